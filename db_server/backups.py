@@ -0,0 +1,92 @@
+import io
+import os
+import json
+import gzip
+import datetime as dt
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional, gzip is always available
+    zstandard = None
+
+
+MANIFEST_NAME = "manifest.json"
+COMPRESSIONS = ("gz", "zst")
+
+
+class BackupError(Exception):
+    pass
+
+
+# opens compressed csv file in text mode, compression is chosen by extension
+def open_backup_file(path, mode):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise BackupError(f"zstandard is not installed, can't open {path}")
+        raw_file = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(raw_file)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw_file)
+        return io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+
+
+def get_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise BackupError(f"unknown backup compression {compression}, expected one of {COMPRESSIONS}")
+    if compression == "zst" and zstandard is None:
+        print("zstandard is not installed, falling back to gzip")
+        return "gz"
+    return compression
+
+
+# manifest.json in backup directory describes current chain: one full backup followed by incrementals
+# watermark is the last exported insertion id, next incremental backup starts after it
+class BackupManifest:
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, MANIFEST_NAME)
+        self.chain = []
+        self.watermark = 0
+
+    @classmethod
+    def load(cls, backup_dir):
+        manifest = cls(backup_dir)
+        if os.path.isfile(manifest.path):
+            with open(manifest.path) as file:
+                data = json.load(file)
+            manifest.chain = data["chain"]
+            manifest.watermark = data["watermark"]
+        return manifest
+
+    # manifest is replaced atomically, so interrupted backup never moves watermark
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"chain": self.chain, "watermark": self.watermark}, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def new_file_path(self, kind, compression):
+        timestamp = dt.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return os.path.join(self.backup_dir, f"{timestamp}_{kind}.csv.{compression}")
+
+    def add_file(self, path, kind, from_id, to_id, rows_count):
+        if kind == "full":
+            self.chain = []
+        self.chain.append({
+            "file": os.path.basename(path),
+            "kind": kind,
+            "from_id": from_id,
+            "to_id": to_id,
+            "rows": rows_count,
+            "created_timestamp": int(dt.datetime.utcnow().timestamp()),
+        })
+        self.watermark = to_id
+
+    def get_chain_paths(self):
+        if not self.chain:
+            raise BackupError(f"no backups in {self.backup_dir}")
+        if self.chain[0]["kind"] != "full":
+            raise BackupError(f"backup chain in {self.backup_dir} doesn't start with full backup")
+        return [os.path.join(self.backup_dir, el["file"]) for el in self.chain]
@@ -2,13 +2,19 @@
 # https://stackoverflow.com/a/17668009
 import struct
 import socket
+import asyncio
 
 
-def send_msg(sock, msg):
-    msg = bytes(msg, encoding="utf-8")
+# msg is str (json) or already encoded bytes
+def pack_msg(msg):
+    if isinstance(msg, str):
+        msg = bytes(msg, encoding="utf-8")
     # Prefix each message with a 4-byte length (network byte order)
-    msg = struct.pack('>I', len(msg)) + msg
-    sock.sendall(msg)
+    return struct.pack('>I', len(msg)) + msg
+
+
+def send_msg(sock, msg):
+    sock.sendall(pack_msg(msg))
 
 
 def recv_msg(sock):
@@ -35,3 +41,13 @@ def recvall(sock, n):
             return None
         data.extend(packet)
     return data
+
+
+# same framing for asyncio streams, returns None if EOF is hit
+async def read_msg(reader):
+    try:
+        raw_msglen = await reader.readexactly(4)
+        msglen = struct.unpack('>I', raw_msglen)[0]
+        return await reader.readexactly(msglen)
+    except asyncio.IncompleteReadError:
+        return None
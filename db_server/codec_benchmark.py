@@ -0,0 +1,63 @@
+# compares json and binary wire codecs on typical db server responses
+# usage: python codec_benchmark.py [rows]
+import sys
+import json
+import random
+from time import perf_counter
+from wire_codec import CODEC_JSON, CODEC_BINARY, encode_message, decode_message
+from gtinfo_requests import GTInfoResponseTypes, make_request, make_stream_frame
+
+
+def make_activity_rows(rows_count):
+    rows = []
+    for _ in range(rows_count):
+        started_playing_timestamp = random.randint(1600000000, 1700000000)
+        ended_playing_timestamp = started_playing_timestamp + random.randint(60, 20000)
+        rows.append((
+            76561197960265728 + random.randint(0, 10 ** 6),
+            random.randint(10, 2000000),
+            started_playing_timestamp,
+            ended_playing_timestamp,
+            float(ended_playing_timestamp - started_playing_timestamp) / 3600,
+        ))
+    return rows
+
+
+def measure(message, codec, repeats):
+    start_time = perf_counter()
+    for _ in range(repeats):
+        encoded = encode_message(message, codec)
+    encode_time = (perf_counter() - start_time) / repeats
+
+    raw = encoded.encode() if isinstance(encoded, str) else encoded
+    start_time = perf_counter()
+    for _ in range(repeats):
+        decoded = decode_message(raw)
+    decode_time = (perf_counter() - start_time) / repeats
+
+    # json turns tuples into lists, so compare with json round trip
+    assert decoded == json.loads(json.dumps(message))
+    return {"bytes": len(raw), "encode_ms": round(encode_time * 1000, 3), "decode_ms": round(decode_time * 1000, 3)}
+
+
+def main():
+    rows_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    activity_rows = make_activity_rows(rows_count)
+    messages = {
+        f"user_online_activity_objects ({rows_count} rows)": make_request(GTInfoResponseTypes.ok, activity_rows),
+        "stream frame (1000 rows)": make_stream_frame(GTInfoResponseTypes.ok, activity_rows[:1000], True),
+        "most_played (10 rows)": make_request(GTInfoResponseTypes.ok, [(row[0], row[3] - row[2]) for row in activity_rows[:10]]),
+        "users_with_data (1000 ids)": make_request(GTInfoResponseTypes.ok, [row[0] for row in activity_rows[:1000]]),
+    }
+
+    for name, message in messages.items():
+        repeats = max(1, 100000 // max(len(message["data"]), 1))
+        results = {codec: measure(message, codec, repeats) for codec in (CODEC_JSON, CODEC_BINARY)}
+        print(name)
+        for codec, result in results.items():
+            print(f"  {codec:>6}: {result['bytes']:>10} bytes, encode {result['encode_ms']:>9} ms, decode {result['decode_ms']:>9} ms")
+        print(f"  binary/json bytes: {results[CODEC_BINARY]['bytes'] / results[CODEC_JSON]['bytes']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from time import monotonic
+from metrics import metrics
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+@dataclass
+class ConnectionPoolStats:
+    created: int = 0
+    closed: int = 0
+    checkouts: int = 0
+    failed_health_checks: int = 0
+    waits: int = 0
+    total_wait_time: float = 0
+    max_wait_time: float = 0
+
+
+# bounded pool of db-api connections
+# connections are checked with a cheap query on checkout and replaced if broken
+class ConnectionPool:
+    # on_connect(conn) sets up session of every new connection (e.g. pragmas)
+    def __init__(self, db_module, connection_dict, min_size=1, max_size=10, timeout=10, health_check_query="SELECT 1;", on_connect=None):
+        self.db_module = db_module
+        self.connection_dict = connection_dict
+        self.on_connect = on_connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_query = health_check_query
+
+        self.idle_connections = deque()
+        self.connection_states = {}  # { id(conn): dict }, per-connection data like prepared statements
+        self.size = 0  # idle + borrowed connections
+        self.condition = threading.Condition()
+        self.stats = ConnectionPoolStats()
+
+    def fill(self):
+        while True:
+            with self.condition:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = self.create_connection()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.idle_connections.append(conn)
+                self.condition.notify()
+
+    def create_connection(self):
+        conn = self.db_module.connect(**self.connection_dict)
+        if self.on_connect is not None:
+            try:
+                self.on_connect(conn)
+            except Exception:
+                conn.close()
+                raise
+        with self.condition:
+            self.stats.created += 1
+            self.connection_states[id(conn)] = {}
+        return conn
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.stats.closed += 1
+            self.connection_states.pop(id(conn), None)
+
+    # state lives as long as connection, it is dropped when connection is closed
+    def get_connection_state(self, conn):
+        with self.condition:
+            return self.connection_states.setdefault(id(conn), {})
+
+    def is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def get(self):
+        start_time = monotonic()
+        deadline = start_time + self.timeout
+        waited = False
+
+        with self.condition:
+            while True:
+                if self.idle_connections:
+                    conn = self.idle_connections.pop()
+                    break
+                if self.size < self.max_size:
+                    conn = None
+                    self.size += 1
+                    break
+                waited = True
+                if (remaining := deadline - monotonic()) <= 0 or not self.condition.wait(remaining):
+                    if not self.idle_connections and self.size >= self.max_size:
+                        raise PoolTimeoutError(f"no free connection in {self.timeout}s (pool size {self.max_size})")
+
+            self.stats.checkouts += 1
+            metrics.observe("db_pool_wait_seconds", monotonic() - start_time)
+            if waited:
+                wait_time = monotonic() - start_time
+                self.stats.waits += 1
+                self.stats.total_wait_time += wait_time
+                self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+
+        # reconnect if idle connection died (db restart, idle timeout, etc.)
+        if conn is not None and not self.is_healthy(conn):
+            with self.condition:
+                self.stats.failed_health_checks += 1
+            self.close_connection(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.create_connection()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                raise
+        return conn
+
+    # broken connections are closed instead of being returned to pool
+    def put(self, conn, broken=False):
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken:
+            self.close_connection(conn)
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            return
+
+        with self.condition:
+            self.idle_connections.append(conn)
+            self.condition.notify()
+
+    # connection is returned to pool on any exit, including generator close
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = not self.is_healthy(conn)
+            raise
+        finally:
+            self.put(conn, broken=broken)
+
+    def close_all(self):
+        with self.condition:
+            idle_connections = list(self.idle_connections)
+            self.idle_connections.clear()
+            self.size -= len(idle_connections)
+            self.condition.notify_all()
+        for conn in idle_connections:
+            self.close_connection(conn)
+
+    def get_stats(self):
+        with self.condition:
+            stats = asdict(self.stats)
+            stats["size"] = self.size
+            stats["idle"] = len(self.idle_connections)
+            stats["in_use"] = self.size - len(self.idle_connections)
+            stats["max_size"] = self.max_size
+        stats["avg_wait_time"] = stats["total_wait_time"] / stats["waits"] if stats["waits"] else 0
+        return stats
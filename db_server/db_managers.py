@@ -1,231 +1,796 @@
 import os
+import json
+import base64
 import sqlite3
 import psycopg2
+import psycopg2.extras
 import datetime as dt
-from abc import ABC
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
 import csv
+import threading
+import uuid
+import hashlib
+import shutil
+import tempfile
+from urllib.request import pathname2url
+import itertools
 from functools import wraps
+from time import monotonic
+from collections import defaultdict
+from connection_pool import ConnectionPool
+from sqlite_writer import SqliteWriter
+from metrics import metrics
+from backups import BackupError, BackupManifest, open_backup_file, get_compression
 from gtinfo_requests import DBManagerResponseTypes, GTInfoRequestTypes, make_request, read_request
 
 
+ACTIVITY_COLUMNS = ("tracked_user", "game_id", "started_playing_timestamp", "ended_playing_timestamp", "total_played")
+ACTIVITY_COLUMNS_STR = "(" + ", ".join(ACTIVITY_COLUMNS) + ")"
+
+DAY_SECONDS = 24 * 60 * 60
+MAX_PAGE_SIZE = 10000
+STREAM_CHUNK_SIZE = 1000
+
+
+def floor_day(timestamp):
+    return timestamp // DAY_SECONDS * DAY_SECONDS
+
+
+def ceil_day(timestamp):
+    return -(-timestamp // DAY_SECONDS) * DAY_SECONDS
+
+
+def month_start(timestamp):
+    date = dt.datetime.utcfromtimestamp(timestamp)
+    return dt.datetime(date.year, date.month, 1)
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    return dt.datetime(date.year + month // 12, month % 12 + 1, 1)
+
+
+def utc_timestamp(date):
+    return int(date.replace(tzinfo=dt.timezone.utc).timestamp())
+
+
+def encode_page_token(position):
+    return base64.urlsafe_b64encode(json.dumps(list(position)).encode()).decode()
+
+
+def decode_page_token(page_token):
+    return json.loads(base64.urlsafe_b64decode(page_token.encode()))
+
+
+# %s placeholders to $1, $2, ... as required by PREPARE
+def numbered_placeholders(query):
+    parts = query.split("%s")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+
+@dataclass
+class PartitioningSettings:
+    enabled: bool = False
+    premake_months: int = 3  # partitions are created in advance for this many upcoming months
+    retention_months: int = 0  # partitions older than this many months are retired, 0 keeps everything
+    retention_action: str = "detach"  # detach, drop or archive (compressed csv in archive_dir, then drop)
+    archive_dir: str = "archive"
+
+
+@dataclass
+class SqliteSettings:
+    tuned: bool = False  # WAL journal, one writer connection fed by a queue and pool of read-only connections
+    synchronous: str = "NORMAL"  # OFF, NORMAL, FULL or EXTRA; with WAL NORMAL may lose last commits on power loss, never corrupts
+    read_pool_size: int = 4
+    busy_timeout: float = 5  # seconds to wait for a lock
+    memory: bool = False  # disposable db in temporary file, synchronous OFF (for tests and benchmarks), deleted when manager is closed
+
+
+# csv stores None as empty string
+def backup_row_from_csv(row):
+    return tuple(None if value == "" else int(value) for value in row[:4]) + (None if row[4] == "" else float(row[4]),)
+
+
+# activity object has every column, ids and timestamps are bigints and session doesn't end before it starts
+def is_valid_activity_object(data):
+    if not isinstance(data, dict) or any(column not in data for column in ACTIVITY_COLUMNS):
+        return False
+    if any(type(data[column]) is not int or not 0 <= data[column] < 2 ** 63 for column in ACTIVITY_COLUMNS[:4]):
+        return False
+    if type(data["total_played"]) not in (int, float):
+        return False
+    return data["started_playing_timestamp"] <= data["ended_playing_timestamp"]
+
+
 def create_file_if_not_exists(filepath):
     if not os.path.isfile(filepath):
         with open(filepath, "w"):
             pass
 
 
-def with_cursor(f):
+# returns connection to pool, connection that failed during request is dropped,
+# so its session state (open transaction, prepared statements) is not reused
+def release_connection(connection_pool, conn, cursor, failed=False):
+    try:
+        cursor.close()
+    except Exception:
+        failed = True
+    connection_pool.put(conn, broken=failed)
+
+
+# db time is added to current thread, so socket handler can attribute it to request type
+def make_cursor_wrapper(f, read_only):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        obj = args[0]
+        start_time = monotonic()
+        response = args[0].run_with_cursor(f, args, kwargs, read_only)
+        duration = monotonic() - start_time
+        metrics.add_thread_db_time(duration)
+        metrics.observe("db_call_seconds", duration, function=f.__name__)
+        metrics.inc("db_calls_total", function=f.__name__, response=DBManagerResponseTypes(response["type"]).name)
+        return response
+    return wrapper
+
+
+def with_cursor(f):
+    return make_cursor_wrapper(f, read_only=False)
+
+
+# function only reads, so manager may run it on a read-only connection
+def with_read_cursor(f):
+    return make_cursor_wrapper(f, read_only=True)
 
-        try:
-            conn = obj.db_module.connect(**obj.connection_dict)
-            cursor = conn.cursor()
-        except Exception as ex:
-            print(f"Database connection failure: {ex}")
-            obj.is_set_up = False
-            return make_request(DBManagerResponseTypes.error, 0)
 
+def call_with_cursor(f, args, kwargs, connection_pool):
+    obj = args[0]
+
+    try:
+        conn = connection_pool.get()
+    except Exception as ex:
+        print(f"Database connection failure: {ex}")
+        obj.is_set_up = False
+        return make_request(DBManagerResponseTypes.error, 0)
+
+    try:
+        cursor = conn.cursor()
+    except Exception as ex:
+        print(f"Database connection failure: {ex}")
+        obj.is_set_up = False
+        connection_pool.put(conn, broken=True)
+        return make_request(DBManagerResponseTypes.error, 0)
+
+    with obj.setup_lock:
         if not obj.is_set_up:
             try:
+                obj.begin_transaction(cursor)
                 obj.create_tables.__wrapped__(obj, cursor)
+                obj.migrate(cursor)
                 conn.commit()
                 obj.is_set_up = True
             except Exception as ex:
                 print(f"Setup failure: {ex}")
+                release_connection(connection_pool, conn, cursor, failed=True)
                 return make_request(DBManagerResponseTypes.error, 0)
 
-        try:
-            res = f(*args, **kwargs, cursor=cursor)
-            conn.commit()
-            res = 0 if res is None else res
-        except Exception as ex:
-            print(f"DBManager failure: {ex}")
-            obj.is_set_up = False
-            return make_request(DBManagerResponseTypes.error, 0)
+    try:
+        res = f(*args, **kwargs, cursor=cursor)
+        conn.commit()
+        res = 0 if res is None else res
+    except Exception as ex:
+        print(f"DBManager failure: {ex}")
+        obj.is_set_up = False
+        release_connection(connection_pool, conn, cursor, failed=True)
+        return make_request(DBManagerResponseTypes.error, 0)
 
-        cursor.close()
-        conn.close()
-        return make_request(DBManagerResponseTypes.ok, res)
-    return wrapper
+    release_connection(connection_pool, conn, cursor)
+    return make_request(DBManagerResponseTypes.ok, res)
 
 
 class DBManager(ABC):
-    is_set_up = False
+    connection_pool = None
+    insertion_id_column = "id"  # grows with every inserted activity object, used as backup watermark
+
+    # setup lock is per manager, so setup and migrations of one database don't wait for another
+    def __init__(self):
+        self.is_set_up = False
+        self.setup_lock = threading.Lock()
+
+    def get_pool_stats(self):
+        return self.connection_pool.get_stats()
+
+    def run_with_cursor(self, f, args, kwargs, read_only):
+        return call_with_cursor(f, args, kwargs, self.get_connection_pool(read_only))
+
+    def get_connection_pool(self, read_only):
+        return self.connection_pool
+
+    def close(self):
+        self.connection_pool.close_all()
 
     @with_cursor
     def set_up(self, cursor):
-        pass
+        self.connection_pool.fill()
+
+    # goes through write connection, so it tells if activity objects can be written at all
+    @with_cursor
+    def check_health(self, cursor):
+        cursor.execute("SELECT 1;")
 
     @with_cursor
     def create_tables(self, cursor):
         cursor.execute("CREATE TABLE IF NOT EXISTS user_online_activity_objects (tracked_user Bigint, game_id Bigint, started_playing_timestamp Bigint, ended_playing_timestamp Bigint, total_played float);")
         cursor.execute("CREATE TABLE IF NOT EXISTS telegram_bot_ignore_table (chat_id Bigint, steam_id Bigint);")
 
+    # ordered schema migrations, schema version is the number of applied steps
+    # steps are only ever appended, released steps must not be changed
+    def get_migrations(self):
+        return [
+            self.migration_add_indexes,
+            self.migration_add_daily_rollup,
+            self.migration_add_insertion_id,
+            self.migration_add_seen_tables,
+            self.migration_add_explicit_insertion_id,
+        ]
+
+    def migrate(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version Bigint, applied_timestamp Bigint);")
+        cursor.execute("SELECT MAX(version) FROM schema_version;")
+        current_version = cursor.fetchone()[0] or 0
+
+        migrations = self.get_migrations()
+        for version in range(current_version + 1, len(migrations) + 1):
+            migration = migrations[version - 1]
+            print(f"Applying migration {version} ({migration.__name__})")
+            migration(cursor)
+            self.execute(cursor, "INSERT INTO schema_version VALUES (%s, %s);", (version, int(dt.datetime.utcnow().timestamp())))
+
+    def migration_add_indexes(self, cursor):
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_user_started_idx ON user_online_activity_objects (tracked_user, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_game_started_idx ON user_online_activity_objects (game_id, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS telegram_bot_ignore_table_steam_chat_idx ON telegram_bot_ignore_table (steam_id, chat_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS telegram_bot_ignore_table_chat_idx ON telegram_bot_ignore_table (chat_id);")
+
+    def migration_add_daily_rollup(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS user_online_activity_daily (tracked_user Bigint, game_id Bigint, day Bigint, ended_day Bigint, seconds_played Bigint, sessions_count Bigint, PRIMARY KEY (tracked_user, game_id, day, ended_day));")
+        # edge days of requested windows are read from raw table by start or end time
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_started_idx ON user_online_activity_objects (started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_ended_idx ON user_online_activity_objects (ended_playing_timestamp);")
+        self.fill_daily_rollup(cursor)
+
+    # sqlite tables already have rowid, it is replaced with explicit id by migration_add_explicit_insertion_id
+    def migration_add_insertion_id(self, cursor):
+        pass
+
+    def migration_add_seen_tables(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS tracked_users_seen (tracked_user Bigint PRIMARY KEY, first_seen_timestamp Bigint, last_seen_timestamp Bigint, sessions_count Bigint);")
+        cursor.execute("CREATE TABLE IF NOT EXISTS games_seen (game_id Bigint PRIMARY KEY, first_seen_timestamp Bigint, last_seen_timestamp Bigint, sessions_count Bigint);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS tracked_users_seen_last_seen_idx ON tracked_users_seen (last_seen_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS games_seen_last_seen_idx ON games_seen (last_seen_timestamp);")
+        self.fill_seen_tables(cursor)
+
+    # for managers that had no explicit insertion id column after migration_add_insertion_id
+    def migration_add_explicit_insertion_id(self, cursor):
+        pass
+
+    # opens transaction explicitly where connection is in autocommit mode
+    def begin_transaction(self, cursor):
+        pass
+
+    # queries are written with %s placeholders, managers convert them to own db module paramstyle
+    def format_query(self, query):
+        return query
+
+    # prepare=True marks hot queries that are prepared once per pooled connection and reused
+    def execute(self, cursor, query, params=(), prepare=False):
+        cursor.execute(self.format_query(query), params)
+
+    # inserts many rows with one statement where possible, query_head is "INSERT INTO table (columns)"
+    def insert_rows(self, cursor, query_head, rows, query_tail=""):
+        placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")" if rows else "()"
+        cursor.executemany(self.format_query(f"{query_head} VALUES {placeholders} {query_tail};"), rows)
+
+    # condition "column is one of values" with one bound parameter, so query text doesn't depend on values count
+    @abstractmethod
+    def in_array(self, column):
+        pass
+
+    @abstractmethod
+    def array_param(self, values):
+        pass
+
     @with_cursor
     def add_user_online_activity_object(self, data, cursor):
-        cursor.execute(f"INSERT INTO user_online_activity_objects VALUES ({data['tracked_user']}, {data['game_id']}, {data['started_playing_timestamp']}, {data['ended_playing_timestamp']}, {data['total_played']});")
+        return self.add_user_online_activity_objects.__wrapped__(self, [data], cursor=cursor)
+
+    @staticmethod
+    def user_online_activity_object_to_row(data):
+        return tuple(data[column] for column in ACTIVITY_COLUMNS)
+
+    # whole batch is written in one transaction (all or nothing)
+    # daily rollup is updated in the same transaction
+    @with_cursor
+    def add_user_online_activity_objects(self, data, cursor):
+        if not (rows := [self.user_online_activity_object_to_row(el) for el in data]):
+            return
+        self.begin_transaction(cursor)
+        self.prepare_activity_rows(rows, cursor)
+        self.insert_rows(cursor, "INSERT INTO user_online_activity_objects " + ACTIVITY_COLUMNS_STR, rows)
+        self.update_daily_rollup(rows, cursor)
+        self.update_seen_tables(rows, cursor)
+
+    # called before activity rows are inserted, e.g. to create missing partitions
+    def prepare_activity_rows(self, rows, cursor):
+        pass
+
+    # daily rollup: seconds played and sessions count per (user, game, start day, end day)
+    # session is counted for the day it started, end day allows exact cut at window end
+    def update_daily_rollup(self, rows, cursor):
+        buckets = defaultdict(lambda: [0, 0])
+        for tracked_user, game_id, started_playing_timestamp, ended_playing_timestamp, total_played in rows:
+            key = (tracked_user, game_id, floor_day(started_playing_timestamp), floor_day(ended_playing_timestamp))
+            buckets[key][0] += ended_playing_timestamp - started_playing_timestamp
+            buckets[key][1] += 1
+
+        self.insert_rows(
+            cursor,
+            "INSERT INTO user_online_activity_daily (tracked_user, game_id, day, ended_day, seconds_played, sessions_count)",
+            [key + tuple(values) for key, values in buckets.items()],
+            "ON CONFLICT (tracked_user, game_id, day, ended_day) DO UPDATE SET \
+            seconds_played = user_online_activity_daily.seconds_played + excluded.seconds_played, \
+            sessions_count = user_online_activity_daily.sessions_count + excluded.sessions_count"
+        )
+
+    # first seen is the earliest session start, last seen is the latest session end
+    def update_seen_tables(self, rows, cursor):
+        for table, column, index in (("tracked_users_seen", "tracked_user", 0), ("games_seen", "game_id", 1)):
+            seen = {}
+            for row in rows:
+                if (values := seen.get(row[index], None)) is None:
+                    seen[row[index]] = [row[2], row[3], 1]
+                else:
+                    values[0] = min(values[0], row[2])
+                    values[1] = max(values[1], row[3])
+                    values[2] += 1
+
+            self.insert_rows(
+                cursor,
+                f"INSERT INTO {table} ({column}, first_seen_timestamp, last_seen_timestamp, sessions_count)",
+                [(key, *values) for key, values in seen.items()],
+                f"ON CONFLICT ({column}) DO UPDATE SET \
+                first_seen_timestamp = CASE WHEN excluded.first_seen_timestamp < {table}.first_seen_timestamp \
+                    THEN excluded.first_seen_timestamp ELSE {table}.first_seen_timestamp END, \
+                last_seen_timestamp = CASE WHEN excluded.last_seen_timestamp > {table}.last_seen_timestamp \
+                    THEN excluded.last_seen_timestamp ELSE {table}.last_seen_timestamp END, \
+                sessions_count = {table}.sessions_count + excluded.sessions_count"
+            )
+
+    def fill_seen_tables(self, cursor):
+        for table, column in (("tracked_users_seen", "tracked_user"), ("games_seen", "game_id")):
+            cursor.execute(f"INSERT INTO {table} ({column}, first_seen_timestamp, last_seen_timestamp, sessions_count) \
+                SELECT {column}, MIN(started_playing_timestamp), MAX(ended_playing_timestamp), COUNT(*) \
+                FROM user_online_activity_objects \
+                GROUP BY {column};")
+
+    def fill_daily_rollup(self, cursor):
+        cursor.execute(f"INSERT INTO user_online_activity_daily (tracked_user, game_id, day, ended_day, seconds_played, sessions_count) \
+                SELECT tracked_user, game_id, \
+                started_playing_timestamp / {DAY_SECONDS} * {DAY_SECONDS} AS day, \
+                ended_playing_timestamp / {DAY_SECONDS} * {DAY_SECONDS} AS ended_day, \
+                CAST(SUM(ended_playing_timestamp - started_playing_timestamp) AS BIGINT), \
+                COUNT(*) \
+                FROM user_online_activity_objects \
+                GROUP BY tracked_user, game_id, \
+                started_playing_timestamp / {DAY_SECONDS} * {DAY_SECONDS}, \
+                ended_playing_timestamp / {DAY_SECONDS} * {DAY_SECONDS};")
+
+    # rebuilds daily rollup and seen tables from raw sessions (e.g. after manual edits of raw table)
+    # sessions already removed by partition retention are lost from them
+    @with_cursor
+    def rebuild_daily_rollup(self, cursor):
+        self.begin_transaction(cursor)
+        cursor.execute("DELETE FROM user_online_activity_daily;")
+        self.fill_daily_rollup(cursor)
+        cursor.execute("DELETE FROM tracked_users_seen;")
+        cursor.execute("DELETE FROM games_seen;")
+        self.fill_seen_tables(cursor)
 
     @with_cursor
     def add_ignore_entry(self, data, cursor):
-        cursor.execute(f"SELECT * FROM telegram_bot_ignore_table WHERE chat_id = {data['chat_id']} and steam_id = {data['steam_id']} LIMIT 1;")
+        params = (data['chat_id'], data['steam_id'])
+        self.execute(cursor, "SELECT chat_id FROM telegram_bot_ignore_table WHERE chat_id = %s and steam_id = %s LIMIT 1;", params, prepare=True)
         if cursor.fetchone() is None:
-            cursor.execute(f"INSERT INTO telegram_bot_ignore_table VALUES ({data['chat_id']}, {data['steam_id']});")
+            self.execute(cursor, "INSERT INTO telegram_bot_ignore_table (chat_id, steam_id) VALUES (%s, %s);", params, prepare=True)
 
-    @with_cursor
+    @with_read_cursor
     def get_ignore_steam_ids_by_chat_id(self, data, cursor):
-        cursor.execute(f"SELECT steam_id FROM telegram_bot_ignore_table WHERE chat_id = {data['chat_id']};")
+        self.execute(cursor, "SELECT steam_id FROM telegram_bot_ignore_table WHERE chat_id = %s;", (data['chat_id'],), prepare=True)
         return cursor.fetchall()
 
-    @with_cursor
+    @with_read_cursor
     def get_ignore_chat_ids_by_steam_id(self, data, cursor):
-        cursor.execute(f"SELECT chat_id FROM telegram_bot_ignore_table WHERE steam_id = {data['steam_id']};")
+        self.execute(cursor, "SELECT chat_id FROM telegram_bot_ignore_table WHERE steam_id = %s;", (data['steam_id'],), prepare=True)
         return cursor.fetchall()
 
     @with_cursor
     def remove_ignore_entry(self, data, cursor):
-        cursor.execute(f"SELECT * FROM telegram_bot_ignore_table WHERE chat_id = {data['chat_id']} and steam_id = {data['steam_id']} LIMIT 1;")
-        if cursor.fetchone() is not None:
-            cursor.execute(f"DELETE FROM telegram_bot_ignore_table WHERE chat_id = {data['chat_id']} and steam_id = {data['steam_id']};")
+        self.execute(cursor, "DELETE FROM telegram_bot_ignore_table WHERE chat_id = %s and steam_id = %s;", (data['chat_id'], data['steam_id']), prepare=True)
 
-    @with_cursor
-    def get_user_online_activity_objects(self, data, cursor):
-        true_request = "1=1"
+    # returns (query, params) selecting filtered activity objects or None if filters match nothing
+    # after is keyset position (started_playing_timestamp, tracked_user, game_id) of last returned row
+    def user_online_activity_objects_query(self, data, after=None, limit=None):
+        conditions = ["1=1"]
+        params = []
 
-        start_timestamp = data.get("start_timestamp", None)
-        start_timestamp_request = f"started_playing_timestamp >= {start_timestamp}" if start_timestamp else true_request
+        if start_timestamp := data.get("start_timestamp", None):
+            conditions.append("started_playing_timestamp >= %s")
+            params.append(start_timestamp)
 
-        end_timestamp = data.get("end_timestamp", None)
-        end_timestamp_request = f"ended_playing_timestamp <= {end_timestamp}" if end_timestamp else true_request
+        # session ends after it starts, redundant bound on start time lets partitioned table skip later partitions
+        if end_timestamp := data.get("end_timestamp", None):
+            conditions += ["ended_playing_timestamp <= %s", "started_playing_timestamp <= %s"]
+            params += [end_timestamp, end_timestamp]
 
         tracked_users = data.get("tracked_users", None)
-        tracked_users_request = true_request
         if tracked_users == []:
-            return []
+            return None
         if tracked_users:
-            tracked_users = [str(x) for x in tracked_users]
-            tracked_users_str = "(" + ", ".join(tracked_users) + ")"
-            tracked_users_request = f"tracked_user in {tracked_users_str}"
+            conditions.append(self.in_array("tracked_user"))
+            params.append(self.array_param(tracked_users))
 
         game_ids = data.get("game_ids", None)
-        game_ids_request = true_request
         if game_ids == []:
-            return []
+            return None
         if game_ids:
-            game_ids = [str(x) for x in game_ids]
-            game_ids_str = "(" + ", ".join(game_ids) + ")"
-            game_ids_request = f"game_id in {game_ids_str}"
-
-        request = f"SELECT * FROM user_online_activity_objects WHERE \
-            {start_timestamp_request} AND {end_timestamp_request} AND \
-            {tracked_users_request} AND {game_ids_request};"
-        cursor.execute(request)
-        return cursor.fetchall()
-
-    @with_cursor
-    def get_most_played_users(self, data, cursor):
-        true_request = "1=1"
-
+            conditions.append(self.in_array("game_id"))
+            params.append(self.array_param(game_ids))
+
+        if after is not None:
+            conditions.append("(started_playing_timestamp, tracked_user, game_id) > (%s, %s, %s)")
+            params += [int(x) for x in after]
+
+        limit_str = ""
+        if limit:
+            limit_str = "LIMIT %s"
+            params.append(int(limit))
+
+        query = f"SELECT {', '.join(ACTIVITY_COLUMNS)} FROM user_online_activity_objects \
+            WHERE {' AND '.join(conditions)} \
+            ORDER BY started_playing_timestamp, tracked_user, game_id \
+            {limit_str};"
+        return query, params
+
+    # without "page_size" returns all rows (old clients)
+    # with "page_size" returns {"rows": [...], "next": token}, token is passed back as "page_token" for next page
+    @with_read_cursor
+    def get_user_online_activity_objects(self, data, cursor):
+        if not (page_size := data.get("page_size", None)):
+            if (request := self.user_online_activity_objects_query(data)) is None:
+                return []
+            self.execute(cursor, *request)
+            return cursor.fetchall()
+
+        page_size = min(int(page_size), MAX_PAGE_SIZE)
+        after = decode_page_token(page_token) if (page_token := data.get("page_token", None)) else None
+        if (request := self.user_online_activity_objects_query(data, after, page_size)) is None:
+            return {"rows": [], "next": None}
+        self.execute(cursor, *request, prepare=True)
+        rows = cursor.fetchall()
+
+        next_page_token = None
+        if len(rows) == page_size:
+            started_playing_timestamp, tracked_user, game_id = rows[-1][2], rows[-1][0], rows[-1][1]
+            next_page_token = encode_page_token((started_playing_timestamp, tracked_user, game_id))
+        return {"rows": rows, "next": next_page_token}
+
+    # yields filtered rows in chunks, server-side cursor keeps memory flat for any result size
+    # pooled connection is held until generator is exhausted or closed
+    def iter_user_online_activity_objects(self, data, chunk_size=STREAM_CHUNK_SIZE):
+        if (request := self.user_online_activity_objects_query(data)) is None:
+            return
+        if not self.is_set_up:
+            self.set_up()
+
+        with self.get_connection_pool(read_only=True).connection() as conn:
+            cursor = self.streaming_cursor(conn, chunk_size)
+            try:
+                self.execute(cursor, *request)
+                while rows := cursor.fetchmany(chunk_size):
+                    yield rows
+            finally:
+                cursor.close()
+
+    def streaming_cursor(self, conn, chunk_size):
+        return conn.cursor()
+
+    # window is split into whole days answered from daily rollup and partial edge days answered from raw sessions:
+    #   rollup: started in [ceil_day(start), ...) and ended in (..., floor_day(end))
+    #   raw: started in [start, ceil_day(start)), or ended in [floor_day(end), end]
+    # so all-time and day-aligned requests don't touch raw table at all
+    def get_most_played(self, column, data, cursor):
         start_timestamp = data.get("start_timestamp", None)
-        start_timestamp_request = f"started_playing_timestamp >= {start_timestamp}" if start_timestamp else true_request
-
         end_timestamp = data.get("end_timestamp", None)
-        end_timestamp_request = f"ended_playing_timestamp <= {end_timestamp}" if end_timestamp else true_request
+        first_whole_day = ceil_day(start_timestamp) if start_timestamp else None
+        last_whole_day_end = floor_day(end_timestamp) if end_timestamp else None
 
         tracked_users = data.get("tracked_users", None)
-        tracked_users_request = true_request
         if tracked_users == []:
             return []
-        if tracked_users:
-            tracked_users = [str(x) for x in tracked_users]
-            tracked_users_str = "(" + ", ".join(tracked_users) + ")"
-            tracked_users_request = f"tracked_user in {tracked_users_str}"
-
-        limit = data.get("limit", None)
-        limit_str = f"LIMIT {limit}" if limit else ""
-
-        request = f"SELECT tracked_user, \
-                    CAST(SUM(ended_playing_timestamp - started_playing_timestamp) AS BIGINT) AS total_played \
-                    FROM user_online_activity_objects \
-                    WHERE {start_timestamp_request} AND {end_timestamp_request} AND {tracked_users_request} \
-                    GROUP BY tracked_user \
-                    ORDER BY total_played desc \
-                    {limit_str};"
-        cursor.execute(request)
-        return cursor.fetchall()
-
-    @with_cursor
-    def get_most_played_games(self, data, cursor):
-        true_request = "1=1"
 
-        start_timestamp = data.get("start_timestamp", None)
-        start_timestamp_request = f"started_playing_timestamp >= {start_timestamp}" if start_timestamp else true_request
+        parts = []
+        params = []
+
+        def add_part(table, played, part_conditions, part_params):
+            if tracked_users:
+                part_conditions = [self.in_array("tracked_user")] + part_conditions
+                part_params = [self.array_param(tracked_users)] + part_params
+            parts.append(f"SELECT {column}, {played} AS played FROM {table} WHERE {' AND '.join(['1=1'] + part_conditions)}")
+            params.extend(part_params)
+
+        conditions, part_params = [], []
+        if first_whole_day is not None:
+            conditions.append("day >= %s")
+            part_params.append(first_whole_day)
+        if last_whole_day_end is not None:
+            conditions.append("ended_day < %s")
+            part_params.append(last_whole_day_end)
+        add_part("user_online_activity_daily", "seconds_played", conditions, part_params)
+
+        raw_played = "ended_playing_timestamp - started_playing_timestamp"
+        if first_whole_day is not None and start_timestamp < first_whole_day:
+            conditions = ["started_playing_timestamp >= %s", "started_playing_timestamp < %s"]
+            part_params = [start_timestamp, first_whole_day]
+            if end_timestamp:
+                conditions.append("ended_playing_timestamp <= %s")
+                part_params.append(end_timestamp)
+            add_part("user_online_activity_objects", raw_played, conditions, part_params)
+        if last_whole_day_end is not None:
+            conditions = ["ended_playing_timestamp >= %s", "ended_playing_timestamp <= %s", "started_playing_timestamp <= %s"]
+            part_params = [last_whole_day_end, end_timestamp, end_timestamp]
+            if first_whole_day is not None:
+                conditions.append("started_playing_timestamp >= %s")
+                part_params.append(first_whole_day)
+            add_part("user_online_activity_objects", raw_played, conditions, part_params)
+
+        limit_str = ""
+        if limit := data.get("limit", None):
+            limit_str = "LIMIT %s"
+            params.append(int(limit))
+
+        query = f"SELECT {column}, CAST(SUM(played) AS BIGINT) AS total_played \
+                  FROM ({' UNION ALL '.join(parts)}) AS played_parts \
+                  GROUP BY {column} \
+                  ORDER BY total_played desc \
+                  {limit_str};"
+        self.execute(cursor, query, params, prepare=True)
+        return cursor.fetchall()
 
-        end_timestamp = data.get("end_timestamp", None)
-        end_timestamp_request = f"ended_playing_timestamp <= {end_timestamp}" if end_timestamp else true_request
+    @with_read_cursor
+    def get_most_played_users(self, data, cursor):
+        return self.get_most_played("tracked_user", data, cursor)
 
-        tracked_users = data.get("tracked_users", None)
-        tracked_users_request = true_request
-        if tracked_users == []:
-            return []
-        if tracked_users:
-            tracked_users = [str(x) for x in tracked_users]
-            tracked_users_str = "(" + ", ".join(tracked_users) + ")"
-            tracked_users_request = f"tracked_user in {tracked_users_str}"
-
-        limit = data.get("limit", None)
-        limit_str = f"LIMIT {limit}" if limit else ""
-
-        request = f"SELECT game_id, \
-                    CAST(SUM(ended_playing_timestamp - started_playing_timestamp) AS BIGINT) AS total_played \
-                    FROM user_online_activity_objects \
-                    WHERE {start_timestamp_request} AND {end_timestamp_request} AND {tracked_users_request} \
-                    GROUP BY game_id \
-                    ORDER BY total_played desc \
-                    {limit_str};"
-        cursor.execute(request)
-        return cursor.fetchall()
+    @with_read_cursor
+    def get_most_played_games(self, data, cursor):
+        return self.get_most_played("game_id", data, cursor)
+
+    # ["active_since": 1] keeps only ones with session ended at or after timestamp
+    def get_seen(self, table, column, data, cursor):
+        active_since = data.get("active_since", None) if isinstance(data, dict) else None
+        if active_since:
+            self.execute(cursor, f"SELECT {column} FROM {table} WHERE last_seen_timestamp >= %s ORDER BY {column};", (active_since,), prepare=True)
+        else:
+            self.execute(cursor, f"SELECT {column} FROM {table} ORDER BY {column};", prepare=True)
+        return [element[0] for element in cursor.fetchall()]
 
-    @with_cursor
+    @with_read_cursor
     def get_users_with_data(self, data, cursor):
-        request = f"SELECT DISTINCT tracked_user FROM user_online_activity_objects;"
-        cursor.execute(request)
-        return [element[0] for element in cursor.fetchall()]
+        return self.get_seen("tracked_users_seen", "tracked_user", data, cursor)
 
-    @with_cursor
+    @with_read_cursor
     def get_games_with_data(self, data, cursor):
-        request = f"SELECT DISTINCT game_id FROM user_online_activity_objects;"
-        cursor.execute(request)
-        return [element[0] for element in cursor.fetchall()]
-
+        return self.get_seen("games_seen", "game_id", data, cursor)
 
+    # periodic maintenance (partitions), returns list of performed actions
+    @with_cursor
+    def maintain_partitions(self, cursor):
+        return []
+
+    def get_insertion_id_bound(self, cursor):
+        cursor.execute(f"SELECT COALESCE(MAX({self.insertion_id_column}), 0) FROM user_online_activity_objects;")
+        return cursor.fetchone()[0]
+
+    # full backup (or first backup in backup_dir) exports whole table and starts new chain,
+    # incremental backup exports rows inserted after watermark of the previous backup
+    # rows are streamed in chunks into compressed csv, manifest is updated only after file is complete
+    @with_read_cursor
+    def create_backup_csv(self, backup_dir, compression, full, cursor):
+        os.makedirs(backup_dir, exist_ok=True)
+        manifest = BackupManifest.load(backup_dir)
+        kind = "full" if full or not manifest.chain else "incremental"
+        from_id = 0 if kind == "full" else manifest.watermark
+        to_id = self.get_insertion_id_bound(cursor)
+        if kind == "incremental" and to_id <= from_id:
+            return {"kind": kind, "file": None, "rows": 0}
+
+        path = manifest.new_file_path(kind, get_compression(compression))
+        tmp_path = os.path.join(backup_dir, ".tmp_" + os.path.basename(path))
+        rows_count = 0
+        stream_cursor = self.streaming_cursor(cursor.connection, STREAM_CHUNK_SIZE)
+        try:
+            self.execute(
+                stream_cursor,
+                f"SELECT {', '.join(ACTIVITY_COLUMNS)} FROM user_online_activity_objects \
+                WHERE {self.insertion_id_column} > %s AND {self.insertion_id_column} <= %s \
+                ORDER BY {self.insertion_id_column};",
+                (from_id, to_id)
+            )
+            with open_backup_file(tmp_path, "w") as file:
+                csv_out = csv.writer(file)
+                csv_out.writerow(ACTIVITY_COLUMNS)
+                while rows := stream_cursor.fetchmany(STREAM_CHUNK_SIZE):
+                    csv_out.writerows(rows)
+                    rows_count += len(rows)
+        except Exception:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            stream_cursor.close()
+
+        os.replace(tmp_path, path)
+        manifest.add_file(path, kind, from_id, to_id, rows_count)
+        manifest.save()
+        return {"kind": kind, "file": path, "rows": rows_count}
+
+    # loads full backup and following incrementals from backup_dir manifest into empty database
+    # daily rollup is rebuilt in the same transaction
+    @with_cursor
+    def restore_backup(self, backup_dir, cursor):
+        paths = BackupManifest.load(backup_dir).get_chain_paths()
+        self.begin_transaction(cursor)
+        cursor.execute("SELECT 1 FROM user_online_activity_objects LIMIT 1;")
+        if cursor.fetchone() is not None:
+            raise BackupError("user_online_activity_objects is not empty, backup can be restored into empty database only")
+
+        rows_count = 0
+        for path in paths:
+            with open_backup_file(path, "r") as file:
+                rows_count += self.load_backup_file(file, cursor)
+
+        cursor.execute("DELETE FROM user_online_activity_daily;")
+        self.fill_daily_rollup(cursor)
+        cursor.execute("DELETE FROM tracked_users_seen;")
+        cursor.execute("DELETE FROM games_seen;")
+        self.fill_seen_tables(cursor)
+        return {"files": len(paths), "rows": rows_count}
+
+    def load_backup_file(self, file, cursor):
+        csv_in = csv.reader(file)
+        if tuple(next(csv_in, ())) != ACTIVITY_COLUMNS:
+            raise BackupError(f"unexpected backup file header, expected {ACTIVITY_COLUMNS}")
+        rows_count = 0
+        while rows := [backup_row_from_csv(row) for row in itertools.islice(csv_in, STREAM_CHUNK_SIZE)]:
+            self.prepare_activity_rows(rows, cursor)
+            self.insert_rows(cursor, "INSERT INTO user_online_activity_objects " + ACTIVITY_COLUMNS_STR, rows)
+            rows_count += len(rows)
+        return rows_count
+
+
+# tuned mode: WAL lets readers work while writer commits, all writes go through one connection in writer thread
+# (sqlite allows one writer at a time anyway), reads are served by pool of read-only connections
 class SqliteManager(DBManager):
-    def __init__(self, db_name):
+    def __init__(self, db_name, pool_min_size=1, pool_max_size=5, pool_timeout=10, settings=None):
+        super().__init__()
+        self.settings = settings or SqliteSettings()
+        if self.settings.synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"unknown sqlite synchronous level {self.settings.synchronous}")
         self.db_name = db_name
-        create_file_if_not_exists(self.db_name)
+        self.temp_dir = None
+        if self.settings.memory:
+            # not a shared-cache memory db: its readers need read_uncommitted not to fail on table locks,
+            # and dirty reads of rolled back writes could get into result cache
+            # temporary file in WAL mode gives readers committed snapshots, as in tuned mode
+            self.temp_dir = tempfile.mkdtemp(prefix="gtinfo_sqlite_")
+            self.db_name = os.path.join(self.temp_dir, "gtinfo.db")
+        if self.db_name != ":memory:":
+            create_file_if_not_exists(self.db_name)
 
         self.db_module = sqlite3
         self.connection_dict = {
             "database": self.db_name,
-            "isolation_level": None
+            "isolation_level": None,
+            "check_same_thread": False,  # pooled connections are shared between threads (one at a time)
+            "cached_statements": 256
         }
+        self.writer = None
+        self.read_pool = None
+        if not self.settings.tuned and not self.settings.memory:
+            self.connection_pool = ConnectionPool(self.db_module, self.connection_dict, pool_min_size, pool_max_size, pool_timeout)
+            self.set_up()
+            return
+
+        self.connection_dict["timeout"] = self.settings.busy_timeout
+        read_connection_dict = dict(self.connection_dict, uri=True)
+        # path is escaped, "?" or "#" in it would be read as uri query or fragment
+        read_connection_dict["database"] = f"file:{pathname2url(os.path.abspath(self.db_name))}?mode=ro"
+
+        self.connection_pool = ConnectionPool(self.db_module, self.connection_dict, 1, 1, pool_timeout, on_connect=self.set_up_write_connection)
+        self.read_pool = ConnectionPool(self.db_module, read_connection_dict, 0, self.settings.read_pool_size, pool_timeout, on_connect=self.set_up_read_connection)
+        self.writer = SqliteWriter()
+        self.writer.start()
 
         self.set_up()
 
-    @with_cursor
-    def create_backup_csv(self, cursor):
-        save_path = "" + f"{dt.datetime.utcnow().timestamp()}.csv"
-        with open(save_path, 'w') as file:
-            cursor.execute('SELECT * FROM user_online_activity_objects')
-            csv_out = csv.writer(file)
-            csv_out.writerow([d[0] for d in cursor.description])
-            for result in cursor:
-                csv_out.writerow(result)
+    def set_up_write_connection(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(f"PRAGMA synchronous={'OFF' if self.settings.memory else self.settings.synchronous};")
+
+    def set_up_read_connection(self, conn):
+        conn.execute("PRAGMA query_only=ON;")
+
+    def get_pool_stats(self):
+        stats = self.connection_pool.get_stats()
+        if self.read_pool is not None:
+            stats.update({f"read_{key}": value for key, value in self.read_pool.get_stats().items()})
+        return stats
+
+    # writes and setup (read-only connections can't create tables) are queued to writer thread
+    def run_with_cursor(self, f, args, kwargs, read_only):
+        if self.writer is None or (read_only and self.is_set_up):
+            return super().run_with_cursor(f, args, kwargs, read_only)
+        return self.writer.submit(call_with_cursor, f, args, kwargs, self.connection_pool)
+
+    def get_connection_pool(self, read_only):
+        if read_only and self.read_pool is not None:
+            return self.read_pool
+        return self.connection_pool
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.stop()
+        if self.read_pool is not None:
+            self.read_pool.close_all()
+        self.connection_pool.close_all()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def begin_transaction(self, cursor):
+        cursor.execute("BEGIN;")
+
+    # implicit rowid may be renumbered by VACUUM and max rowid may be reused after delete, so it can't be backup watermark
+    # table is rebuilt with AUTOINCREMENT id, existing rows keep their rowids as ids, so backup watermarks stay valid
+    def migration_add_explicit_insertion_id(self, cursor):
+        cursor.execute(f"CREATE TABLE user_online_activity_objects_new ({self.insertion_id_column} INTEGER PRIMARY KEY AUTOINCREMENT, \
+            tracked_user Bigint, game_id Bigint, started_playing_timestamp Bigint, ended_playing_timestamp Bigint, total_played float);")
+        cursor.execute(f"INSERT INTO user_online_activity_objects_new ({self.insertion_id_column}, {', '.join(ACTIVITY_COLUMNS)}) \
+            SELECT rowid, {', '.join(ACTIVITY_COLUMNS)} FROM user_online_activity_objects ORDER BY rowid;")
+        cursor.execute("DROP TABLE user_online_activity_objects;")
+        cursor.execute("ALTER TABLE user_online_activity_objects_new RENAME TO user_online_activity_objects;")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_user_started_idx ON user_online_activity_objects (tracked_user, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_game_started_idx ON user_online_activity_objects (game_id, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_started_idx ON user_online_activity_objects (started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_ended_idx ON user_online_activity_objects (ended_playing_timestamp);")
+
+    # sqlite3 caches compiled statements per connection by query text, so bound parameters are enough for reuse
+    def format_query(self, query):
+        return query.replace("%s", "?")
+
+    # sqlite has no arrays, values are passed as one json parameter
+    def in_array(self, column):
+        return f"{column} IN (SELECT value FROM json_each(%s))"
+
+    def array_param(self, values):
+        return json.dumps([int(x) for x in values])
 
 
 class PostgreSQLManager(DBManager):
-    def __init__(self, user, password, host, port, db_name):
+    partition_prefix = "user_online_activity_objects_p"  # + YYYYMM
+
+    def __init__(self, user, password, host, port, db_name, pool_min_size=1, pool_max_size=10, pool_timeout=10, partitioning=None):
+        super().__init__()
+        self.partitioning = partitioning or PartitioningSettings()
+        self.known_partitions = set()  # YYYYMM of existing partitions
+        self.partitions_lock = threading.Lock()  # known_partitions is used by ingest writer and maintenance threads
         self.user = user
         self.password = password
         self.host = host
@@ -240,14 +805,178 @@ class PostgreSQLManager(DBManager):
             "port": self.port,
             "dbname": self.db_name
         }
+        self.connection_pool = ConnectionPool(self.db_module, self.connection_dict, pool_min_size, pool_max_size, pool_timeout)
 
         self.set_up()
 
+    # prepared statement name is derived from query text, so every query shape is prepared once per connection
+    def execute(self, cursor, query, params=(), prepare=False):
+        if not prepare:
+            return cursor.execute(query, params or None)
+
+        statement_name = "gtinfo_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+        prepared_statements = self.connection_pool.get_connection_state(cursor.connection).setdefault("prepared_statements", set())
+        if statement_name not in prepared_statements:
+            cursor.execute(f"PREPARE {statement_name} AS {numbered_placeholders(query).rstrip(';')};")
+            prepared_statements.add(statement_name)
+        if params:
+            cursor.execute(f"EXECUTE {statement_name} ({', '.join(['%s'] * len(params))});", params)
+        else:
+            cursor.execute(f"EXECUTE {statement_name};")
+
+    # multi-row INSERT ... VALUES (...), (...), page_size rows per statement
+    def insert_rows(self, cursor, query_head, rows, query_tail=""):
+        psycopg2.extras.execute_values(cursor, f"{query_head} VALUES %s {query_tail};", rows, page_size=1000)
+
+    def in_array(self, column):
+        return f"{column} = ANY(%s)"
+
+    def array_param(self, values):
+        return [int(x) for x in values]
+
+    # named cursor is server-side, rows are transferred by itersize
+    def streaming_cursor(self, conn, chunk_size):
+        cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_size
+        return cursor
+
+    def migration_add_insertion_id(self, cursor):
+        cursor.execute(f"ALTER TABLE user_online_activity_objects ADD COLUMN IF NOT EXISTS {self.insertion_id_column} BIGSERIAL;")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS user_online_activity_objects_id_idx ON user_online_activity_objects ({self.insertion_id_column});")
+
+    # ids are taken from sequence before commit, so transactions may become visible out of id order
+    # share lock waits for running inserts, after it no row with id <= max id can appear
+    def get_insertion_id_bound(self, cursor):
+        cursor.execute("LOCK TABLE user_online_activity_objects IN SHARE MODE;")
+        bound = super().get_insertion_id_bound(cursor)
+        cursor.connection.commit()
+        return bound
+
+    # COPY can't create missing partitions, so partitioned table is loaded by batched inserts
+    def load_backup_file(self, file, cursor):
+        if self.partitioning.enabled:
+            return super().load_backup_file(file, cursor)
+        cursor.copy_expert(f"COPY user_online_activity_objects {ACTIVITY_COLUMNS_STR} FROM STDIN WITH CSV HEADER", file)
+        return cursor.rowcount
+
+    def migrate(self, cursor):
+        super().migrate(cursor)
+        if self.partitioning.enabled:
+            self.set_up_partitioning(cursor)
+
+    def create_activity_indexes(self, cursor):
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_user_started_idx ON user_online_activity_objects (tracked_user, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_game_started_idx ON user_online_activity_objects (game_id, started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_started_idx ON user_online_activity_objects (started_playing_timestamp);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_online_activity_objects_ended_idx ON user_online_activity_objects (ended_playing_timestamp);")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS user_online_activity_objects_id_idx ON user_online_activity_objects ({self.insertion_id_column});")
+
+    # user_online_activity_objects becomes range-partitioned by month of started_playing_timestamp
+    # existing heap table is converted once, its rows are copied and its id sequence is kept
+    def set_up_partitioning(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'user_online_activity_objects'::regclass;")
+        if cursor.fetchone() is None:
+            print("Converting user_online_activity_objects to monthly partitions")
+            cursor.execute("ALTER TABLE user_online_activity_objects RENAME TO user_online_activity_objects_heap;")
+            cursor.execute("CREATE TABLE user_online_activity_objects (LIKE user_online_activity_objects_heap INCLUDING DEFAULTS) \
+                PARTITION BY RANGE (started_playing_timestamp);")
+            with self.partitions_lock:
+                self.known_partitions = set()
+            cursor.execute("SELECT MIN(started_playing_timestamp), MAX(started_playing_timestamp) FROM user_online_activity_objects_heap;")
+            min_started, max_started = cursor.fetchone()
+            if min_started is not None:
+                self.create_partitions(cursor, min_started, max_started)
+            cursor.execute("INSERT INTO user_online_activity_objects SELECT * FROM user_online_activity_objects_heap;")
+            cursor.execute(f"SELECT pg_get_serial_sequence('user_online_activity_objects_heap', '{self.insertion_id_column}');")
+            if sequence := cursor.fetchone()[0]:
+                cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY user_online_activity_objects.{self.insertion_id_column};")
+            cursor.execute("DROP TABLE user_online_activity_objects_heap;")
+            self.create_activity_indexes(cursor)
+
+        partition_months = self.get_partition_months(cursor)
+        with self.partitions_lock:
+            self.known_partitions = partition_months
+        self.create_upcoming_partitions(cursor)
+
+    def get_partition_months(self, cursor):
+        cursor.execute("SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid \
+            WHERE pg_inherits.inhparent = 'user_online_activity_objects'::regclass;")
+        return {row[0][len(self.partition_prefix):] for row in cursor.fetchall() if row[0].startswith(self.partition_prefix)}
+
+    # creates missing partitions for months from start_timestamp to end_timestamp inclusive
+    # lock is not held while statements run, so a thread waiting for table lock in postgres doesn't block others here
+    def create_partitions(self, cursor, start_timestamp, end_timestamp):
+        months = []
+        month = month_start(start_timestamp)
+        last_month = month_start(end_timestamp)
+        while month <= last_month:
+            months.append(month)
+            month = add_months(month, 1)
+        with self.partitions_lock:
+            missing_months = [month for month in months if month.strftime("%Y%m") not in self.known_partitions]
+
+        for month in missing_months:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.partition_prefix}{month.strftime('%Y%m')} PARTITION OF user_online_activity_objects \
+                FOR VALUES FROM ({utc_timestamp(month)}) TO ({utc_timestamp(add_months(month, 1))});")
+        with self.partitions_lock:
+            self.known_partitions.update(month.strftime("%Y%m") for month in missing_months)
+
+    def create_upcoming_partitions(self, cursor):
+        now = dt.datetime.utcnow()
+        self.create_partitions(cursor, utc_timestamp(now), utc_timestamp(add_months(month_start(utc_timestamp(now)), self.partitioning.premake_months)))
+
+    # sessions from late backfills or backups may start in months without partition
+    def prepare_activity_rows(self, rows, cursor):
+        if self.partitioning.enabled and rows:
+            started_timestamps = [row[2] for row in rows]
+            self.create_partitions(cursor, min(started_timestamps), max(started_timestamps))
+
+    # creates upcoming partitions and retires ones older than retention_months
+    # daily rollup is kept, so all-time leaderboards still count retired sessions
     @with_cursor
-    def create_backup_csv(self, cursor):
-        s = "SELECT * FROM user_online_activity_objects"
-        query = f"COPY ({s}) TO STDOUT WITH CSV HEADER"
-        save_path = "" + f"{dt.datetime.utcnow().timestamp()}.csv"
+    def maintain_partitions(self, cursor):
+        if not self.partitioning.enabled:
+            return []
+        self.create_upcoming_partitions(cursor)
+        if not self.partitioning.retention_months:
+            return []
 
-        with open(save_path, 'w') as file:
-            cursor.copy_expert(query, file)
+        actions = []
+        oldest_kept_month = add_months(dt.datetime.utcnow(), -self.partitioning.retention_months).strftime("%Y%m")
+        with self.partitions_lock:
+            month_keys = sorted(self.known_partitions)
+        for month_key in month_keys:
+            if month_key >= oldest_kept_month:
+                break
+            partition = f"{self.partition_prefix}{month_key}"
+            if self.partitioning.retention_action == "drop":
+                cursor.execute(f"DROP TABLE {partition};")
+            elif self.partitioning.retention_action == "archive":
+                self.archive_partition(cursor, partition)
+                cursor.execute(f"DROP TABLE {partition};")
+            else:
+                # renamed, so a late session for that month gets a new partition instead of name clash
+                # detach time is in the name, the same month may be detached again after late sessions
+                cursor.execute(f"ALTER TABLE user_online_activity_objects DETACH PARTITION {partition};")
+                cursor.execute(f"ALTER TABLE {partition} RENAME TO {self.get_detached_name(cursor, month_key)};")
+            cursor.connection.commit()
+            with self.partitions_lock:
+                self.known_partitions.discard(month_key)
+            actions.append(f"{self.partitioning.retention_action} {partition}")
+        return actions
+
+    def get_detached_name(self, cursor, month_key):
+        name = detached_name = f"user_online_activity_objects_detached_{month_key}_{int(dt.datetime.utcnow().timestamp())}"
+        for number in itertools.count(1):
+            cursor.execute("SELECT to_regclass(%s);", (detached_name,))
+            if cursor.fetchone()[0] is None:
+                return detached_name
+            detached_name = f"{name}_{number}"
+
+    def archive_partition(self, cursor, partition):
+        os.makedirs(self.partitioning.archive_dir, exist_ok=True)
+        path = os.path.join(self.partitioning.archive_dir, f"{partition}.csv.gz")
+        if os.path.exists(path):  # month was archived before and got late sessions since
+            path = os.path.join(self.partitioning.archive_dir, f"{partition}_{int(dt.datetime.utcnow().timestamp())}.csv.gz")
+        with open_backup_file(path, "w") as file:
+            cursor.copy_expert(f"COPY (SELECT {', '.join(ACTIVITY_COLUMNS)} FROM {partition} ORDER BY {self.insertion_id_column}) TO STDOUT WITH CSV HEADER", file)
@@ -1,26 +1,56 @@
 import socket
-import json
 import requests
 from binary_functions import *
 import threading
 from notifiers import SenderToTelegramNotifier
+from result_cache import ResultCache
+from ingest_queue import IngestQueue
+from db_managers import is_valid_activity_object
+from metrics import metrics
+from user_set import VersionedUserSet
+from doer_registry import DoerRegistry
+from idle_connections import ClientConnection, IdleConnections
+from user_sync import UserSync
+from wire_codec import CODEC_JSON, decode_message, encode_message, read_request_codec
 import os
 from dataclasses import dataclass, asdict
 import datetime as dt
 from time import sleep
 from gtinfo_requests import *
 import re
+import struct
+from time import monotonic
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 
 @dataclass
 class LastRunTimestamps:
     users_retrieval: int
+    maintenance: int = 0
+    metrics_dump: int = 0
 
 
 @dataclass
 class DBServerSettings:
     users_retrieval_freq: int
+    maintenance_freq: int = 3600  # seconds between db maintenance runs (partitions)
+    metrics_file: str = ""  # prometheus text file, not written if empty
+    metrics_dump_freq: int = 15  # seconds
+    max_in_flight: int = 16  # requests served in parallel, idle persistent connections don't take slots
+    read_timeout: int = 10  # seconds to wait for the rest of started client request
+    idle_timeout: int = 60  # seconds to keep persistent connection open between requests
+    doer_heartbeat_timeout: int = 60  # seconds without users delta request after which doer worker is dropped
+    cache_size: int = 1024  # cached read request results
+    cache_ttl: int = 300  # seconds
+    ingest_queue_size: int = 100000  # activity objects waiting for db, doer gets "busy" above it
+    ingest_batch_size: int = 1000
+    ingest_flush_interval: int = 1  # seconds
+    ingest_dead_letter_path: str = "data/ingest_dead_letter.jsonl"  # activity objects that couldn't be written
+    notifier_outbox_path: str = "data/telegram_outbox.jsonl"
+    notifier_outbox_max_size: int = 64 * 1024 * 1024  # bytes of notifications outbox file
+    backup_dir: str = "backups"
+    backup_compression: str = "gz"  # gz or zst
 
 
 @dataclass
@@ -32,43 +62,88 @@ class DoerSettings:
 
 class DBServer:
     def __init__(self, bind_address, website_url, db_manager, telegram_notifier_address=None):
-        self.basic_users_ids = []
-        self.premium_users_ids = []
-
-        self.new_basic_users_ids = []
-        self.new_premium_users_ids = []
+        self.user_set = VersionedUserSet()
 
         self.db_manager = db_manager
         self.request_servant = RequestServant(self)
 
         self.BIND_ADDRESS = bind_address
         self.server_socket = None
+        self.idle_connections = None
 
         self.WEBSITE_URL = website_url
         self.SUPERUSER_USER = os.environ.get("SUPERUSER_USER")
         self.SUPERUSER_PASSWORD = os.environ.get("SUPERUSER_PASSWORD")
         self.superuser_auth = requests.auth.HTTPBasicAuth(self.SUPERUSER_USER, self.SUPERUSER_PASSWORD)
+        self.user_sync = UserSync(self.WEBSITE_URL, self.user_set, self.superuser_auth)
+
+        self.settings = DBServerSettings(50)
+        self.settings.backup_dir = os.environ.get("BACKUP_DIR") or self.settings.backup_dir
+        self.settings.backup_compression = os.environ.get("BACKUP_COMPRESSION") or self.settings.backup_compression
+        self.settings.notifier_outbox_path = os.environ.get("NOTIFIER_OUTBOX_PATH") or self.settings.notifier_outbox_path
+        self.settings.ingest_dead_letter_path = os.environ.get("INGEST_DEAD_LETTER_PATH") or self.settings.ingest_dead_letter_path
+        self.settings.metrics_file = os.environ.get("METRICS_FILE") or self.settings.metrics_file
 
         self.sender_to_telegram_notifier = None
         if telegram_notifier_address is not None:
-            self.sender_to_telegram_notifier = SenderToTelegramNotifier(telegram_notifier_address)
+            self.sender_to_telegram_notifier = SenderToTelegramNotifier(
+                telegram_notifier_address,
+                self.settings.notifier_outbox_path,
+                self.settings.notifier_outbox_max_size
+            )
 
-        self.settings = DBServerSettings(50)
         self.doer_settings = DoerSettings(10, 5, 15)
+        # doer sends heartbeat every update_freq seconds, worker isn't dropped before it missed several of them
+        self.doer_registry = DoerRegistry(self.user_set, max(self.settings.doer_heartbeat_timeout, 4 * self.doer_settings.update_freq))
+        self.doer_users_versions = {}  # { worker_id: user set version } last sent by doer_users(_if_changed), None for doers without id
+        self.result_cache = ResultCache(self.settings.cache_size, self.settings.cache_ttl)
+        self.ingest_queue = IngestQueue(
+            self.write_user_online_activity_objects,
+            self.settings.ingest_queue_size,
+            self.settings.ingest_batch_size,
+            self.settings.ingest_flush_interval,
+            dead_letter_path=self.settings.ingest_dead_letter_path,
+            health_function=self.is_db_healthy
+        )
         self.last_runs = LastRunTimestamps(0)
 
-        self.users_changed = True
         self.is_working = True
 
-        self.retrieve_users()
+    @property
+    def basic_users_ids(self):
+        return self.user_set.get_user_ids("basic")
+
+    @property
+    def premium_users_ids(self):
+        return self.user_set.get_user_ids("premium")
 
     # send data about user online activity objects to telegram address
     def send_notification(self, data):
         if self.sender_to_telegram_notifier is not None:
             self.sender_to_telegram_notifier.send_data(data)
 
+    # ingest queue writer, notifications are sent only for committed objects
+    def write_user_online_activity_objects(self, user_online_activity_objects):
+        db_manager_response = self.db_manager.add_user_online_activity_objects(user_online_activity_objects)
+        response_code, response_data = read_request(db_manager_response)
+        if response_code != DBManagerResponseTypes.ok:
+            metrics.inc("ingest_failed_batches_total")
+            return False
+        metrics.inc("ingest_rows_total", len(user_online_activity_objects))
+        metrics.add_rate("ingest_rows", len(user_online_activity_objects))
+        self.result_cache.invalidate(user_online_activity_objects)
+        self.send_notification(user_online_activity_objects)
+        return True
+
+    def is_db_healthy(self):
+        response_code, response_data = read_request(self.db_manager.check_health())
+        return response_code == DBManagerResponseTypes.ok
+
     def start(self):
         print("DB server starting...")
+        self.ingest_queue.start()
+        if self.sender_to_telegram_notifier is not None:
+            self.sender_to_telegram_notifier.start()
 
         (socket_thread := threading.Thread(target=self.start_socket)).start()
         (users_update_thread := threading.Thread(target=self.start_users_update)).start()
@@ -78,35 +153,219 @@ class DBServer:
         console_thread.join()
         users_update_thread.join()
 
+        # socket is closed and handlers are finished, so nothing is added to queue anymore
+        self.ingest_queue.stop()
+        self.user_sync.close()
+        if self.sender_to_telegram_notifier is not None:
+            self.sender_to_telegram_notifier.stop()
+
     def start_users_update(self):
         print("Data collection active")
         while self.is_working:
             current_timestamp = dt.datetime.utcnow().timestamp()
             if self.last_runs.users_retrieval + self.settings.users_retrieval_freq <= current_timestamp:
                 self.last_runs.users_retrieval = current_timestamp
-                self.retrieve_users_new()
+                self.retrieve_users()
+            if self.last_runs.maintenance + self.settings.maintenance_freq <= current_timestamp:
+                self.last_runs.maintenance = current_timestamp
+                self.run_maintenance()
+            if self.settings.metrics_file and self.last_runs.metrics_dump + self.settings.metrics_dump_freq <= current_timestamp:
+                self.last_runs.metrics_dump = current_timestamp
+                self.dump_metrics()
+            self.doer_registry.expire()
             sleep(1)
         print("Users update stopped")
 
+    # current values of pools, queues and caches
+    def collect_gauges(self):
+        gauges = {}
+        for name, stats in (("db_pool", self.db_manager.get_pool_stats()), ("cache", self.result_cache.get_stats()), ("ingest", self.ingest_queue.get_stats())):
+            for key, value in stats.items():
+                gauges[f"{name}_{key}"] = value
+        if self.sender_to_telegram_notifier is not None:
+            gauges["notifier_outbox_pending_bytes"] = self.sender_to_telegram_notifier.outbox.get_pending_size()
+        gauges["users_version"] = self.user_set.version
+        gauges["users_count"] = len(self.user_set.users)
+        gauges["doer_workers"] = len(self.doer_registry.workers)
+        if self.idle_connections is not None:
+            gauges["idle_connections"] = self.idle_connections.count
+        return gauges
+
+    def get_metrics(self):
+        return {**metrics.get_stats(), "gauges": self.collect_gauges()}
+
+    def dump_metrics(self):
+        try:
+            metrics.dump_prometheus(self.settings.metrics_file, self.collect_gauges())
+        except OSError as ex:
+            print(f"Failed to dump metrics: {ex}")
+
+    def run_maintenance(self):
+        response_code, response_data = read_request(self.db_manager.maintain_partitions())
+        if response_code != DBManagerResponseTypes.ok:
+            print("Partitions maintenance failed")
+        for action in response_data or []:
+            print(f"Partitions maintenance: {action}")
+
     def start_socket(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind(self.BIND_ADDRESS)
         self.server_socket.listen()
+        self.idle_connections = IdleConnections(self.settings.idle_timeout)
+        self.idle_connections.add_listener(self.server_socket)
+
+        # accepted and idle connections wait in selector, worker slot is taken only when request arrives
+        # accept loop waits for a free worker, so requests of other clients stay in socket buffers
+        in_flight = threading.BoundedSemaphore(self.settings.max_in_flight)
+        with ThreadPoolExecutor(max_workers=self.settings.max_in_flight, thread_name_prefix="connection") as executor:
+            print('Socket active')
+            while self.is_working:
+                is_accept_ready, ready_clients = self.idle_connections.wait(1)
+                if is_accept_ready and self.is_working:
+                    try:
+                        connection, address = self.server_socket.accept()
+                        self.idle_connections.add(ClientConnection(connection, CODEC_JSON))
+                    except OSError as ex:
+                        if self.is_working:
+                            print(f"Error: {ex}")
+                for client in ready_clients:
+                    if self.wait_for_worker(in_flight):
+                        executor.submit(self.handle_connection, client, in_flight)
+                    else:
+                        client.sock.close()
+            self.idle_connections.close_all()
+        print("Socket stopped")
 
-        print('Socket active')
+    # waiting is done in steps, so stop is noticed even when every worker is busy
+    def wait_for_worker(self, in_flight):
         while self.is_working:
-            connection, address = self.server_socket.accept()
-            request_raw = recv_msg(connection)
+            if in_flight.acquire(timeout=1):
+                return True
+        return False
+
+    # serves requests of the client while they keep coming, then gives connection back to idle ones,
+    # so one connection may carry many requests without holding a worker between them
+    # one-shot clients send single untagged request and close
+    # responses are json until client asks for binary codec, then codec is kept for the connection
+    # every request is timed by stages: read, decode, serve (db is part of it), encode, write
+    def handle_connection(self, client, in_flight):
+        connection = client.sock
+        is_kept = False
+        try:
+            while True:
+                connection.settimeout(self.settings.read_timeout)
+                if (request := self.recv_request(connection)) is None:
+                    break
+                request_raw, read_time = request
+                start_time = monotonic()
+                try:
+                    request_dict = decode_message(request_raw)
+                    request_type, request_data = read_request(request_dict)
+                    client.codec = read_request_codec(request_dict, client.codec)
+                except (ValueError, TypeError, AttributeError):
+                    print(f"Incorrect request: {request_raw}")
+                    metrics.inc("incorrect_requests_total")
+                    break
+                decode_time = monotonic() - start_time
+
+                request_id = read_request_id(request_dict)
+                request_name = self.request_servant.get_request_name(request_type)
+                metrics.reset_thread_db_time()
+                start_time = monotonic()
+                try:
+                    response = self.request_servant.serve_request(request_type, request_data)
+                except Exception as ex:
+                    print(f"Error: {ex}")
+                    response = make_request(GTInfoResponseTypes.error, 0)
+                serve_time = monotonic() - start_time
+                db_time = metrics.get_thread_db_time()
+
+                timings = {"encode": 0, "write": 0}
+                is_sent = self.send_response(connection, response, request_id, client.codec, timings)
+
+                metrics.inc("requests_total", type=request_name)
+                metrics.inc("responses_total", type=request_name, response=self.get_response_name(response))
+                stages = {"read": read_time, "decode": decode_time, "serve": serve_time, "db": db_time, **timings}
+                for stage, stage_time in stages.items():
+                    metrics.observe("request_stage_seconds", stage_time, type=request_name, stage=stage)
+                if not is_sent:
+                    break
+                # pipelined request already in buffer is served at once, else connection waits without worker
+                if not self.has_pending_data(connection):
+                    is_kept = True
+                    break
+        finally:
+            in_flight.release()
+            if is_kept:
+                self.idle_connections.put(client)
+            else:
+                connection.close()
+
+    @staticmethod
+    def has_pending_data(connection):
+        connection.setblocking(False)
+        try:
+            return bool(connection.recv(1, socket.MSG_PEEK))
+        except OSError:
+            return False
+
+    # returns (request bytes, seconds spent reading them) or None if connection is closed
+    # waiting for request to start (idle connection) is not counted as read time
+    @staticmethod
+    def recv_request(connection):
+        try:
+            if not (raw_msglen := recvall(connection, 4)):
+                return None
+            start_time = monotonic()
+            if (request_raw := recvall(connection, struct.unpack('>I', raw_msglen)[0])) is None:
+                return None
+            return request_raw, monotonic() - start_time
+        except (socket.timeout, ConnectionResetError):
+            return None
+
+    @staticmethod
+    def get_response_name(response):
+        if not isinstance(response, dict):
+            return "stream"
+        try:
+            return GTInfoResponseTypes(response["type"]).name
+        except (KeyError, ValueError):
+            return "unknown"
+
+    # streamed response is a generator of frames, it is closed if sending stops early
+    # returns False if connection is broken
+    def send_response(self, connection, response, request_id, codec=CODEC_JSON, timings=None):
+        is_streamed = not isinstance(response, dict)
+        frames = response if is_streamed else [response]
+        try:
+            for frame in frames:
+                self.send_frame(connection, frame, request_id, codec, timings)
+        except OSError as ex:
+            print(f"Connection error: {ex}")
+            return False
+        except Exception as ex:
+            print(f"Error: {ex}")
+            error_frame = make_stream_frame(GTInfoResponseTypes.error, 0, False) if is_streamed else make_request(GTInfoResponseTypes.error, 0)
             try:
-                request_dict = json.loads(request_raw)
-                resp_dict = self.request_servant.serve_request(*read_request(request_dict))
-                send_msg(connection, json.dumps(resp_dict))
-            except (ValueError, TypeError):
-                print(f"Incorrect request: {request_raw}")
-            except Exception as ex:
-                print(f"Error: {ex}")
-            connection.close()
-        print("Socket stopped")
+                self.send_frame(connection, error_frame, request_id, codec, timings)
+            except OSError:
+                return False
+        finally:
+            if is_streamed:
+                response.close()
+        return True
+
+    @staticmethod
+    def send_frame(connection, frame, request_id, codec=CODEC_JSON, timings=None):
+        if request_id is not None:
+            frame = tag_request(frame, request_id)
+        start_time = monotonic()
+        message = encode_message(frame, codec)
+        encoded_time = monotonic()
+        send_msg(connection, message)
+        if timings is not None:
+            timings["encode"] += encoded_time - start_time
+            timings["write"] += monotonic() - encoded_time
 
     def stop_socket(self):
         socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(self.BIND_ADDRESS)
@@ -120,88 +379,66 @@ class DBServer:
                 print("Stopping execution...")
                 self.is_working = False
                 self.stop_socket()
-            elif re.match(r'backup', command):
-                self.db_manager.create_backup_csv()
-                print("csv backup created")
+            elif res := re.match(r'stats( dump)?', command):
+                if res.group(1):
+                    self.dump_metrics() if self.settings.metrics_file else print("METRICS_FILE is not set")
+                else:
+                    self.print_stats()
+            elif re.match(r'pool', command):
+                print(self.db_manager.get_pool_stats())
+            elif re.match(r'cache', command):
+                print(self.result_cache.get_stats())
+            elif re.match(r'ingest replay', command):
+                print(f"{self.ingest_queue.replay_dead_letter()} activity objects from {self.settings.ingest_dead_letter_path} queued again")
+            elif re.match(r'ingest', command):
+                print(self.ingest_queue.get_stats())
+            elif re.match(r'doers', command):
+                for worker_id, worker_stats in self.doer_registry.get_stats().items():
+                    print(f"  {worker_id}: " + " ".join(f"{key}={value}" for key, value in worker_stats.items()))
+            elif re.match(r'partitions', command):
+                self.run_maintenance()
+                print("partitions maintenance done")
+            elif re.match(r'rebuildrollup', command):
+                self.db_manager.rebuild_daily_rollup()
+                self.result_cache.clear()
+                print("daily rollup rebuilt")
+            elif res := re.match(r'backup( full)?', command):
+                response_code, response_data = read_request(self.db_manager.create_backup_csv(
+                    self.settings.backup_dir, self.settings.backup_compression, res.group(1) is not None
+                ))
+                if response_code != DBManagerResponseTypes.ok:
+                    print("backup failed")
+                elif response_data["file"] is None:
+                    print("no new rows since last backup")
+                else:
+                    print(f"{response_data['kind']} csv backup created: {response_data['file']} ({response_data['rows']} rows)")
+            elif res := re.match(r'restore ?(.*)', command):
+                backup_dir = res.group(1).strip() or self.settings.backup_dir
+                response_code, response_data = read_request(self.db_manager.restore_backup(backup_dir))
+                if response_code != DBManagerResponseTypes.ok:
+                    print("restore failed")
+                else:
+                    self.result_cache.clear()
+                    print(f"restored {response_data['rows']} rows from {response_data['files']} files, run \"backup full\" to start new chain")
             elif res := re.match(r'addtrackeduser (\d*) (basic|premium)', command):
                 userid, premiumness = res.groups()
                 userid = int(userid)
-                if premiumness == "basic":
-                    self.basic_users_ids.append(userid)
-                else:
-                    self.premium_users_ids.append(userid)
-                self.users_changed = True
+                self.user_set.add(userid, premiumness)
                 print(f"Added user {userid} ({premiumness})")
 
-    def retrieve_users_new(self):
-        self.new_basic_users_ids = []
-        self.new_premium_users_ids = []
-
-        try:
-            resp = requests.get(f"{self.WEBSITE_URL}/tracked_users")
-        except Exception as ex:
-            print(f"Warning! Failed to connect to {self.WEBSITE_URL} ({ex})")
-            return
-
-        try:
-            resp = json.loads(resp.text)
-        except (ValueError, TypeError) as ex:
-            print(f"Failed to retrieve users: {ex}")
-            return
-
-        for el in resp["users"]:
-            self.new_premium_users_ids.append(int(el))
-
-        if self.new_basic_users_ids != self.basic_users_ids or self.new_premium_users_ids != self.premium_users_ids:
-            self.users_changed = True
-            print(f"Users from {self.WEBSITE_URL}: {self.new_basic_users_ids}, {self.new_premium_users_ids}")
-
-        self.basic_users_ids = self.new_basic_users_ids
-        self.premium_users_ids = self.new_premium_users_ids
-
+    def print_stats(self):
+        stats = self.get_metrics()
+        for section in ("counters", "rates", "gauges"):
+            print(f"{section}:")
+            for name, value in stats[section].items():
+                print(f"  {name} {value}")
+        print("histograms:")
+        for name, histogram_stats in stats["histograms"].items():
+            print(f"  {name} " + " ".join(f"{key}={value}" for key, value in histogram_stats.items()))
+
+    # users are retrieved in background loop, so server starts without waiting for website
     def retrieve_users(self):
-        self.new_basic_users_ids = []
-        self.new_premium_users_ids = []
-
-        if not (resp := self.retrieve_users_page(f"{self.WEBSITE_URL}/tracked_users")):
-            return
-
-        while resp["next"]:
-            if not (resp := self.retrieve_users_page(resp["next"])):
-                return
-
-        if self.new_basic_users_ids != self.basic_users_ids or self.new_premium_users_ids != self.premium_users_ids:
-            self.users_changed = True
-
-        print(f"Users from {self.WEBSITE_URL}: {self.new_basic_users_ids}, {self.new_premium_users_ids}")
-
-        self.basic_users_ids = self.new_basic_users_ids
-        self.premium_users_ids = self.new_premium_users_ids
-
-    def retrieve_users_page(self, url):
-        try:
-            resp = requests.get(url, auth=self.superuser_auth)
-        except Exception as ex:
-            print(f"Warning! Failed to connect to {self.WEBSITE_URL} ({ex})")
-            return
-
-        try:
-            resp = json.loads(resp.text)
-        except (ValueError, TypeError) as ex:
-            print(f"Failed to retrieve users: {ex}")
-            return
-
-        if resp.get("count", -1) == -1:
-            print(f"Warning! Failed to get tracked users from {self.WEBSITE_URL}")
-            return
-
-        for el in resp["results"]:
-            if el["is_premium"]:
-                self.new_premium_users_ids.append(el["steam_id"])
-            else:
-                self.new_basic_users_ids.append(el["steam_id"])
-
-        return resp
+        self.user_sync.sync()
 
 
 class RequestServant:
@@ -210,6 +447,8 @@ class RequestServant:
         self.request_servants = {
             GTInfoRequestTypes.doer_users: self.serve_doer_users,
             GTInfoRequestTypes.doer_users_if_changed: self.serve_doer_users_if_changed,
+            GTInfoRequestTypes.doer_users_delta: self.serve_doer_users_delta,
+            GTInfoRequestTypes.doer_unregister: self.serve_doer_unregister,
             GTInfoRequestTypes.doer_settings: self.serve_doer_settings,
             GTInfoRequestTypes.doer_new_user_online_activity_object: self.serve_doer_new_user_online_activity_object,
             GTInfoRequestTypes.web_user_online_activity_objects: self.web_user_online_activity_objects,
@@ -217,78 +456,157 @@ class RequestServant:
             GTInfoRequestTypes.web_games_with_data: self.web_games_with_data,
             GTInfoRequestTypes.most_played_users: self.most_played_users,
             GTInfoRequestTypes.most_played_games: self.most_played_games,
+            GTInfoRequestTypes.metrics: self.serve_metrics,
         }
 
+    @staticmethod
+    def get_request_name(request_type):
+        try:
+            return GTInfoRequestTypes(request_type).name
+        except ValueError:
+            return "unknown"
+
     def serve_request(self, request_type, request_data):
         if servant := self.request_servants.get(request_type, None):
             return servant(request_data)
 
         return make_request(GTInfoResponseTypes.no_such_command, 0)
 
+    @staticmethod
+    def read_worker_id(request_data):
+        return request_data.get("worker_id", None) if isinstance(request_data, dict) else None
+
+    # full lists, ["worker_id": "..."] keeps track of what was sent to each doer separately
     def serve_doer_users(self, request_data):
         data = {
             "basic_user_ids": self.db_server.basic_users_ids,
             "premium_user_ids": self.db_server.premium_users_ids
         }
-        self.db_server.users_changed = False
+        self.db_server.doer_users_versions[self.read_worker_id(request_data)] = self.db_server.user_set.version
         return make_request(GTInfoResponseTypes.ok, data)
 
     def serve_doer_users_if_changed(self, request_data):
-        data = {"changed": self.db_server.users_changed}
-        if self.db_server.users_changed:
+        worker_id = self.read_worker_id(request_data)
+        version = self.db_server.user_set.version
+        data = {"changed": self.db_server.doer_users_versions.get(worker_id, None) != version}
+        if data["changed"]:
             data["basic_user_ids"] = self.db_server.basic_users_ids
             data["premium_user_ids"] = self.db_server.premium_users_ids
-            self.db_server.users_changed = False
+            self.db_server.doer_users_versions[worker_id] = version
         return make_request(GTInfoResponseTypes.ok, data)
 
+    # ["epoch": "...", "version": 1] of the last applied user set, anything else for snapshot
+    # with ["worker_id": "..."] doer is registered (request is its heartbeat) and gets delta of its shard only
+    def serve_doer_users_delta(self, request_data):
+        user_set = self.db_server.user_set
+        if not isinstance(request_data, dict):
+            return make_request(GTInfoResponseTypes.ok, user_set.get_snapshot())
+        epoch, version = request_data.get("epoch", None), request_data.get("version", -1)
+        if (worker_id := request_data.get("worker_id", None)) is not None:
+            return make_request(GTInfoResponseTypes.ok, self.db_server.doer_registry.get_shard_delta(str(worker_id), epoch, version))
+        return make_request(GTInfoResponseTypes.ok, user_set.get_delta_or_snapshot(epoch, version))
+
+    # ["worker_id": "..."], stopping doer hands its shard over without waiting for heartbeat timeout
+    def serve_doer_unregister(self, request_data):
+        if (worker_id := self.read_worker_id(request_data)) is None:
+            return make_request(GTInfoResponseTypes.error, 0)
+        self.db_server.doer_registry.unregister(str(worker_id))
+        return make_request(GTInfoResponseTypes.ok, 0)
+
+    def serve_metrics(self, request_data):
+        return make_request(GTInfoResponseTypes.ok, self.db_server.get_metrics())
+
     def serve_doer_settings(self, request_data):
         settings = self.db_server.doer_settings
         return make_request(GTInfoResponseTypes.ok, asdict(settings))
 
+    # ["user_online_activity_objects": [...], "idempotency_key": "..."], request with known key is not applied again
+    # objects are checked before they are queued, request with malformed ones is answered with error and their indexes
     def serve_doer_new_user_online_activity_object(self, request_data):
         user_online_activity_objects = request_data["user_online_activity_objects"]
-        self.db_server.send_notification(user_online_activity_objects)
         print(user_online_activity_objects)
-        for user_online_activity_object in user_online_activity_objects:
-            db_manager_response = self.db_server.db_manager.add_user_online_activity_object(user_online_activity_object)
-            response_code, response_data = read_request(db_manager_response)
-            if response_code != DBManagerResponseTypes.ok:
-                return make_request(GTInfoResponseTypes.error, 0)
+        if invalid_indexes := [i for i, el in enumerate(user_online_activity_objects) if not is_valid_activity_object(el)]:
+            print(f"Incorrect activity objects: {[user_online_activity_objects[i] for i in invalid_indexes]}")
+            metrics.inc("ingest_invalid_rows_total", len(invalid_indexes))
+            return make_request(GTInfoResponseTypes.error, {"invalid": invalid_indexes})
+        # objects are written by ingest queue writer, doer keeps them and retries later if queue is full
+        if not self.db_server.ingest_queue.put(user_online_activity_objects, request_data.get("idempotency_key", None)):
+            return make_request(GTInfoResponseTypes.busy, 0)
         return make_request(GTInfoResponseTypes.ok, 0)
 
-    def web_user_online_activity_objects(self, request_data):
-        db_manager_response = self.db_server.db_manager.get_user_online_activity_objects(request_data)
+    # read-only requests are answered from result cache when possible
+    # affected_by builds function telling if new activity object changes cached response
+    def serve_cached(self, request_type, request_data, db_manager_function, affected_by):
+        result_cache = self.db_server.result_cache
+        key = result_cache.make_key(request_type, request_data)
+        found, response_data = result_cache.get(key)
+        if found:
+            return make_request(GTInfoResponseTypes.ok, response_data)
+
+        generation = result_cache.generation
+        db_manager_response = db_manager_function(request_data)
         response_code, response_data = read_request(db_manager_response)
         if response_code != DBManagerResponseTypes.ok:
             return make_request(GTInfoResponseTypes.error, 0)
+        result_cache.put(key, response_data, affected_by(request_data, response_data), generation)
         return make_request(GTInfoResponseTypes.ok, response_data)
 
-    def most_played_users(self, request_data):
-        # ["start_timestamp": 1, "end_timestamp": 2, "tracked_users": [1, 2, 3], "limit": 10]
-        db_manager_response = self.db_server.db_manager.get_most_played_users(request_data)
+    # new session changes leaderboard if it matches request filters
+    @staticmethod
+    def window_affected_by(request_data, response_data):
+        start_timestamp = request_data.get("start_timestamp", None)
+        end_timestamp = request_data.get("end_timestamp", None)
+        tracked_users = request_data.get("tracked_users", None)
+        tracked_users = set(tracked_users) if tracked_users else None
+
+        def is_affected_by(el):
+            return (tracked_users is None or el["tracked_user"] in tracked_users) and \
+                   (not start_timestamp or el["started_playing_timestamp"] >= start_timestamp) and \
+                   (not end_timestamp or el["ended_playing_timestamp"] <= end_timestamp)
+        return is_affected_by
+
+    @staticmethod
+    def new_user_affected_by(request_data, response_data):
+        known_users = set(response_data)
+        return lambda el: el["tracked_user"] not in known_users
+
+    @staticmethod
+    def new_game_affected_by(request_data, response_data):
+        known_games = set(response_data)
+        return lambda el: el["game_id"] not in known_games
+
+    # ["start_timestamp": 1, "end_timestamp": 2, "tracked_users": [1, 2, 3], "game_ids": [1, 2],
+    #  "page_size": 1000, "page_token": "..."] or ["stream": True] to get rows as sequence of frames
+    def web_user_online_activity_objects(self, request_data):
+        if request_data.get("stream", False):
+            return self.stream_user_online_activity_objects(request_data)
+
+        db_manager_response = self.db_server.db_manager.get_user_online_activity_objects(request_data)
         response_code, response_data = read_request(db_manager_response)
         if response_code != DBManagerResponseTypes.ok:
             return make_request(GTInfoResponseTypes.error, 0)
         return make_request(GTInfoResponseTypes.ok, response_data)
 
+    def stream_user_online_activity_objects(self, request_data):
+        rows_chunks = self.db_server.db_manager.iter_user_online_activity_objects(request_data)
+        try:
+            for rows in rows_chunks:
+                yield make_stream_frame(GTInfoResponseTypes.ok, rows, True)
+        finally:
+            rows_chunks.close()
+        yield make_stream_frame(GTInfoResponseTypes.ok, [], False)
+
+    def most_played_users(self, request_data):
+        # ["start_timestamp": 1, "end_timestamp": 2, "tracked_users": [1, 2, 3], "limit": 10]
+        return self.serve_cached(GTInfoRequestTypes.most_played_users, request_data, self.db_server.db_manager.get_most_played_users, self.window_affected_by)
+
     def most_played_games(self, request_data):
         # ["start_timestamp": 1, "end_timestamp": 2, "tracked_users": [1, 2, 3], "limit": 10]
-        db_manager_response = self.db_server.db_manager.get_most_played_games(request_data)
-        response_code, response_data = read_request(db_manager_response)
-        if response_code != DBManagerResponseTypes.ok:
-            return make_request(GTInfoResponseTypes.error, 0)
-        return make_request(GTInfoResponseTypes.ok, response_data)
+        return self.serve_cached(GTInfoRequestTypes.most_played_games, request_data, self.db_server.db_manager.get_most_played_games, self.window_affected_by)
 
+    # ["active_since": 1] or anything else for all users/games
     def web_users_with_data(self, request_data):
-        db_manager_response = self.db_server.db_manager.get_users_with_data(request_data)
-        response_code, response_data = read_request(db_manager_response)
-        if response_code != DBManagerResponseTypes.ok:
-            return make_request(GTInfoResponseTypes.error, 0)
-        return make_request(GTInfoResponseTypes.ok, response_data)
+        return self.serve_cached(GTInfoRequestTypes.web_users_with_data, request_data, self.db_server.db_manager.get_users_with_data, self.new_user_affected_by)
 
     def web_games_with_data(self, request_data):
-        db_manager_response = self.db_server.db_manager.get_games_with_data(request_data)
-        response_code, response_data = read_request(db_manager_response)
-        if response_code != DBManagerResponseTypes.ok:
-            return make_request(GTInfoResponseTypes.error, 0)
-        return make_request(GTInfoResponseTypes.ok, response_data)
+        return self.serve_cached(GTInfoRequestTypes.web_games_with_data, request_data, self.db_server.db_manager.get_games_with_data, self.new_game_affected_by)
@@ -0,0 +1,127 @@
+import uuid
+import hashlib
+import threading
+from bisect import bisect
+from time import monotonic
+from user_set import USER_TIERS
+
+
+def stable_hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+
+
+# consistent hashing: worker owns users whose hash falls after its points on the ring,
+# so when a worker comes or goes only its share of users moves
+class HashRing:
+    def __init__(self, worker_ids, virtual_nodes=64):
+        self.points = sorted((stable_hash(f"{worker_id}#{i}"), worker_id) for worker_id in worker_ids for i in range(virtual_nodes))
+        self.hashes = [point_hash for point_hash, worker_id in self.points]
+
+    def get_worker(self, key):
+        if not self.points:
+            return None
+        return self.points[bisect(self.hashes, stable_hash(key)) % len(self.points)][1]
+
+
+class DoerWorker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.last_heartbeat = monotonic()
+        self.epoch = uuid.uuid4().hex  # new on every registration, doer with other epoch gets snapshot
+        self.version = 0
+        self.sent_users = {}  # { user_id: tier } of the last delta or snapshot sent to the worker
+
+
+# doer workers registered on db server, each polls only its shard of tracked users
+# worker that misses heartbeats (delta requests) for heartbeat_timeout is dropped and its users are rebalanced
+class DoerRegistry:
+    def __init__(self, user_set, heartbeat_timeout=60, virtual_nodes=64):
+        self.user_set = user_set
+        self.heartbeat_timeout = heartbeat_timeout
+        self.virtual_nodes = virtual_nodes
+        self.lock = threading.Lock()
+        self.workers = {}  # { worker_id: DoerWorker }
+        self.ring = HashRing([])
+        self.assignment_key = None  # (user set version, workers) assignment was made for
+        self.assignment = {}  # { worker_id: { user_id: tier } }
+
+    def rebuild_ring(self):
+        self.ring = HashRing(sorted(self.workers), self.virtual_nodes)
+
+    # returns True if worker is new
+    def register(self, worker_id):
+        with self.lock:
+            if worker_id in self.workers:
+                self.workers[worker_id].last_heartbeat = monotonic()
+                return False
+            self.workers[worker_id] = DoerWorker(worker_id)
+            self.rebuild_ring()
+        print(f"Doer worker {worker_id} registered, {len(self.workers)} workers")
+        return True
+
+    def unregister(self, worker_id):
+        with self.lock:
+            if self.workers.pop(worker_id, None) is None:
+                return False
+            self.rebuild_ring()
+        print(f"Doer worker {worker_id} unregistered, {len(self.workers)} workers")
+        return True
+
+    # returns ids of dropped workers
+    def expire(self):
+        now = monotonic()
+        with self.lock:
+            expired_worker_ids = [worker_id for worker_id, worker in self.workers.items() if now - worker.last_heartbeat > self.heartbeat_timeout]
+            for worker_id in expired_worker_ids:
+                del self.workers[worker_id]
+            if expired_worker_ids:
+                self.rebuild_ring()
+        for worker_id in expired_worker_ids:
+            print(f"Doer worker {worker_id} missed heartbeats and is dropped, {len(self.workers)} workers left")
+        return expired_worker_ids
+
+    def get_assignment(self):
+        key = (self.user_set.version, tuple(sorted(self.workers)))
+        if not self.workers:
+            return {}
+        if key != self.assignment_key:
+            assignment = {worker_id: {} for worker_id in self.workers}
+            with self.user_set.lock:
+                users = list(self.user_set.users.items())
+            for user_id, tier in users:
+                assignment[self.ring.get_worker(user_id)][user_id] = tier
+            self.assignment_key, self.assignment = key, assignment
+        return self.assignment
+
+    # same format as VersionedUserSet delta, but for the worker's shard and in worker's own versions
+    # delta is made against the last sent shard if worker has applied it, else snapshot is sent
+    def get_shard_delta(self, worker_id, epoch, version):
+        self.register(worker_id)
+        with self.lock:
+            worker = self.workers[worker_id]
+            worker.last_heartbeat = monotonic()
+            shard = self.get_assignment().get(worker_id, {})
+            is_snapshot = epoch != worker.epoch or version != worker.version
+            changes = {user_id: None for user_id in worker.sent_users.keys() - shard.keys()}
+            changes.update({user_id: tier for user_id, tier in shard.items() if worker.sent_users.get(user_id, None) != tier})
+            if changes or is_snapshot:
+                worker.version += 1
+            worker.sent_users = shard
+
+            delta = {"epoch": worker.epoch, "version": worker.version, "snapshot": is_snapshot}
+            if is_snapshot:
+                for tier in USER_TIERS:
+                    delta[f"{tier}_user_ids"] = sorted(user_id for user_id, user_tier in shard.items() if user_tier == tier)
+                return delta
+            delta["removed"] = [user_id for user_id, tier in changes.items() if tier is None]
+            delta["upserted"] = {tier: [user_id for user_id, user_tier in changes.items() if user_tier == tier] for tier in USER_TIERS}
+        return delta
+
+    def get_stats(self):
+        now = monotonic()
+        with self.lock:
+            shard_sizes = {worker_id: len(shard) for worker_id, shard in self.get_assignment().items()}
+            return {
+                worker_id: {"shard_size": shard_sizes.get(worker_id, 0), "last_heartbeat_ago": round(now - worker.last_heartbeat, 1), "version": worker.version}
+                for worker_id, worker in self.workers.items()
+            }
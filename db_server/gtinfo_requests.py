@@ -13,6 +13,9 @@ class GTInfoRequestTypes(int, Enum):
     most_played_users = auto()
     most_played_games = auto()
     incorrect = auto()
+    doer_users_delta = auto()
+    metrics = auto()
+    doer_unregister = auto()
 
 
 class GTInfoResponseTypes(int, Enum):
@@ -21,6 +24,7 @@ class GTInfoResponseTypes(int, Enum):
     no_connection = auto()
     no_such_command = auto()
     no_response = auto()
+    busy = auto()
 
 
 class DBManagerResponseTypes(int, Enum):
@@ -32,7 +36,33 @@ def make_request(request_type, data):
     return {"type": request_type, "data": data}
 
 
+# lost response of request that adds data doesn't tell if it was applied,
+# so client resends it only with idempotency key, server applies request with the same key once
+def is_safe_to_resend(request):
+    if request.get("type", None) == GTInfoRequestTypes.doer_new_user_online_activity_object:
+        return isinstance(request.get("data", None), dict) and request["data"].get("idempotency_key", None) is not None
+    return True
+
+
 def read_request(request):
     if "type" not in request.keys() or "data" not in request.keys():
         return GTInfoResponseTypes.incorrect, []
     return request["type"], request["data"]
+
+
+# requests on persistent connections carry an id, response is tagged with the same id
+def tag_request(request, request_id):
+    return {**request, "id": request_id}
+
+
+def read_request_id(request):
+    return request.get("id", None)
+
+
+# streamed response is sent as several frames with the same id, last frame has "more" set to False
+def make_stream_frame(response_type, data, more):
+    return {"type": response_type, "data": data, "more": more}
+
+
+def read_stream_more(response):
+    return response.get("more", False)
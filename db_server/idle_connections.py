@@ -0,0 +1,110 @@
+import queue
+import socket
+import selectors
+import threading
+from time import monotonic
+
+
+class ClientConnection:
+    def __init__(self, sock, codec):
+        self.sock = sock
+        self.codec = codec  # negotiated wire codec, kept between requests
+        self.idle_since = monotonic()
+
+
+# persistent connections waiting for their next request are watched by one selector instead of holding a worker,
+# connection goes to a worker only when its next request starts to arrive
+# selector is used by the accept loop thread only, workers give connections back through a queue and wake it up
+class IdleConnections:
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout  # seconds, idle connection is closed after it
+        self.selector = selectors.DefaultSelector()
+        self.returned = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.is_closed = False
+        self.last_expire = monotonic()
+        self.count = 0  # idle connections watched now
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, "wakeup")
+
+    def add_listener(self, server_socket):
+        self.selector.register(server_socket, selectors.EVENT_READ, "listener")
+
+    # accept loop thread only
+    def add(self, client):
+        client.idle_since = monotonic()
+        self.selector.register(client.sock, selectors.EVENT_READ, client)
+        self.count += 1
+
+    def remove(self, client):
+        self.selector.unregister(client.sock)
+        self.count -= 1
+
+    # any thread, connection is closed if accept loop has already stopped
+    def put(self, client):
+        with self.lock:
+            if not self.is_closed:
+                self.returned.put(client)
+                try:
+                    self.wakeup_sender.send(b"\0")
+                except OSError:
+                    pass  # wakeup buffer is full, accept loop is woken anyway
+                return
+        client.sock.close()
+
+    # returns (listener has a connection to accept, connections with request to read)
+    def wait(self, timeout):
+        is_accept_ready, ready_clients = False, []
+        for key, events in self.selector.select(timeout):
+            if key.data == "wakeup":
+                self.drain_wakeup()
+            elif key.data == "listener":
+                is_accept_ready = True
+            else:
+                self.remove(key.data)
+                ready_clients.append(key.data)
+
+        while True:
+            try:
+                self.add(self.returned.get_nowait())
+            except queue.Empty:
+                break
+
+        if (now := monotonic()) - self.last_expire >= 1:
+            self.last_expire = now
+            self.expire(now)
+        return is_accept_ready, ready_clients
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    # accept loop thread only
+    def get_clients(self):
+        return [key.data for key in self.selector.get_map().values() if isinstance(key.data, ClientConnection)]
+
+    def expire(self, now):
+        for client in self.get_clients():
+            if now - client.idle_since > self.idle_timeout:
+                self.remove(client)
+                client.sock.close()
+
+    def close_all(self):
+        with self.lock:
+            self.is_closed = True
+        while True:
+            try:
+                self.returned.get_nowait().sock.close()
+            except queue.Empty:
+                break
+        for client in self.get_clients():
+            client.sock.close()
+        self.count = 0
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
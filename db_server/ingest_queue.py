@@ -0,0 +1,251 @@
+import os
+import json
+import threading
+from collections import deque, OrderedDict
+from dataclasses import dataclass, asdict
+from time import monotonic
+
+
+@dataclass
+class IngestQueueStats:
+    accepted: int = 0
+    rejected: int = 0  # rows rejected because queue was full
+    duplicates: int = 0  # rows of repeated requests (same idempotency key) that were not queued again
+    written: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    dead_lettered: int = 0  # rows moved to dead letter file
+    lost: int = 0  # rows neither written nor saved to dead letter file
+
+
+# bounded queue of activity objects between socket handlers and db
+# handlers put objects and answer right away, background writer flushes them with write_function in batches
+# batch is flushed when batch_size rows are pending or oldest pending row waited flush_interval seconds
+# batch failing max_attempts times in a row while database is healthy is split in halves to isolate bad rows,
+# single failing row is moved to dead letter file (json lines), so one bad row doesn't block the rows behind it
+# while database is unavailable batch is retried as is with growing interval, nothing is split or moved
+# dead letter file can be put back into queue with replay_dead_letter
+class IngestQueue:
+    def __init__(self, write_function, max_size=100000, batch_size=1000, flush_interval=1, retry_interval=5, stop_retries=3, max_keys=10000,
+                 max_attempts=3, dead_letter_path="data/ingest_dead_letter.jsonl", health_function=None, max_retry_interval=60):
+        self.write_function = write_function  # function(rows) -> bool, True if rows are committed
+        self.health_function = health_function  # function() -> bool, True if database answers, database is taken as healthy if None
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval  # doubles with every failed write in a row up to max_retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.stop_retries = stop_retries
+        self.max_keys = max_keys
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path
+
+        self.pending = deque()
+        self.oldest_timestamp = None  # monotonic time of oldest pending row
+        self.accepted_keys = OrderedDict()  # idempotency keys of last accepted requests, oldest first
+        self.failed_attempts = 0  # failed writes of head batch in a row
+        self.failed_writes = 0  # failed writes in a row of any batch, for retry backoff
+        self.suspect_rows = 0  # rows at queue head that were in a failed batch, written in smaller batches
+        self.failing_rows = 0  # rows at queue head that were in the last failed batch, batch size doesn't grow before they are passed
+        self.split_size = self.batch_size  # batch size while there are suspect rows
+        self.condition = threading.Condition()
+        self.is_working = False
+        self.writer_thread = None
+        self.stats = IngestQueueStats()
+
+    def start(self):
+        self.is_working = True
+        self.writer_thread = threading.Thread(target=self.start_writer, name="ingest_writer")
+        self.writer_thread.start()
+
+    # returns False if rows don't fit into queue (backpressure), rows of one request are accepted all or nothing
+    # batch bigger than max_size is still accepted into empty queue, so it can't be rejected forever
+    # rows with key of already accepted request are not queued again (client resent them after lost response)
+    def put(self, rows, key=None):
+        with self.condition:
+            if key is not None and key in self.accepted_keys:
+                self.stats.duplicates += len(rows)
+                return True
+            if self.pending and len(self.pending) + len(rows) > self.max_size:
+                self.stats.rejected += len(rows)
+                return False
+            if key is not None:
+                self.accepted_keys[key] = True
+                if len(self.accepted_keys) > self.max_keys:
+                    self.accepted_keys.popitem(last=False)
+            was_empty = not self.pending
+            if was_empty:
+                self.oldest_timestamp = monotonic()
+            self.pending.extend(rows)
+            self.stats.accepted += len(rows)
+            # writer waiting on empty queue is woken too, it has to start flush_interval timer
+            if was_empty or len(self.pending) >= self.batch_size:
+                self.condition.notify()
+            return True
+
+    # waits until batch is ready, returns [] when stopped and nothing is pending
+    def take_batch(self):
+        with self.condition:
+            while self.is_working:
+                if len(self.pending) >= self.batch_size:
+                    break
+                if self.pending and (remaining := self.oldest_timestamp + self.flush_interval - monotonic()) <= 0:
+                    break
+                self.condition.wait(remaining if self.pending else None)
+            return self.get_head_batch()
+
+    def get_head_batch(self):
+        batch_size = self.split_size if self.suspect_rows else self.batch_size
+        return [self.pending[i] for i in range(min(batch_size, len(self.pending)))]
+
+    def pop_head(self, count):
+        for _ in range(count):
+            self.pending.popleft()
+        self.oldest_timestamp = monotonic() if self.pending else None
+        self.suspect_rows = max(self.suspect_rows - count, 0)
+        self.failing_rows = max(self.failing_rows - count, 0)
+
+    # batch leaves queue only after it is written, so failed batch is retried first
+    # batch size grows back after every written part of suspect rows
+    def commit_batch(self, batch):
+        with self.condition:
+            self.pop_head(len(batch))
+            self.failed_attempts = 0
+            self.failed_writes = 0
+            if not self.failing_rows:
+                self.split_size = min(self.split_size * 2, self.batch_size)
+            self.stats.written += len(batch)
+            self.stats.batches += 1
+
+    # after max_attempts failures in a row batch is split, single row is moved to dead letter file
+    # database that is down fails every batch, so nothing is split until it answers health check
+    def on_failed_batch(self, batch):
+        with self.condition:
+            self.stats.failed_batches += 1
+            self.failed_writes += 1
+            self.failed_attempts += 1
+            if self.failed_attempts < self.max_attempts:
+                return
+            self.failed_attempts = 0
+        if not self.is_db_healthy():
+            print(f"Ingest batch of {len(batch)} rows failed {self.max_attempts} times, database is unavailable, batch will be retried as is")
+            return
+
+        with self.condition:
+            self.suspect_rows = max(self.suspect_rows, len(batch))
+            self.failing_rows = len(batch)
+            if len(batch) > 1:
+                self.split_size = len(batch) // 2
+                print(f"Ingest batch of {len(batch)} rows failed {self.max_attempts} times, retrying in batches of {self.split_size}")
+                return
+            self.pop_head(1)
+        self.save_dead_letter(batch, "write failed")
+
+    def is_db_healthy(self):
+        if self.health_function is None:
+            return True
+        try:
+            return self.health_function()
+        except Exception as ex:
+            print(f"Ingest health check error: {ex}")
+            return False
+
+    def get_retry_interval(self):
+        with self.condition:
+            return min(self.retry_interval * 2 ** max(self.failed_writes - 1, 0), self.max_retry_interval)
+
+    def save_dead_letter(self, rows, reason):
+        try:
+            if directory := os.path.dirname(self.dead_letter_path):
+                os.makedirs(directory, exist_ok=True)
+            with open(self.dead_letter_path, "a") as file:
+                for row in rows:
+                    file.write(json.dumps({"reason": reason, "row": row}) + "\n")
+        except (OSError, TypeError, ValueError) as ex:
+            print(f"Warning! {len(rows)} activity objects were not saved to dead letter file ({ex}): {rows}")
+            with self.condition:
+                self.stats.lost += len(rows)
+            return
+        print(f"Warning! {len(rows)} activity objects were moved to {self.dead_letter_path} ({reason})")
+        with self.condition:
+            self.stats.dead_lettered += len(rows)
+
+    def write_batch(self, batch):
+        try:
+            is_written = self.write_function(batch)
+        except Exception as ex:
+            print(f"Ingest writer error: {ex}")
+            is_written = False
+        if is_written:
+            self.commit_batch(batch)
+        else:
+            self.on_failed_batch(batch)
+        return is_written
+
+    def start_writer(self):
+        print("Ingest writer active")
+        while batch := self.take_batch():
+            if not self.write_batch(batch):
+                if not self.is_working:
+                    break
+                retry_interval = self.get_retry_interval()
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.is_working, retry_interval)
+        self.drain()
+        print("Ingest writer stopped")
+
+    # writes everything left after stop, gives up after stop_retries failed attempts in a row
+    # rows left then are saved to dead letter file
+    def drain(self):
+        failed_attempts = 0
+        while self.pending and failed_attempts < self.stop_retries:
+            with self.condition:
+                batch = self.get_head_batch()
+            failed_attempts = 0 if self.write_batch(batch) else failed_attempts + 1
+        with self.condition:
+            rows = list(self.pending)
+            self.pending.clear()
+        if rows:
+            self.save_dead_letter(rows, "not written on stop")
+
+    # puts rows of dead letter file back into queue, returns number of queued rows
+    # file is moved aside first, so rows failing again are written to a new one; rows that don't fit are saved back
+    def replay_dead_letter(self):
+        replay_path = self.dead_letter_path + ".replay"
+        try:
+            os.replace(self.dead_letter_path, replay_path)
+        except FileNotFoundError:
+            return 0
+
+        entries = []
+        with open(replay_path) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    print(f"Warning! Broken line in ingest dead letter file is skipped: {line!r}")
+
+        queued = 0
+        for i in range(0, len(entries), self.batch_size):
+            chunk = entries[i:i + self.batch_size]
+            if not self.put([entry["row"] for entry in chunk]):
+                for entry in entries[i:]:
+                    self.save_dead_letter([entry["row"]], entry["reason"])
+                break
+            queued += len(chunk)
+        os.remove(replay_path)
+        return queued
+
+    def stop(self):
+        with self.condition:
+            self.is_working = False
+            self.condition.notify_all()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+
+    def get_stats(self):
+        with self.condition:
+            stats = asdict(self.stats)
+            stats["pending"] = len(self.pending)
+            stats["max_size"] = self.max_size
+        return stats
@@ -0,0 +1,295 @@
+# load generator for db server: starts DBServer on SqliteManager with website calls stubbed
+# and drives it over the socket protocol from many concurrent clients
+# results (latency percentiles and requests/sec per request type) are printed or written as json
+# usage: python load_benchmark.py [--clients 16] [--duration 10] [--mix insert=4,most_played_users=2,...] [--output result.json]
+import os
+import sys
+import json
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+from time import monotonic, sleep
+from collections import defaultdict
+from binary_functions import send_msg, recv_msg
+from db_managers import SqliteManager, SqliteSettings
+from db_server import DBServer
+from gtinfo_requests import *
+from wire_codec import CODECS, CODEC_JSON, decode_message, set_request_codec
+
+
+DAY = 24 * 60 * 60
+FIRST_USER_ID = 76561197960265728
+DEFAULT_MIX = "insert=4,most_played_users=2,most_played_games=2,web_user_online_activity_objects=2"
+
+
+# users of stubbed website, set once instead of being fetched
+class StubUserSync:
+    def __init__(self, user_set, basic_user_ids, premium_user_ids):
+        self.user_set = user_set
+        self.basic_user_ids = basic_user_ids
+        self.premium_user_ids = premium_user_ids
+
+    def sync(self):
+        return self.user_set.update(self.basic_user_ids, self.premium_user_ids)
+
+    def close(self):
+        pass
+
+
+class RequestFactory:
+    def __init__(self, users, games, days, batch_size, now):
+        self.user_ids = [FIRST_USER_ID + i for i in range(users)]
+        self.game_ids = list(range(10, 10 + games))
+        self.days = days
+        self.batch_size = batch_size
+        self.now = now - now % DAY
+
+    def make_activity_object(self, rng):
+        started_playing_timestamp = self.now - rng.randint(0, self.days * DAY)
+        ended_playing_timestamp = started_playing_timestamp + rng.randint(60, 4 * 60 * 60)
+        return {
+            "tracked_user": rng.choice(self.user_ids),
+            "game_id": rng.choice(self.game_ids),
+            "started_playing_timestamp": started_playing_timestamp,
+            "ended_playing_timestamp": ended_playing_timestamp,
+            "total_played": round((ended_playing_timestamp - started_playing_timestamp) / 3600, 2),
+        }
+
+    # day-aligned windows, so repeated leaderboard requests can hit result cache as on website
+    def make_window(self, rng):
+        days = rng.choice((1, 7, self.days))
+        end_timestamp = self.now - rng.randint(0, self.days - days) * DAY
+        return {"start_timestamp": end_timestamp - days * DAY, "end_timestamp": end_timestamp}
+
+    def insert(self, rng):
+        return make_request(GTInfoRequestTypes.doer_new_user_online_activity_object, {
+            "user_online_activity_objects": [self.make_activity_object(rng) for _ in range(self.batch_size)]
+        })
+
+    def most_played_users(self, rng):
+        return make_request(GTInfoRequestTypes.most_played_users, {**self.make_window(rng), "limit": 10})
+
+    def most_played_games(self, rng):
+        return make_request(GTInfoRequestTypes.most_played_games, {**self.make_window(rng), "limit": 10})
+
+    def web_user_online_activity_objects(self, rng):
+        return make_request(GTInfoRequestTypes.web_user_online_activity_objects, {
+            **self.make_window(rng), "tracked_users": [rng.choice(self.user_ids)], "page_size": 100
+        })
+
+    def web_users_with_data(self, rng):
+        return make_request(GTInfoRequestTypes.web_users_with_data, 0)
+
+    def web_games_with_data(self, rng):
+        return make_request(GTInfoRequestTypes.web_games_with_data, 0)
+
+    def get_makers(self):
+        return {
+            "insert": self.insert,
+            "most_played_users": self.most_played_users,
+            "most_played_games": self.most_played_games,
+            "web_user_online_activity_objects": self.web_user_online_activity_objects,
+            "web_users_with_data": self.web_users_with_data,
+            "web_games_with_data": self.web_games_with_data,
+        }
+
+
+# "insert=4,most_played_users=1" -> { "insert": 4, "most_played_users": 1 }
+def parse_mix(mix, known_names):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in known_names:
+            raise ValueError(f"unknown request type {name}, expected one of {', '.join(known_names)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def get_free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(address, timeout=10):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return True
+        except OSError:
+            sleep(0.05)
+    return False
+
+
+class Client(threading.Thread):
+    def __init__(self, address, codec, makers, weights, seed, deadline, warmup_deadline):
+        super().__init__(daemon=True)
+        self.address = address
+        self.codec = codec
+        self.makers = makers
+        self.names = list(weights.keys())
+        self.weights = list(weights.values())
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.warmup_deadline = warmup_deadline  # requests before it are not measured
+        self.latencies = defaultdict(list)  # { name: [seconds] }
+        self.responses = defaultdict(lambda: defaultdict(int))  # { name: { response type name: count } }
+
+    def run(self):
+        sock = socket.create_connection(self.address)
+        try:
+            while (start_time := monotonic()) < self.deadline:
+                name = self.rng.choices(self.names, self.weights)[0]
+                request = set_request_codec(self.makers[name](self.rng), self.codec)
+                send_msg(sock, json.dumps(request))
+                if (response_raw := recv_msg(sock)) is None:
+                    self.responses[name][GTInfoResponseTypes.no_response.name] += 1
+                    break
+                response_type, _ = read_request(decode_message(response_raw))
+                if start_time < self.warmup_deadline:
+                    continue
+                self.latencies[name].append(monotonic() - start_time)
+                self.responses[name][GTInfoResponseTypes(response_type).name] += 1
+        finally:
+            sock.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summarize(latencies, responses, duration):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "rps": round(len(latencies) / duration, 1),
+        "avg_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0,
+        "responses": dict(responses),
+    }
+
+
+def preload(db_manager, request_factory, rows_count, seed):
+    rng = random.Random(seed)
+    for start in range(0, rows_count, 10000):
+        rows = [request_factory.make_activity_object(rng) for _ in range(min(10000, rows_count - start))]
+        response_code, _ = read_request(db_manager.add_user_online_activity_objects(rows))
+        if response_code != DBManagerResponseTypes.ok:
+            raise RuntimeError("failed to preload activity objects")
+
+
+def run_benchmark(args):
+    request_factory = RequestFactory(args.users, args.games, args.days, args.batch_size, int(args.now))
+    makers = request_factory.get_makers()
+    weights = parse_mix(args.mix, list(makers.keys()))
+
+    tmp_dir = None
+    sqlite_settings = SqliteSettings(tuned=args.tuned, synchronous=args.synchronous, read_pool_size=args.pool_size, memory=args.memory)
+    if args.memory:
+        db_manager = SqliteManager("gtinfo_benchmark", settings=sqlite_settings)
+    else:
+        if not (db_path := args.db):
+            tmp_dir = tempfile.TemporaryDirectory()
+            db_path = os.path.join(tmp_dir.name, "benchmark.db")
+        db_manager = SqliteManager(db_path, pool_max_size=args.pool_size, settings=sqlite_settings)
+
+    preload(db_manager, request_factory, args.preload, args.seed)
+
+    address = (args.host, get_free_port(args.host))
+    server = DBServer(address, "http://website.invalid", db_manager)
+    server.user_sync = StubUserSync(server.user_set, request_factory.user_ids[len(request_factory.user_ids) // 10:], request_factory.user_ids[:len(request_factory.user_ids) // 10])
+    server.retrieve_users()
+    server.settings.max_in_flight = max(server.settings.max_in_flight, args.clients)
+
+    # server prints every ingested batch, it would cost more than serving it
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        server.ingest_queue.start()
+        socket_thread = threading.Thread(target=server.start_socket, daemon=True)
+        socket_thread.start()
+        if not wait_for_server(address):
+            raise RuntimeError(f"db server didn't start on {address}")
+
+        start_time = monotonic()
+        warmup_deadline = start_time + args.warmup
+        deadline = warmup_deadline + args.duration
+        clients = [Client(address, args.codec, makers, weights, args.seed + i, deadline, warmup_deadline) for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = monotonic() - warmup_deadline
+
+        server.is_working = False
+        server.stop_socket()
+        socket_thread.join()
+        server.ingest_queue.stop()
+
+    latencies, responses = defaultdict(list), defaultdict(lambda: defaultdict(int))
+    for client in clients:
+        for name, client_latencies in client.latencies.items():
+            latencies[name] += client_latencies
+        for name, client_responses in client.responses.items():
+            for response_name, count in client_responses.items():
+                responses[name][response_name] += count
+
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "quiet")},
+        "requests": {name: summarize(latencies[name], responses[name], duration) for name in weights},
+        "total": summarize([latency for name in weights for latency in latencies[name]], {}, duration),
+        "ingest": server.ingest_queue.get_stats(),
+        "cache": server.result_cache.get_stats(),
+        "db_pool": db_manager.get_pool_stats(),
+    }
+    del result["total"]["responses"]
+    db_manager.close()
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db server load benchmark")
+    parser.add_argument("--db", default="", help="sqlite file, temporary one if not set")
+    parser.add_argument("--memory", action="store_true", help="disposable sqlite in temporary file, synchronous OFF")
+    parser.add_argument("--tuned", action="store_true", help="WAL, dedicated writer and read-only pool")
+    parser.add_argument("--synchronous", default="NORMAL", help="sqlite synchronous level of tuned mode")
+    parser.add_argument("--pool-size", type=int, default=5, help="connections (read-only ones in tuned mode)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds before measuring")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request types with weights")
+    parser.add_argument("--batch-size", type=int, default=20, help="activity objects per insert request")
+    parser.add_argument("--preload", type=int, default=50000, help="activity objects in db before start")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=500)
+    parser.add_argument("--days", type=int, default=30, help="activity objects are spread over this many last days")
+    parser.add_argument("--now", type=float, default=1700000000, help="fixed, so runs are repeatable")
+    parser.add_argument("--codec", choices=CODECS, default=CODEC_JSON)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="json file for results, stdout if not set")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="keep db server output")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+        for name, stats in result["requests"].items():
+            print(f"{name:>34}: {stats['rps']:>9} rps, p50 {stats['p50_ms']:>8} ms, p95 {stats['p95_ms']:>8} ms, p99 {stats['p99_ms']:>8} ms")
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from db_server import DBServer
-from db_managers import PostgreSQLManager, SqliteManager
+from db_managers import PostgreSQLManager, SqliteManager, PartitioningSettings, SqliteSettings
 import os
 
 # from dotenv import load_dotenv
@@ -16,9 +16,30 @@ database_values = (
     os.environ.get("SQL_DATABASE"),
 )
 
-postgre_manager = PostgreSQLManager(*database_values)
+pool_values = (
+    int(os.environ.get("SQL_POOL_MIN_SIZE") or 1),
+    int(os.environ.get("SQL_POOL_MAX_SIZE") or 10),
+    int(os.environ.get("SQL_POOL_TIMEOUT") or 10),
+)
+
+partitioning = PartitioningSettings(
+    enabled=os.environ.get("SQL_PARTITION_BY_MONTH", "") in ("1", "true"),
+    retention_months=int(os.environ.get("SQL_RETENTION_MONTHS") or 0),
+    retention_action=os.environ.get("SQL_RETENTION_ACTION") or "detach",
+    archive_dir=os.environ.get("SQL_ARCHIVE_DIR") or "archive",
+)
+
+if os.environ.get("SQL_ENGINE") == "sqlite":
+    sqlite_settings = SqliteSettings(
+        tuned=os.environ.get("SQLITE_TUNED", "") in ("1", "true"),
+        synchronous=os.environ.get("SQLITE_SYNCHRONOUS") or "NORMAL",
+        read_pool_size=int(os.environ.get("SQLITE_READ_POOL_SIZE") or 4),
+    )
+    db_manager = SqliteManager(os.environ.get("SQL_DATABASE"), *pool_values, sqlite_settings)
+else:
+    db_manager = PostgreSQLManager(*database_values, *pool_values, partitioning)
 
 TELEGRAM_NOTIFIER_ADDRESS = (os.environ.get("TGNOTIFIER_HOST"), int(os.environ.get("TGNOTIFIER_PORT")))
 
-a = DBServer(BIND_ADDRESS, WEBSITE_URL, postgre_manager, TELEGRAM_NOTIFIER_ADDRESS)
+a = DBServer(BIND_ADDRESS, WEBSITE_URL, db_manager, TELEGRAM_NOTIFIER_ADDRESS)
 a.start()
@@ -0,0 +1,165 @@
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict, deque
+from time import monotonic
+
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATE_WINDOW = 60  # seconds
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # upper bound of the bucket quantile falls into
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 3) if self.count else 0,
+            "p50_ms": self.quantile(0.5) * 1000,
+            "p95_ms": self.quantile(0.95) * 1000,
+            "p99_ms": self.quantile(0.99) * 1000,
+        }
+
+
+# events per second over the last RATE_WINDOW seconds
+class RateMeter:
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.events = deque()  # (second, count)
+
+    def add(self, count, now):
+        second = int(now)
+        if self.events and self.events[-1][0] == second:
+            self.events[-1] = (second, self.events[-1][1] + count)
+        else:
+            self.events.append((second, count))
+        self.trim(now)
+
+    def trim(self, now):
+        while self.events and self.events[0][0] <= now - self.window:
+            self.events.popleft()
+
+    def get_rate(self, now):
+        self.trim(now)
+        return sum(count for second, count in self.events) / self.window
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# counters, latency histograms and rates, labels are passed as keyword arguments
+# time spent in db by current thread is accumulated separately, so it can be attributed to request type
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)  # { (name, labels): value }
+        self.histograms = {}  # { (name, labels): Histogram }
+        self.rates = {}  # { name: RateMeter }
+        self.local = threading.local()
+
+    @staticmethod
+    def make_key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self.make_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self.make_key(name, labels)
+        with self.lock:
+            if (histogram := self.histograms.get(key, None)) is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_rate(self, name, count):
+        now = monotonic()
+        with self.lock:
+            self.rates.setdefault(name, RateMeter()).add(count, now)
+
+    def reset_thread_db_time(self):
+        self.local.db_time = 0
+
+    def add_thread_db_time(self, seconds):
+        self.local.db_time = getattr(self.local, "db_time", 0) + seconds
+
+    def get_thread_db_time(self):
+        return getattr(self.local, "db_time", 0)
+
+    # { "counters": {...}, "histograms": {...}, "rates": {...} } with "name{labels}" keys
+    def get_stats(self):
+        now = monotonic()
+        with self.lock:
+            return {
+                "counters": {name + format_labels(labels): value for (name, labels), value in sorted(self.counters.items())},
+                "histograms": {name + format_labels(labels): histogram.get_stats() for (name, labels), histogram in sorted(self.histograms.items())},
+                "rates": {name + "_per_second": round(rate_meter.get_rate(now), 3) for name, rate_meter in sorted(self.rates.items())},
+            }
+
+    # prometheus text exposition format, gauges are { name: value } collected by caller
+    def to_prometheus(self, gauges=None, prefix="gtinfo_"):
+        lines = []
+        now = monotonic()
+        with self.lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{prefix}{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{prefix}{name}_count{format_labels(labels)} {histogram.count}")
+
+            rates = {f"{name}_per_second": rate_meter.get_rate(now) for name, rate_meter in self.rates.items()}
+
+        for name, value in sorted({**rates, **(gauges or {})}.items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    # file is replaced atomically, so scraper (e.g. node exporter textfile collector) never reads half of it
+    def dump_prometheus(self, path, gauges=None):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.to_prometheus(gauges))
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
@@ -5,6 +5,10 @@ import socket
 import requests
 from binary_functions import *
 import json
+import itertools
+import threading
+from outbox import Outbox
+from gtinfo_requests import *
 
 
 # add 3 hours to date
@@ -135,29 +139,115 @@ class NameFinder:
         return username
 
 
+# delivers activity objects to telegram notifier in background
+# objects go through on-disk outbox, so notifier outage doesn't grow memory or block caller,
+# and undelivered objects survive restart
+# one long-lived connection, each frame is a batch acknowledged by notifier with the same id
 class SenderToTelegramNotifier:
-    def __init__(self, telegram_notifier_address):
+    def __init__(self, telegram_notifier_address, outbox_path="data/telegram_outbox.jsonl", max_outbox_size=64 * 1024 * 1024,
+                 batch_size=100, ack_timeout=10, ack_timeout_per_object=0.05, max_backoff=60):
         self.TELEGRAM_NOTIFIER_ADDRESS = telegram_notifier_address
         self.telegram_notifier_operational = True
-        self.data_to_send = []
-
+        self.outbox = Outbox(outbox_path, max_outbox_size)
+        self.batch_size = batch_size
+        # notifier answers as soon as batch is queued on its side, timeout still grows with batch size
+        # so bigger batch on slow link isn't resent while its acknowledgement is on the way
+        self.ack_timeout = ack_timeout
+        self.ack_timeout_per_object = ack_timeout_per_object
+        self.max_backoff = max_backoff
+
+        self.sock = None
+        self.request_ids = itertools.count(1)
+        self.is_working = False
+        self.stop_event = threading.Event()
+        self.sender_thread = None
+        self.dropped = 0
+
+    def start(self):
+        self.is_working = True
+        self.sender_thread = threading.Thread(target=self.start_sender, name="telegram_sender")
+        self.sender_thread.start()
+
+    def stop(self):
+        self.is_working = False
+        self.stop_event.set()
+        self.outbox.wake_up()
+        if self.sender_thread is not None:
+            self.sender_thread.join()
+        self.drop_socket()
+        self.outbox.close()
+
+    # only writes to outbox, objects that don't fit into max outbox size are dropped
     def send_data(self, data):
-        self.data_to_send += data
-        sock = socket.socket()
+        if not self.outbox.append(data):
+            self.dropped += len(data)
+            print(f"Telegram notifier outbox is full, {len(data)} objects dropped ({self.dropped} total)")
+
+    def set_operational(self, operational, reason=""):
+        if operational and not self.telegram_notifier_operational:
+            print(f"Telegram notifier is operational since {dt.datetime.utcnow()} utc")
+        elif not operational and self.telegram_notifier_operational:
+            print(f"Telegram notifier is not operational since {dt.datetime.utcnow()} utc ({reason})")
+        self.telegram_notifier_operational = operational
+
+    def get_socket(self):
+        if self.sock is None:
+            sock = socket.socket()
+            sock.settimeout(self.ack_timeout)
+            try:
+                sock.connect(self.TELEGRAM_NOTIFIER_ADDRESS)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+        return self.sock
+
+    def drop_socket(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # returns True if notifier received batch, False if it is to be sent again (also when notifier is busy)
+    # batch that notifier failed to handle is acknowledged too, so it doesn't block the outbox forever
+    def send_batch(self, data):
+        request_id = next(self.request_ids)
+        req = {"command": "new_user_online_activity_objects", "user_online_activity_objects": data}
         try:
-            # I'm in
-            sock.connect(self.TELEGRAM_NOTIFIER_ADDRESS)
-            if not self.telegram_notifier_operational:
-                print(f"Telegram notifier is operational since {dt.datetime.utcnow()} utc")
-            self.telegram_notifier_operational = True
-
-            req = {"command": "new_user_online_activity_objects", "user_online_activity_objects": self.data_to_send}
-            req_str = json.dumps(req)
-            send_msg(sock, req_str)
-            self.data_to_send = []
-            sock.close()
-        except ConnectionRefusedError:
-            # bruh, lets try another time
-            if self.telegram_notifier_operational:
-                print(f"Telegram notifier is not operational since {dt.datetime.utcnow()} utc")
-            self.telegram_notifier_operational = False
\ No newline at end of file
+            sock = self.get_socket()
+            sock.settimeout(self.ack_timeout + self.ack_timeout_per_object * len(data))
+            send_msg(sock, json.dumps(tag_request(req, request_id)))
+            response_raw = recv_msg(sock)
+            if response_raw is None:
+                raise ConnectionError("no acknowledgement")
+            response = json.loads(response_raw)
+            if read_request_id(response) != request_id:
+                raise ConnectionError(f"unexpected acknowledgement {response}")
+        except (OSError, ValueError) as ex:
+            self.drop_socket()
+            self.set_operational(False, ex)
+            return False
+
+        self.set_operational(True)
+        response_code, response_data = read_request(response)
+        if response_code == GTInfoResponseTypes.busy:
+            print(f"Telegram notifier is busy, {len(data)} objects will be sent later")
+            return False
+        if response_code != GTInfoResponseTypes.ok:
+            print(f"Telegram notifier failed to handle {len(data)} objects")
+        return True
+
+    def start_sender(self):
+        backoff = 1
+        while self.is_working:
+            data, position = self.outbox.read(self.batch_size)
+            if not data:
+                if position != self.outbox.position:  # only broken lines were read
+                    self.outbox.ack(position)
+                self.outbox.wait(1)
+                continue
+            if self.send_batch(data):
+                self.outbox.ack(position)
+                backoff = 1
+            else:
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import threading
+
+
+# append-only file of json lines, one line per item
+# reader position is kept in "<path>.pos" and moved only after items are acknowledged,
+# so items survive restarts and are delivered at least once
+# acknowledged part is cut off when it grows over compact_size, so file doesn't grow while it is never fully acknowledged
+class Outbox:
+    def __init__(self, path, max_size=64 * 1024 * 1024, compact_size=4 * 1024 * 1024):
+        self.path = path
+        self.position_path = path + ".pos"
+        self.max_size = max_size  # bytes of outbox file, acknowledged part included
+        self.compact_size = min(compact_size, max_size // 4)  # bytes of acknowledged items kept in file before it is compacted
+        self.condition = threading.Condition()
+
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.position = self.load_position()
+
+    def load_position(self):
+        try:
+            with open(self.position_path) as file:
+                position = int(file.read())
+        except (OSError, ValueError):
+            return 0
+        return min(position, self.size)
+
+    def save_position(self):
+        tmp_path = self.position_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(str(self.position))
+        os.replace(tmp_path, self.position_path)
+
+    def get_pending_size(self):
+        with self.condition:
+            return self.size - self.position
+
+    # returns False if items don't fit into max_size, nothing is written then
+    def append(self, items):
+        data = b"".join(json.dumps(item).encode() + b"\n" for item in items)
+        with self.condition:
+            if self.size + len(data) > self.max_size:
+                return False
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.condition.notify_all()
+        return True
+
+    # returns up to max_items oldest unacknowledged items and position to acknowledge them with
+    # line without "\n" at the end is partially written and is not read
+    def read(self, max_items):
+        with self.condition:
+            position, size = self.position, self.size
+        items = []
+        with open(self.path, "rb") as file:
+            file.seek(position)
+            while len(items) < max_items and position < size:
+                line = file.readline()
+                if not line.endswith(b"\n"):
+                    break
+                position += len(line)
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    print(f"Skipping broken outbox line: {line}")
+        return items, position
+
+    def wait(self, timeout):
+        with self.condition:
+            if self.position == self.size:
+                self.condition.wait(timeout)
+
+    def wake_up(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    # file is truncated when everything in it is acknowledged, compacted when acknowledged part is big
+    # file is replaced only here, items are read and acknowledged by one thread, so read doesn't see it replaced
+    def ack(self, position):
+        with self.condition:
+            self.position = position
+            if self.position == self.size:
+                self.file.truncate(0)
+                self.position = self.size = 0
+            elif self.position >= self.compact_size:
+                self.compact()
+                return
+            self.save_position()
+
+    # unacknowledged tail is copied to new file, position is saved as 0 before file is replaced,
+    # so crash in between resends acknowledged items (at least once) instead of losing unacknowledged ones
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(self.path, "rb") as file, open(tmp_path, "wb") as tmp_file:
+            file.seek(self.position)
+            shutil.copyfileobj(file, tmp_file)
+        self.file.close()
+        self.size -= self.position
+        self.position = 0
+        self.save_position()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        with self.condition:
+            self.file.close()
@@ -0,0 +1,96 @@
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from time import monotonic
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class ResultCacheEntry:
+    def __init__(self, value, expires, is_affected_by):
+        self.value = value
+        self.expires = expires
+        self.is_affected_by = is_affected_by  # function(user_online_activity_object) -> bool
+
+
+# LRU cache with TTL for read-only request results
+# entries are dropped when new activity objects would change them
+class ResultCache:
+    # list values whose order doesn't change query result
+    UNORDERED_KEYS = ("tracked_users", "game_ids")
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = ResultCacheStats()
+        self.generation = 0  # bumped on every invalidation
+
+    @classmethod
+    def make_key(cls, request_type, request_data):
+        if isinstance(request_data, dict):
+            request_data = {
+                key: sorted(set(value)) if key in cls.UNORDERED_KEYS and isinstance(value, list) else value
+                for key, value in request_data.items()
+            }
+        return json.dumps([int(request_type), request_data], sort_keys=True)
+
+    # returns (True, value) on hit and (False, None) on miss
+    def get(self, key):
+        with self.lock:
+            if (entry := self.entries.get(key, None)) is None:
+                self.stats.misses += 1
+                return False, None
+            if entry.expires <= monotonic():
+                del self.entries[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return True, entry.value
+
+    # generation is taken before reading value from db,
+    # value is not stored if invalidation happened in between
+    def put(self, key, value, is_affected_by, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = ResultCacheEntry(value, monotonic() + self.ttl, is_affected_by)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    # drops entries affected by any of new user online activity objects
+    def invalidate(self, user_online_activity_objects):
+        with self.lock:
+            self.generation += 1
+            for key, entry in list(self.entries.items()):
+                if any(entry.is_affected_by(el) for el in user_online_activity_objects):
+                    del self.entries[key]
+                    self.stats.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.stats.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            stats = asdict(self.stats)
+            stats["size"] = len(self.entries)
+            stats["max_size"] = self.max_size
+        requests_count = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / requests_count, 3) if requests_count else 0
+        return stats
@@ -0,0 +1,58 @@
+import queue
+import threading
+
+
+class WriteJob:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+# runs write calls one by one in a single thread, so they all go through one connection
+# and writers never wait for each other on database lock
+class SqliteWriter:
+    def __init__(self, max_size=10000):
+        self.jobs = queue.Queue(max_size)
+        self.thread = None
+        self.is_working = False
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.is_working = True
+        self.thread = threading.Thread(target=self.run, name="sqlite_writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while (job := self.jobs.get()) is not None:
+            try:
+                job.result = job.function(*job.args)
+            except Exception as ex:
+                job.exception = ex
+            job.event.set()
+
+    # blocks until function is run by writer thread, returns its result
+    # call from writer thread itself (nested write) is run in place, waiting for own queue would never end
+    def submit(self, function, *args):
+        if threading.current_thread() is self.thread:
+            return function(*args)
+        if not self.is_working:
+            raise RuntimeError("sqlite writer is stopped")
+        job = WriteJob(function, args)
+        self.jobs.put(job)
+        job.event.wait()
+        if job.exception is not None:
+            raise job.exception
+        return job.result
+
+    # jobs already queued are finished first
+    def stop(self):
+        if self.thread is None:
+            return
+        self.is_working = False
+        self.jobs.put(None)
+        self.thread.join()
+        self.thread = None
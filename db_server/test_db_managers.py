@@ -0,0 +1,120 @@
+import os
+import threading
+import datetime as dt
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from db_managers import PostgreSQLManager, PartitioningSettings, add_months, utc_timestamp
+from gtinfo_requests import DBManagerResponseTypes, read_request
+
+
+# runs against throwaway postgres database only, its public schema is recreated
+# TEST_SQL_HOST=localhost TEST_SQL_PORT=5432 TEST_SQL_USER=... TEST_SQL_PASSWORD=... TEST_SQL_DATABASE=... python -m pytest
+pytestmark = pytest.mark.skipif(not os.environ.get("TEST_SQL_HOST"), reason="TEST_SQL_HOST is not set")
+
+
+def get_connection_params():
+    return {
+        "user": os.environ.get("TEST_SQL_USER", "postgres"),
+        "password": os.environ.get("TEST_SQL_PASSWORD", ""),
+        "host": os.environ.get("TEST_SQL_HOST"),
+        "port": os.environ.get("TEST_SQL_PORT", "5432"),
+        "db_name": os.environ.get("TEST_SQL_DATABASE", "gtinfo_test"),
+    }
+
+
+def execute(query, params=()):
+    connection_params = get_connection_params()
+    connection_params["dbname"] = connection_params.pop("db_name")
+    conn = psycopg2.connect(**connection_params)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params or None)
+            rows = cursor.fetchall() if cursor.description else []
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def get_detached_tables():
+    return sorted(row[0] for row in execute("SELECT relname FROM pg_class WHERE relname LIKE 'user_online_activity_objects_detached_%%' AND relkind = 'r';"))
+
+
+def make_activity_object(tracked_user, started):
+    return {"tracked_user": tracked_user, "game_id": 1, "started_playing_timestamp": started,
+            "ended_playing_timestamp": started + 60, "total_played": 60}
+
+
+@pytest.fixture
+def manager():
+    execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    partitioning = PartitioningSettings(enabled=True, retention_months=2, retention_action="detach")
+    db_manager = PostgreSQLManager(**get_connection_params(), partitioning=partitioning)
+    yield db_manager
+    db_manager.close()
+
+
+def add(db_manager, objects):
+    response_code, _ = read_request(db_manager.add_user_online_activity_objects(objects))
+    assert response_code == DBManagerResponseTypes.ok
+
+
+# insert racing with detach of its month fails once, ingest queue retries it the same way
+# failed call makes manager set up again, so known partitions are read from database
+def add_with_retries(db_manager, objects, attempts=3):
+    for _ in range(attempts - 1):
+        response_code, _ = read_request(db_manager.add_user_online_activity_objects(objects))
+        if response_code == DBManagerResponseTypes.ok:
+            return
+    add(db_manager, objects)
+
+
+def test_month_detached_twice(manager):
+    old_month = utc_timestamp(add_months(dt.datetime.utcnow(), -6))
+    add(manager, [make_activity_object(1, old_month)])
+    read_request(manager.maintain_partitions())
+    assert len(get_detached_tables()) == 1
+
+    # late session for retired month gets new partition, which is retired again under another name
+    add(manager, [make_activity_object(2, old_month + 1)])
+    read_request(manager.maintain_partitions())
+    detached_tables = get_detached_tables()
+    assert len(detached_tables) == 2
+    assert sum(execute(f"SELECT COUNT(*) FROM {table};")[0][0] for table in detached_tables) == 2
+
+
+def test_partitions_created_while_maintained(manager):
+    now = dt.datetime.utcnow()
+    errors = []
+
+    def add_months_back(first_user):
+        try:
+            for months_back in range(12):
+                add_with_retries(manager, [make_activity_object(first_user + months_back, utc_timestamp(add_months(now, -months_back)))])
+        except Exception as ex:
+            errors.append(ex)
+
+    def maintain():
+        try:
+            for _ in range(12):
+                read_request(manager.maintain_partitions())
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=add_months_back, args=(i * 100,)) for i in range(3)] + [threading.Thread(target=maintain)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    read_request(manager.maintain_partitions())
+    with manager.partitions_lock:
+        known_partitions = set(manager.known_partitions)
+    conn = manager.connection_pool.get()
+    try:
+        assert known_partitions == manager.get_partition_months(conn.cursor())
+    finally:
+        manager.connection_pool.put(conn)
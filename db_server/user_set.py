@@ -0,0 +1,80 @@
+import uuid
+import threading
+from collections import deque
+
+
+USER_TIERS = ("basic", "premium")
+
+
+# tracked users with tier, every change bumps version and is kept in history,
+# so clients can ask for changes since version they know instead of full lists
+# epoch changes on every server start, versions of different epochs are not comparable
+class VersionedUserSet:
+    def __init__(self, max_history=1000):
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.users = {}  # { user_id: tier }
+        self.history = deque(maxlen=max_history)  # (version, { user_id: tier or None if removed })
+        self.lock = threading.Lock()
+
+    # replaces whole set, returns True if anything changed
+    def update(self, basic_user_ids, premium_user_ids):
+        new_users = {int(user_id): "basic" for user_id in basic_user_ids}
+        new_users.update({int(user_id): "premium" for user_id in premium_user_ids})
+        with self.lock:
+            changes = {user_id: None for user_id in self.users.keys() - new_users.keys()}
+            changes.update({user_id: tier for user_id, tier in new_users.items() if self.users.get(user_id, None) != tier})
+            self.apply_changes(changes)
+        return bool(changes)
+
+    def add(self, user_id, tier):
+        with self.lock:
+            if self.users.get(user_id, None) != tier:
+                self.apply_changes({user_id: tier})
+
+    def apply_changes(self, changes):
+        if not changes:
+            return
+        for user_id, tier in changes.items():
+            if tier is None:
+                del self.users[user_id]
+            else:
+                self.users[user_id] = tier
+        self.version += 1
+        self.history.append((self.version, changes))
+
+    def get_user_ids(self, tier):
+        with self.lock:
+            return sorted(user_id for user_id, user_tier in self.users.items() if user_tier == tier)
+
+    def get_snapshot(self):
+        with self.lock:
+            snapshot = {"epoch": self.epoch, "version": self.version, "snapshot": True}
+            for tier in USER_TIERS:
+                snapshot[f"{tier}_user_ids"] = sorted(user_id for user_id, user_tier in self.users.items() if user_tier == tier)
+        return snapshot
+
+    # returns changes since version: {"upserted": {"basic": [...], "premium": [...]}, "removed": [...]}
+    # tier change is upsert with new tier, snapshot is returned if version is unknown or too old
+    def get_delta(self, epoch, version):
+        with self.lock:
+            oldest_known_version = self.history[0][0] - 1 if self.history else self.version
+            if epoch != self.epoch or not oldest_known_version <= version <= self.version:
+                return None
+            merged_changes = {}
+            for change_version, changes in self.history:
+                if change_version > version:
+                    merged_changes.update(changes)
+            delta = {"epoch": self.epoch, "version": self.version, "snapshot": False, "removed": [], "upserted": {tier: [] for tier in USER_TIERS}}
+
+        for user_id, tier in merged_changes.items():
+            if tier is None:
+                delta["removed"].append(user_id)
+            else:
+                delta["upserted"][tier].append(user_id)
+        return delta
+
+    def get_delta_or_snapshot(self, epoch, version):
+        if (delta := self.get_delta(epoch, version)) is not None:
+            return delta
+        return self.get_snapshot()
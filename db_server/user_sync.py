@@ -0,0 +1,153 @@
+import json
+import requests
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+
+
+class UserSyncError(Exception):
+    pass
+
+
+class CachedPage:
+    def __init__(self, etag, last_modified, data):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.data = data
+
+
+# keeps VersionedUserSet in sync with tracked users list of the website
+# one persistent session, only first page is requested conditionally, unchanged list costs one 304,
+# after first page pages count is known and the rest are fetched concurrently
+# website answers either {"users": [...]} (all premium) or paginated {"count", "next", "results"}
+# ETag / Last-Modified of first page is taken as validator of the whole list, website doesn't send a separate one,
+# so list is fully fetched at least every full_fetch_interval seconds in case it only covers first page
+class UserSync:
+    def __init__(self, website_url, user_set, auth=None, max_workers=8, timeout=10, full_fetch_interval=600):
+        self.users_url = f"{website_url}/tracked_users"
+        self.user_set = user_set
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.full_fetch_interval = full_fetch_interval
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+        self.users_list = None  # CachedPage with validators of first page and user ids of all pages
+        self.last_full_fetch = None  # monotonic time
+        self.website_operational = True
+
+    # returns (page json, etag, last modified), page json is None if website answers 304 to cached_page validators
+    def get_page(self, url, cached_page=None):
+        headers = {}
+        if cached_page is not None:
+            if cached_page.etag:
+                headers["If-None-Match"] = cached_page.etag
+            if cached_page.last_modified:
+                headers["If-Modified-Since"] = cached_page.last_modified
+
+        try:
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        except Exception as ex:
+            raise UserSyncError(f"failed to connect to {url} ({ex})")
+
+        if resp.status_code == 304 and cached_page is not None:
+            return None, cached_page.etag, cached_page.last_modified
+        if resp.status_code != 200:
+            raise UserSyncError(f"{url} answered {resp.status_code}")
+        try:
+            data = json.loads(resp.text)
+        except (ValueError, TypeError) as ex:
+            raise UserSyncError(f"incorrect response from {url} ({ex})")
+        return data, resp.headers.get("ETag", None), resp.headers.get("Last-Modified", None)
+
+    def get_page_data(self, url):
+        return self.get_page(url)[0]
+
+    # urls of pages after first one, built from "next" link once count and page size are known
+    @staticmethod
+    def get_page_urls(first_page, next_url):
+        page_size = len(first_page["results"])
+        if not page_size:
+            return None
+        pages_count = -(-first_page["count"] // page_size)
+
+        parsed_url = urlparse(next_url)
+        query = {key: values[-1] for key, values in parse_qs(parsed_url.query).items()}
+        urls = []
+        for page in range(2, pages_count + 1):
+            if "page" in query:
+                query["page"] = page
+            elif "offset" in query:
+                query["offset"] = (page - 1) * int(query.get("limit", page_size))
+            else:
+                return None  # unknown pagination, follow "next" links
+            urls.append(urlunparse(parsed_url._replace(query=urlencode(query))))
+        return urls
+
+    def get_pages(self, first_page):
+        if not first_page["next"]:
+            return [first_page]
+        if (urls := self.get_page_urls(first_page, first_page["next"])) is not None:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="user_sync") as executor:
+                return [first_page] + list(executor.map(self.get_page_data, urls))
+
+        pages = [first_page]
+        while pages[-1]["next"]:
+            pages.append(self.get_page_data(pages[-1]["next"]))
+        return pages
+
+    # returns (basic user ids, premium user ids), kept ones if first page is not modified
+    def fetch_users(self):
+        cached_list = self.users_list
+        if self.last_full_fetch is None or monotonic() - self.last_full_fetch >= self.full_fetch_interval:
+            cached_list = None
+        first_page, etag, last_modified = self.get_page(self.users_url, cached_list)
+        if first_page is None:
+            return cached_list.data
+
+        users = self.read_users(first_page)
+        self.users_list = CachedPage(etag, last_modified, users) if etag or last_modified else None
+        self.last_full_fetch = monotonic()
+        return users
+
+    def read_users(self, first_page):
+        if "users" in first_page:
+            return [], [int(user_id) for user_id in first_page["users"]]
+        if first_page.get("count", -1) == -1:
+            raise UserSyncError(f"failed to get tracked users from {self.users_url}")
+
+        basic_user_ids, premium_user_ids = [], []
+        for page in self.get_pages(first_page):
+            for el in page["results"]:
+                if el["is_premium"]:
+                    premium_user_ids.append(int(el["steam_id"]))
+                else:
+                    basic_user_ids.append(int(el["steam_id"]))
+        return basic_user_ids, premium_user_ids
+
+    # returns True if user set changed, set is kept as is if website is unavailable
+    def sync(self):
+        old_version = self.user_set.version
+        try:
+            basic_user_ids, premium_user_ids = self.fetch_users()
+        except (UserSyncError, KeyError, TypeError, ValueError) as ex:
+            if self.website_operational:
+                print(f"Warning! Failed to retrieve users ({ex})")
+                self.website_operational = False
+            return False
+
+        if not self.website_operational:
+            print(f"Website is operational again, users retrieved from {self.users_url}")
+            self.website_operational = True
+        if not self.user_set.update(basic_user_ids, premium_user_ids):
+            return False
+
+        delta = self.user_set.get_delta(self.user_set.epoch, old_version)
+        if delta is not None:
+            print(f"Users from {self.users_url}: {len(delta['upserted']['basic'])} basic and {len(delta['upserted']['premium'])} premium added or changed, {len(delta['removed'])} removed")
+        return True
+
+    def close(self):
+        self.session.close()
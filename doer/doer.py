@@ -1,13 +1,14 @@
-import json
+import uuid
+import queue
 import datetime as dt
-import socket
 from time import sleep
 from dataclasses import dataclass
 from managers import DataManager
+from steam_api import SteamApi
 import threading
 from enum import Enum, auto
 from gtinfo_requests import *
-from binary_functions import *
+from gtinfo_client import GTInfoClient
 
 
 class UserTiers(Enum):
@@ -27,6 +28,7 @@ class DoerSettings:
     basic_freq: int
     premium_freq: int
     update_freq: int
+    idle_max_freq: int = 1800  # seconds, idle premium user is polled at least this often
 
 
 # decorator to check execution time (for users check only)
@@ -48,50 +50,36 @@ def time_check(f):
 
 # Doer interacts with db server:
 #   settings updates
-#   user lists updates
+#   user lists updates (only the worker's shard, users delta request is also its heartbeat)
 #   send data from data manager
+# updates are requested by their own thread, so heartbeat doesn't wait for a long (rate limited) users check,
+# received updates are applied by data collection thread between checks, data manager is used by that thread only
 class Doer:
-    def __init__(self, db_server_address, steam_key):
+    def __init__(self, db_server_address, steam_keys, worker_id, rate_limit_settings=None):
         self.is_set_up = False
-        self.db_operational = True  # db is anyway checked during setup
+        self.worker_id = worker_id  # unique among doers sharing db server
         self.db_server_address = db_server_address
-        self.steam_key = steam_key
+        self.db_client = GTInfoClient(db_server_address)
+        self.steam_api = SteamApi(steam_keys, rate_limit_settings)  # rate limit settings are per key
         self.settings = DoerSettings(5, 5, 5)
         self.basic_user_ids = []
         self.premium_user_ids = []
+        self.users_epoch = None  # version of user set on db server the last received delta leads to
+        self.users_version = 0
+        self.applied_users_version = 0  # version of user set the lists correspond to
+        self.updates = queue.SimpleQueue()  # (settings or None, users delta or None) received but not applied yet
         self.data_manager = DataManager(self)
         self.last_runs = LastRunTimestamps(0, 0, 0)
         self.data_to_send = []
+        self.batch_to_send = None  # (idempotency key, activity objects) sent but not confirmed yet
 
         self.is_working = True
 
-    # returns socket if db server operational, else None
-    def try_to_connect(self):
-        sock = socket.socket()
-        sock.settimeout(5)
-        try:
-            sock.connect(self.db_server_address)
-            if not self.db_operational:
-                print(f"DB is operational since {dt.datetime.utcnow()} utc")
-                self.db_operational = True
-            return sock
-        except (ConnectionRefusedError, socket.timeout, OSError) as ex:
-            if self.db_operational:
-                print(f"DB is not operational since {dt.datetime.utcnow()} utc ({ex})")
-                self.db_operational = False
-
     def send_request(self, request):
-        if not (sock := self.try_to_connect()):
-            return make_request(GTInfoResponseTypes.no_connection, 0)
-        send_msg(sock, json.dumps(request))
-        if not (response := recv_msg(sock)):
-            return make_request(GTInfoResponseTypes.no_response, 0)
-        sock.close()
-        response = json.loads(response)
-        return response
+        return self.db_client.send_request(request)
 
     def quick_request(self, request_type, data):
-        return read_request(self.send_request(make_request(request_type, data)))
+        return self.db_client.quick_request(request_type, data)
 
     # update users list
     def apply_users(self, new_basic_user_ids, new_premium_user_ids):
@@ -99,39 +87,90 @@ class Doer:
         self.data_manager.update_user_ids(new_basic_user_ids, new_premium_user_ids)
         self.basic_user_ids = new_basic_user_ids
         self.premium_user_ids = new_premium_user_ids
+        self.plan_steam_budget()
+
+    # apply changes since known version or full snapshot
+    def apply_users_delta(self, delta):
+        if delta["snapshot"]:
+            self.apply_users(delta["basic_user_ids"], delta["premium_user_ids"])
+        elif delta["version"] != self.applied_users_version:
+            changed_user_ids = set(delta["removed"]) | set(delta["upserted"]["basic"]) | set(delta["upserted"]["premium"])
+            new_basic_user_ids = [user_id for user_id in self.basic_user_ids if user_id not in changed_user_ids] + delta["upserted"]["basic"]
+            new_premium_user_ids = [user_id for user_id in self.premium_user_ids if user_id not in changed_user_ids] + delta["upserted"]["premium"]
+            self.apply_users(new_basic_user_ids, new_premium_user_ids)
+        self.applied_users_version = delta["version"]
 
     # update settings
     def apply_settings(self, settings_dict):
         self.settings.basic_freq = settings_dict.get("basic_user_request_freq", self.settings.basic_freq)
         self.settings.premium_freq = settings_dict.get("premium_user_request_freq", self.settings.basic_freq)
         self.settings.update_freq = settings_dict.get("settings_update_freq", self.settings.basic_freq)
+        self.settings.idle_max_freq = settings_dict.get("premium_user_idle_max_freq", self.settings.idle_max_freq)
+        self.plan_steam_budget()
+
+    # steam api rate is split between tiers by calls they need per their check period
+    # backed off premium users need less than a call per period, so premium demand follows their schedules
+    def plan_steam_budget(self):
+        self.steam_api.plan_budget(len(self.basic_user_ids), self.settings.basic_freq, self.data_manager.get_premium_calls_per_period(), self.settings.premium_freq)
 
-    # update from db server
+    # update from db server, called by updates thread
+    # settings and users requests are pipelined on one connection
+    # next delta is asked from the version received delta leads to, deltas are applied in the same order
     def check_updates(self):
-        response_code, response_data = self.quick_request(GTInfoRequestTypes.doer_settings, 0)
-        if response_code == GTInfoResponseTypes.ok:
-            self.apply_settings(response_data)
+        settings_response, users_response = self.db_client.send_requests([
+            make_request(GTInfoRequestTypes.doer_settings, 0),
+            make_request(GTInfoRequestTypes.doer_users_delta, {"epoch": self.users_epoch, "version": self.users_version, "worker_id": self.worker_id})
+        ])
 
-        if not self.is_set_up:  # all users
-            response_code, response_data = self.quick_request(GTInfoRequestTypes.doer_users, 0)
-            if response_code == GTInfoResponseTypes.ok:
-                self.apply_users(response_data["basic_user_ids"], response_data["premium_user_ids"])
+        settings, delta = None, None
+        response_code, response_data = read_request(settings_response)
+        if response_code == GTInfoResponseTypes.ok:
+            settings = response_data
+        response_code, response_data = read_request(users_response)
+        if response_code == GTInfoResponseTypes.ok:
+            delta = response_data
+            self.users_epoch = delta["epoch"]
+            self.users_version = delta["version"]
+        if settings is not None or delta is not None:
+            self.updates.put((settings, delta))
+
+    # called by data collection thread
+    def apply_updates(self):
+        while True:
+            try:
+                settings, delta = self.updates.get_nowait()
+            except queue.Empty:
+                return
+            if settings is not None:
+                self.apply_settings(settings)
+            if delta is not None:
+                self.apply_users_delta(delta)
                 self.is_set_up = True
-        else:  # all users if changed
-            response_code, response_data = self.quick_request(GTInfoRequestTypes.doer_users_if_changed, 0)
-            if response_code == GTInfoResponseTypes.ok:
-                if response_data["changed"]:
-                    self.apply_users(response_data["basic_user_ids"], response_data["premium_user_ids"])
 
     # send user activity objects to db server if there any
+    # unconfirmed batch is resent as is with the same key, so server doesn't write it twice if it was
+    # applied and only the response was lost, objects collected meanwhile go in the next batch
     def send_data_to_send(self):
-        if not self.data_to_send:
-            return
+        if self.batch_to_send is None:
+            if not self.data_to_send:
+                return
+            self.batch_to_send = (uuid.uuid4().hex, self.data_to_send)
+            self.data_to_send = []
 
-        data = {"user_online_activity_objects": self.data_to_send}
+        idempotency_key, user_online_activity_objects = self.batch_to_send
+        data = {"user_online_activity_objects": user_online_activity_objects, "idempotency_key": idempotency_key}
         response_code, response_data = self.quick_request(GTInfoRequestTypes.doer_new_user_online_activity_object, data)
         if response_code == GTInfoResponseTypes.ok:
-            self.data_to_send = []
+            self.batch_to_send = None
+            self.send_data_to_send()
+        elif response_code == GTInfoResponseTypes.busy:
+            print(f"DB is busy, {len(user_online_activity_objects) + len(self.data_to_send)} activity objects will be sent later")
+        elif response_code == GTInfoResponseTypes.error and isinstance(response_data, dict) and "invalid" in response_data:
+            # nothing of rejected batch was applied, malformed objects are dropped and the rest goes as new batch
+            invalid_indexes = set(response_data["invalid"])
+            print(f"DB rejected activity objects: {[el for i, el in enumerate(user_online_activity_objects) if i in invalid_indexes]}")
+            self.batch_to_send = None
+            self.data_to_send = [el for i, el in enumerate(user_online_activity_objects) if i not in invalid_indexes] + self.data_to_send
 
     # ask data manager for users and send data to db server
     @time_check
@@ -143,35 +182,51 @@ class Doer:
             self.data_to_send += self.data_manager.check_basic_users()
         elif users_tier == UserTiers.premium:
             self.data_to_send += self.data_manager.check_premium_users()
+            self.plan_steam_budget()
 
         self.send_data_to_send()
 
     def start(self):
         print("Doer starting... (1)")
+        (updates := threading.Thread(target=self.start_updates)).start()
         (data_collection := threading.Thread(target=self.start_data_collection)).start()
         (console := threading.Thread(target=self.start_console)).start()
 
+        updates.join()
         data_collection.join()
         console.join()
 
     def stop(self):
         print("Stopping execution...")
         self.is_working = False
+        self.quick_request(GTInfoRequestTypes.doer_unregister, {"worker_id": self.worker_id})
+        self.db_client.close()
 
-    def start_data_collection(self):
-        print("Data collection active")
+    def start_updates(self):
+        print("Updates active")
         while self.is_working:
             current_timestamp = dt.datetime.utcnow().timestamp()
             if self.last_runs.update + self.settings.update_freq <= current_timestamp:
                 self.last_runs.update = current_timestamp
                 self.check_updates()
+            sleep(1)
+        print("Updates stopped")
+
+    def start_data_collection(self):
+        print("Data collection active")
+        while self.is_working:
+            self.apply_updates()
+            current_timestamp = dt.datetime.utcnow().timestamp()
             if self.last_runs.basic + self.settings.basic_freq <= current_timestamp:
                 self.last_runs.basic = current_timestamp
                 self.check_users(UserTiers.basic)
             if self.last_runs.premium + self.settings.premium_freq <= current_timestamp:
                 self.last_runs.premium = current_timestamp
+                self.apply_updates()
                 self.check_users(UserTiers.premium)
             sleep(1)
+        self.data_manager.close()
+        self.steam_api.close()
         print("Data collection stopped")
 
     def start_console(self):
@@ -180,4 +235,14 @@ class Doer:
             command = input()
             if command == "stop":
                 self.stop()
+            elif command == "steam":
+                self.print_steam_stats()
         print("Console stopped")
+
+    def print_steam_stats(self):
+        stats = self.steam_api.get_stats()
+        keys_stats = stats.pop("keys")
+        print(" ".join(f"{key}={value}" for key, value in stats.items()))
+        for name, key_stats in keys_stats.items():
+            print(f"  key {name}: " + " ".join(f"{key}={value}" for key, value in key_stats.items()))
+        print("polling: " + " ".join(f"{key}={value}" for key, value in self.data_manager.get_poll_stats().items()))
@@ -1,11 +1,21 @@
 from doer import Doer
+import socket
+from steam_api import RateLimitSettings
 import os
 
 # from dotenv import load_dotenv
 # load_dotenv()
 
 SERVER_ADDRESS = (os.environ.get("DB_SERVER_HOST"), int(os.environ.get("DB_SERVER_PORT")))
-steam_key = os.environ.get("STEAM_API_KEY")
+# comma separated list of keys, single STEAM_API_KEY is still accepted
+steam_keys = [key.strip() for key in (os.environ.get("STEAM_API_KEYS") or os.environ.get("STEAM_API_KEY") or "").split(",") if key.strip()]
 
-a = Doer(SERVER_ADDRESS, steam_key)
+rate_limit_settings = RateLimitSettings()
+rate_limit_settings.calls_per_second = float(os.environ.get("STEAM_CALLS_PER_SECOND") or rate_limit_settings.calls_per_second)
+rate_limit_settings.daily_budget = int(os.environ.get("STEAM_DAILY_BUDGET") or rate_limit_settings.daily_budget)
+
+# doers sharing db server split tracked users between them by worker id
+worker_id = os.environ.get("DOER_WORKER_ID") or socket.gethostname()
+
+a = Doer(SERVER_ADDRESS, steam_keys, worker_id, rate_limit_settings)
 a.start()
@@ -1,9 +1,17 @@
-from concurrent.futures import as_completed
-from requests_futures.sessions import FuturesSession
-import requests
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+from time import monotonic
 import datetime as dt
 import traceback
+from steam_api import PLAYER_SUMMARIES_BATCH_SIZE
+
+
+@dataclass
+class PollStats:
+    polls: int = 0  # GetRecentlyPlayedGames calls made for premium users
+    skipped: int = 0  # premium user checks skipped because user is idle and backed off
+    presence_calls: int = 0  # batched GetPlayerSummaries calls for premium users
+    promoted: int = 0  # backed off users found in game and polled at once
 
 
 # one manager for each user
@@ -52,6 +60,20 @@ class PremiumUserManager:
         self.user_id = userid
         self.last_known_playtimes = all_playtimes
         self.sessions_start_playtimes = {}  # { app_id: [start_playtime, last_check_timestamp], }
+        self.poll_interval = 0  # seconds between polls, grows while user is idle
+        self.next_poll = 0  # monotonic time user is due, new user is due at once
+
+    # user is active if in game or session is not finished yet, active user is polled on every check,
+    # idle one is polled twice as rarely after every idle poll, up to max_interval
+    def schedule_next_poll(self, is_active, min_interval, max_interval, now):
+        if is_active or self.sessions_start_playtimes:
+            self.poll_interval = min_interval
+        else:
+            self.poll_interval = min(max(self.poll_interval * 2, min_interval), max(max_interval, min_interval))
+        self.next_poll = now + self.poll_interval
+
+    def is_due(self, now):
+        return self.next_poll <= now
 
     def analyze_data(self, data, current_timestamp=0):
         result_data = []  # list of tracked user objects to return
@@ -115,22 +137,29 @@ class PremiumUserManager:
         return result_data
 
 
+# steam requests are made from a bounded pool of threads through doer's SteamApi (shared session and rate limiter),
+# so checking a tier takes about as long as its slowest request, not the sum of all of them
+# premium users are polled on their own schedule: idle users back off, batched presence check
+# brings back those who started playing
 class DataManager:
-    def __init__(self, doer_class):
+    def __init__(self, doer_class, max_workers=16):
         self.doer = doer_class
+        self.steam_api = self.doer.steam_api
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="steam")
+        self.poll_stats = PollStats()
+
         self.basic_users_managers = {user_id: BasicUserManager(user_id, self.get_recent_playtimes) for user_id in self.doer.basic_user_ids}
         self.premium_users_managers = {user_id: PremiumUserManager(user_id, self.get_all_playtimes(user_id)) for user_id in self.doer.premium_user_ids}
 
-    def get_recent_playtimes(self, user_id):
-        url = f"http://api.steampowered.com/IPlayerService/GetRecentlyPlayedGames/v0001/?key={self.doer.steam_key}&steamid={user_id}&include_played_free_games=1"
-        resp = requests.get(url)
+    def close(self):
+        self.executor.shutdown(wait=False)
 
-        if resp.status_code != 200:
-            print(f"Request failed. Status code: {resp.status_code}")
+    def get_recent_playtimes(self, user_id, tier="basic"):
+        if (resp := self.steam_api.get_recently_played_games(user_id, tier)) is None:
             return {}
 
         try:
-            resp = json.loads(resp.text)["response"]
+            resp = resp["response"]
             if resp["total_count"] != 0:
                 res = {game["appid"]: game["playtime_forever"] * 60 for game in resp["games"]}
                 return res
@@ -139,18 +168,15 @@ class DataManager:
         return {}
 
     def get_all_playtimes(self, user_id):
-        url = f"http://api.steampowered.com/IPlayerService/GetOwnedGames/v1/?key={self.doer.steam_key}&steamid={user_id}&include_played_free_games=1"
-        resp = requests.get(url)
-
-        if resp.status_code != 200:
+        if (resp := self.steam_api.get_owned_games(user_id)) is None:
             return {}
 
         try:
-            resp = json.loads(resp.text)["response"]
-            
+            resp = resp["response"]
+
             if (x := resp.get("game_count", None)) is not None and x != 0:
                 res = {game["appid"]: game["playtime_forever"] * 60 for game in resp["games"]}
-                return res | self.get_recent_playtimes(user_id)
+                return res | self.get_recent_playtimes(user_id, "premium")
         except KeyError:
             print("Error: ")
             traceback.print_exc()
@@ -167,63 +193,97 @@ class DataManager:
             self.basic_users_managers[additional_userid] = BasicUserManager(additional_userid, self.get_recent_playtimes)
 
         for removed_userid in old_premium_user_ids - new_premium_user_ids:
-            del self.basic_users_managers[removed_userid]
-        for additional_userid in new_premium_user_ids - old_premium_user_ids:
-            self.premium_users_managers[additional_userid] = PremiumUserManager(additional_userid, self.get_all_playtimes(additional_userid))
+            del self.premium_users_managers[removed_userid]
+        additional_userids = list(new_premium_user_ids - old_premium_user_ids)
+        for additional_userid, all_playtimes in zip(additional_userids, self.executor.map(self.get_all_playtimes, additional_userids)):
+            self.premium_users_managers[additional_userid] = PremiumUserManager(additional_userid, all_playtimes)
 
     def check_basic_users(self):
         result_data = []
         basic_users_count = len(self.doer.basic_user_ids)
-        urls = []
-        for i in range(0, basic_users_count, 100):
-            start = i
-            end = i + 100 if i + 100 < basic_users_count else basic_users_count
-
-            users_range = ",".join([str(i) for i in self.doer.basic_user_ids[start:end]])
-            new_url = f"http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/?key={self.doer.steam_key}&steamids={users_range}"
-            urls.append(new_url)
-        with FuturesSession() as session:
-            futures = [session.get(url) for url in urls]
-            for future in as_completed(futures):
-                response = future.result()
-                if response.status_code == 200:
-                    response = json.loads(response.text)
-                    for player in response["response"]["players"]:
-                        if basic_users_manager := self.basic_users_managers.get(int(player["steamid"]), None):
-                            result_data += basic_users_manager.analyze_data(player, dt.datetime.utcnow().timestamp())
+        futures = []
+        for i in range(0, basic_users_count, PLAYER_SUMMARIES_BATCH_SIZE):
+            futures.append(self.executor.submit(self.steam_api.get_player_summaries, self.doer.basic_user_ids[i:i + PLAYER_SUMMARIES_BATCH_SIZE]))
+        for future in as_completed(futures):
+            if (response := future.result()) is None:
+                continue
+            for player in response.get("response", {}).get("players", []):
+                if basic_users_manager := self.basic_users_managers.get(int(player["steamid"]), None):
+                    result_data += basic_users_manager.analyze_data(player, dt.datetime.utcnow().timestamp())
         return result_data
 
+    # ids of given users that are in game now
+    def get_in_game_user_ids(self, user_ids, tier):
+        futures = []
+        for i in range(0, len(user_ids), PLAYER_SUMMARIES_BATCH_SIZE):
+            futures.append(self.executor.submit(self.steam_api.get_player_summaries, user_ids[i:i + PLAYER_SUMMARIES_BATCH_SIZE], tier))
+        self.poll_stats.presence_calls += len(futures)
+
+        in_game_user_ids = set()
+        for future in as_completed(futures):
+            if (response := future.result()) is None:
+                continue
+            for player in response.get("response", {}).get("players", []):
+                if player.get("gameid", None):
+                    in_game_user_ids.add(int(player["steamid"]))
+        return in_game_user_ids
+
+    # responses are analyzed as they complete, slow or failing user doesn't hold back the others
+    # only due users are polled, presence check of all users (one call per 100) keeps users in game active
+    # and brings back backed off users who started playing
     def check_premium_users(self):
-        url_template = "http://api.steampowered.com/IPlayerService/GetRecentlyPlayedGames/v0001/?key={}&steamid={}&include_played_free_games=1"
-        urls = [url_template.format(self.doer.steam_key, user_id) for user_id in self.doer.premium_user_ids]
-        result_data = []
-
-        try:
-            for steam_id, url in zip(self.doer.premium_user_ids, urls):
-                response = requests.get(url)
+        now = monotonic()
+        min_interval, max_interval = self.doer.settings.premium_freq, self.doer.settings.idle_max_freq
+        in_game_user_ids = self.get_in_game_user_ids(self.doer.premium_user_ids, "premium")
+
+        due_user_ids = []
+        for user_id in self.doer.premium_user_ids:
+            if (premium_user_manager := self.premium_users_managers.get(user_id, None)) is None:
+                continue
+            if premium_user_manager.is_due(now):
+                due_user_ids.append(user_id)
+            elif user_id in in_game_user_ids:
+                due_user_ids.append(user_id)
+                self.poll_stats.promoted += 1
+            else:
+                self.poll_stats.skipped += 1
 
-                if not (response.status_code == 200):  # first response check
-                    print(response.status_code)
-                    continue
+        futures = {self.executor.submit(self.steam_api.get_recently_played_games, user_id): user_id for user_id in due_user_ids}
+        self.poll_stats.polls += len(futures)
+        result_data = []
 
-                try:  # trying to parse to dict
-                    response = json.loads(response.text)["response"]
-                except json.decoder.JSONDecodeError as ex:  # probably request futures messed up
-                    print(2)
-                    continue
+        for future in as_completed(futures):
+            steam_id = futures[future]
+            if (response := future.result()) is None:
+                continue  # schedule is kept, user is polled again on next check
+            if (premium_user_manager := self.premium_users_managers.get(steam_id, None)) is None:
+                continue
 
-                if not ("games" in response.keys()):  # check if response is not empty
-                    print(list(response.keys()), response)
-                    continue  # response is empty, steam bug perhaps
+            user_data = []
+            response = response.get("response", {})
+            if "games" in response.keys():  # empty response: steam bug perhaps or user has no recent games
+                user_data = premium_user_manager.analyze_data(response["games"], dt.datetime.utcnow().timestamp())
+                result_data += user_data
 
-                # finally
-                if premium_user_manager := self.premium_users_managers.get(steam_id, None):
-                    result_data += premium_user_manager.analyze_data(response["games"], dt.datetime.utcnow().timestamp())
-        except requests.exceptions.ConnectionError as ex:
-            print("ERROR:", ex)
+            # playtime change means user played since last poll, may still be playing
+            is_active = steam_id in in_game_user_ids or bool(user_data)
+            premium_user_manager.schedule_next_poll(is_active, min_interval, max_interval, monotonic())
 
         return result_data
 
+    # GetRecentlyPlayedGames calls premium users make per period of premium_freq with their current intervals,
+    # plus presence calls
+    def get_premium_calls_per_period(self):
+        premium_freq = max(self.doer.settings.premium_freq, 1)
+        calls = sum(premium_freq / max(premium_user_manager.poll_interval, premium_freq) for premium_user_manager in self.premium_users_managers.values())
+        return calls + -(-len(self.premium_users_managers) // PLAYER_SUMMARIES_BATCH_SIZE)
+
+    def get_poll_stats(self):
+        stats = asdict(self.poll_stats)
+        stats["premium_idle"] = sum(premium_user_manager.poll_interval > self.doer.settings.premium_freq for premium_user_manager in self.premium_users_managers.values())
+        stats["premium_active"] = len(self.premium_users_managers) - stats["premium_idle"]
+        return stats
+
     @staticmethod
     def extract_steamid_from_url(url):
         ix = url.find("steamid=") + 8
@@ -0,0 +1,342 @@
+import json
+import threading
+import requests
+import datetime as dt
+from time import monotonic, sleep
+from dataclasses import dataclass, field, asdict
+
+
+STEAM_API_URL = "http://api.steampowered.com"
+
+PLAYER_SUMMARIES = "ISteamUser/GetPlayerSummaries/v0002/"
+RECENTLY_PLAYED_GAMES = "IPlayerService/GetRecentlyPlayedGames/v0001/"
+OWNED_GAMES = "IPlayerService/GetOwnedGames/v1/"
+
+PLAYER_SUMMARIES_BATCH_SIZE = 100  # steam ids per GetPlayerSummaries call
+
+TIERS = ("basic", "premium")
+RATES_UPDATE_FREQ = 10  # seconds, budget rate changes as calls are made and the day goes by
+
+
+@dataclass
+class RateLimitSettings:
+    calls_per_second: float = 1.1  # sustained rate, 100k a day is ~1.16/s
+    burst: int = 20  # calls that may go at once after idle time
+    daily_budget: int = 100000  # steam web api terms limit a key to 100k calls a day
+    endpoint_costs: dict = field(default_factory=lambda: {PLAYER_SUMMARIES: 1, RECENTLY_PLAYED_GAMES: 1, OWNED_GAMES: 1})
+    min_speed: float = 0.05  # slowdown never goes below this fraction of calls_per_second
+    recovery_step: float = 0.02  # fraction of calls_per_second regained per successful call
+    min_tier_share: float = 0.05  # tier without demand still gets this fraction (e.g. for newly added users)
+
+
+@dataclass
+class RateLimiterStats:
+    calls: int = 0
+    throttled: int = 0  # 429 and 5xx answers
+
+
+@dataclass
+class ApiKeyPoolStats:
+    calls: int = 0
+    rejected: int = 0  # calls not made because daily budget of every key is spent
+    timeouts: int = 0  # calls not made because no key had tokens in time
+    wait_time: float = 0  # seconds callers waited for tokens
+
+
+@dataclass
+class ApiKeyStats:
+    errors: int = 0
+    ejections: int = 0
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate, now):
+        self.refill(now)
+        self.rate = rate
+
+    # returns 0 if tokens are taken, else seconds to wait before trying again
+    def try_take(self, cost, now):
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        if self.rate <= 0:
+            return 1
+        return (cost - self.tokens) / self.rate
+
+
+# every steam call takes tokens of its tier bucket, tier rates are shares of one global rate
+# global rate is lowered to spread the rest of daily budget over the rest of the day,
+# halved on 429/5xx (with pause for Retry-After) and restored step by step on successful calls
+class RateLimiter:
+    def __init__(self, settings=None):
+        self.settings = settings or RateLimitSettings()
+        self.lock = threading.Lock()
+        self.stats = RateLimiterStats()
+        self.speed = 1  # fraction of calls_per_second after slowdowns
+        self.paused_until = 0
+        self.day = dt.datetime.utcnow().date()
+        self.used_today = 0
+        self.demands = {tier: 0 for tier in TIERS}  # calls per second each tier needs
+        self.buckets = {tier: TokenBucket(0, self.settings.burst) for tier in TIERS}
+        self.rates_updated = 0
+        with self.lock:
+            self.update_rates(monotonic())
+
+    def get_rate(self):
+        now = dt.datetime.utcnow()
+        seconds_left = (dt.datetime.combine(now.date() + dt.timedelta(days=1), dt.time()) - now).total_seconds()
+        budget_rate = max(self.settings.daily_budget - self.used_today, 0) / max(seconds_left, 1)
+        return min(self.settings.calls_per_second * self.speed, budget_rate)
+
+    # spare rate is split by demand too, so tier that fell behind can catch up
+    def update_rates(self, now):
+        self.rates_updated = now
+        rate = self.get_rate()
+        weights = {tier: demand + rate * self.settings.min_tier_share for tier, demand in self.demands.items()}
+        total_weight = sum(weights.values()) or 1
+        for tier, bucket in self.buckets.items():
+            bucket.set_rate(rate * weights[tier] / total_weight, now)
+
+    # scheduler: demand of a tier is calls it makes per check divided by its check period
+    def set_demands(self, demands):
+        with self.lock:
+            self.demands.update(demands)
+            self.update_rates(monotonic())
+
+    def check_day(self):
+        if (today := dt.datetime.utcnow().date()) != self.day:
+            self.day = today
+            self.used_today = 0
+
+    # returns 0 if call is allowed and counted, seconds to wait if not yet, None if daily budget is spent
+    def try_acquire(self, endpoint, tier):
+        cost = self.settings.endpoint_costs.get(endpoint, 1)
+        with self.lock:
+            self.check_day()
+            if self.used_today + cost > self.settings.daily_budget:
+                return None
+            now = monotonic()
+            if now - self.rates_updated > RATES_UPDATE_FREQ:
+                self.update_rates(now)
+            if (wait_time := self.paused_until - now) > 0:
+                return wait_time
+            if (wait_time := self.buckets[tier].try_take(cost, now)) == 0:
+                self.used_today += cost
+                self.stats.calls += 1
+            return wait_time
+
+    def report(self, status_code, retry_after=None):
+        with self.lock:
+            if status_code == 429 or status_code >= 500:
+                self.stats.throttled += 1
+                self.speed = max(self.settings.min_speed, self.speed / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, monotonic() + retry_after)
+            elif self.speed < 1:
+                self.speed = min(1, self.speed + self.settings.recovery_step)
+            else:
+                return
+            self.update_rates(monotonic())
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                **asdict(self.stats),
+                "used_today": self.used_today,
+                "daily_budget": self.settings.daily_budget,
+                "speed": round(self.speed, 3),
+            }
+            for tier, bucket in self.buckets.items():
+                stats[f"{tier}_rate"] = round(bucket.rate, 3)
+                stats[f"{tier}_demand"] = round(self.demands[tier], 3)
+        return stats
+
+
+def get_retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+# one api key with own rate accounting, key that keeps failing is ejected for a growing backoff
+class ApiKey:
+    def __init__(self, key, rate_limit_settings=None, max_failures=3, base_backoff=30, max_backoff=3600):
+        self.key = key
+        self.name = "..." + key[-4:]  # key is never printed in full
+        self.rate_limiter = RateLimiter(rate_limit_settings)
+        self.max_failures = max_failures  # consecutive failures before ejection
+        self.base_backoff = base_backoff  # seconds, doubled on every ejection in a row
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.stats = ApiKeyStats()
+        self.failures = 0
+        self.ejections_in_row = 0
+        self.ejected_until = 0
+
+    def is_ejected(self, now):
+        with self.lock:
+            return self.ejected_until > now
+
+    def report_success(self):
+        with self.lock:
+            self.failures = 0
+            self.ejections_in_row = 0
+
+    # is_key_error marks answers caused by key itself (rejected or throttled key), key is ejected at once then
+    def report_failure(self, reason, is_key_error=False):
+        with self.lock:
+            self.stats.errors += 1
+            self.failures += 1
+            if not is_key_error and self.failures < self.max_failures:
+                return
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** self.ejections_in_row)
+            self.ejected_until = monotonic() + backoff
+            self.ejections_in_row += 1
+            self.failures = 0
+            self.stats.ejections += 1
+        print(f"Steam api key {self.name} is ejected for {backoff}s ({reason})")
+
+    def get_stats(self):
+        stats = self.rate_limiter.get_stats()
+        with self.lock:
+            stats.update(asdict(self.stats))
+            stats["ejected_for"] = max(round(self.ejected_until - monotonic()), 0)
+        return stats
+
+
+# calls are spread over keys in turn, key without tokens, with spent budget or ejected is skipped
+class ApiKeyPool:
+    def __init__(self, keys, rate_limit_settings=None):
+        if not keys:
+            raise ValueError("at least one steam api key is required")
+        self.keys = [ApiKey(key, rate_limit_settings) for key in keys]
+        self.lock = threading.Lock()
+        self.stats = ApiKeyPoolStats()
+        self.next_index = 0
+        self.budget_warned = False
+
+    def get_keys_in_turn(self):
+        with self.lock:
+            start = self.next_index
+            self.next_index = (self.next_index + 1) % len(self.keys)
+        return self.keys[start:] + self.keys[:start]
+
+    # blocks until some key allows the call, returns that key or None if all budgets are spent or timeout passed
+    def acquire(self, endpoint, tier, timeout=60):
+        start_time = monotonic()
+        while True:
+            now = monotonic()
+            wait_times = []
+            for api_key in self.get_keys_in_turn():
+                if api_key.is_ejected(now):
+                    wait_times.append(api_key.ejected_until - now)
+                elif (wait_time := api_key.rate_limiter.try_acquire(endpoint, tier)) == 0:
+                    with self.lock:
+                        self.stats.calls += 1
+                        self.stats.wait_time += now - start_time
+                        self.budget_warned = False
+                    return api_key
+                elif wait_time is not None:
+                    wait_times.append(wait_time)
+
+            with self.lock:
+                if not wait_times:
+                    self.stats.rejected += 1
+                    if not self.budget_warned:
+                        print("WARNING! Daily steam api budget of every key is spent")
+                        self.budget_warned = True
+                    return None
+                if now + min(wait_times) - start_time > timeout:
+                    self.stats.timeouts += 1
+                    return None
+            sleep(min(min(wait_times), 1))
+
+    def set_demands(self, demands):
+        for api_key in self.keys:
+            api_key.rate_limiter.set_demands(demands)
+
+    def get_stats(self):
+        with self.lock:
+            stats = asdict(self.stats)
+        stats["keys"] = {api_key.name: api_key.get_stats() for api_key in self.keys}
+        return stats
+
+
+# all steam web api calls of the doer go through here: one keep-alive session, pool of keys, timeouts and retries
+class SteamApi:
+    def __init__(self, keys, rate_limit_settings=None, pool_size=16, timeout=10, retries=2, retry_delay=1):
+        self.key_pool = ApiKeyPool(keys, rate_limit_settings)
+        self.timeout = timeout  # seconds for connect and for read
+        self.retries = retries  # extra attempts (with another key if there is one) on connection errors, 429 and 5xx
+        self.retry_delay = retry_delay  # seconds, doubled on every retry
+
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+    def close(self):
+        self.session.close()
+
+    # returns parsed json response or None
+    def get(self, endpoint, params, tier):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(self.retry_delay * 2 ** (attempt - 1))
+            if (api_key := self.key_pool.acquire(endpoint, tier)) is None:
+                return None
+            try:
+                resp = self.session.get(f"{STEAM_API_URL}/{endpoint}", params={"key": api_key.key, **params}, timeout=self.timeout)
+            except requests.exceptions.RequestException as ex:
+                error = ex.__class__.__name__
+                api_key.report_failure(error)
+                continue
+            api_key.rate_limiter.report(resp.status_code, get_retry_after(resp))
+            if resp.status_code in (401, 403, 429) or resp.status_code >= 500:
+                error = f"status code {resp.status_code}"
+                api_key.report_failure(error, is_key_error=resp.status_code < 500)
+                continue
+            api_key.report_success()
+            if resp.status_code != 200:
+                print(f"Request to {endpoint} failed. Status code: {resp.status_code}")
+                return None
+            try:
+                return json.loads(resp.text)
+            except ValueError:
+                print(f"Incorrect response from {endpoint}")
+                return None
+        print(f"Request to {endpoint} failed after {self.retries + 1} attempts ({error})")
+        return None
+
+    def get_player_summaries(self, steam_ids, tier="basic"):
+        return self.get(PLAYER_SUMMARIES, {"steamids": ",".join(str(steam_id) for steam_id in steam_ids)}, tier)
+
+    def get_recently_played_games(self, steam_id, tier="premium"):
+        return self.get(RECENTLY_PLAYED_GAMES, {"steamid": steam_id, "include_played_free_games": 1}, tier)
+
+    def get_owned_games(self, steam_id, tier="premium"):
+        return self.get(OWNED_GAMES, {"steamid": steam_id, "include_played_free_games": 1}, tier)
+
+    # calls per second each tier needs to check all its users once per its period
+    # every key splits its own rate between tiers in the same proportion
+    # premium_calls is calls premium users make per premium_freq, less than their count when some are backed off
+    def plan_budget(self, basic_users_count, basic_freq, premium_calls, premium_freq):
+        self.key_pool.set_demands({
+            "basic": -(-basic_users_count // PLAYER_SUMMARIES_BATCH_SIZE) / max(basic_freq, 1),
+            "premium": premium_calls / max(premium_freq, 1),
+        })
+
+    def get_stats(self):
+        return self.key_pool.get_stats()
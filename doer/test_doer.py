@@ -0,0 +1,84 @@
+import threading
+from time import monotonic, sleep
+from doer import Doer
+from gtinfo_requests import GTInfoRequestTypes, GTInfoResponseTypes, make_request, read_request
+
+
+# answers settings and users delta requests, remembers when heartbeats came
+class FakeDBClient:
+    def __init__(self):
+        self.heartbeats = []
+        self.version = 0
+
+    def send_requests(self, requests_list):
+        responses = []
+        for request in requests_list:
+            request_type, request_data = read_request(request)
+            if request_type == GTInfoRequestTypes.doer_settings:
+                responses.append(make_request(GTInfoResponseTypes.ok, {"basic_user_request_freq": 1, "premium_user_request_freq": 1, "settings_update_freq": 1}))
+            elif request_type == GTInfoRequestTypes.doer_users_delta:
+                self.heartbeats.append(monotonic())
+                self.version += 1
+                responses.append(make_request(GTInfoResponseTypes.ok, {
+                    "epoch": "epoch", "version": self.version, "snapshot": request_data["epoch"] is None,
+                    "basic_user_ids": [1], "premium_user_ids": [],
+                    "upserted": {"basic": [self.version + 1], "premium": []}, "removed": [],
+                }))
+        return responses
+
+    def quick_request(self, request_type, data):
+        return GTInfoResponseTypes.ok, 0
+
+    def close(self):
+        pass
+
+
+# basic users check takes several heartbeat periods, as it does when steam calls are rate limited
+class SlowDataManager:
+    def __init__(self, check_time):
+        self.check_time = check_time
+        self.user_ids_updates = []
+        self.is_checking = False
+
+    def update_user_ids(self, basic_user_ids, premium_user_ids):
+        assert not self.is_checking
+        self.user_ids_updates.append(list(basic_user_ids))
+
+    def check_basic_users(self):
+        self.is_checking = True
+        sleep(self.check_time)
+        self.is_checking = False
+        return []
+
+    def check_premium_users(self):
+        return []
+
+    def get_premium_calls_per_period(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+def test_heartbeat_during_slow_check():
+    doer = Doer(("127.0.0.1", 0), ["key"], "worker")
+    doer.settings.update_freq = 1
+    doer.db_client = FakeDBClient()
+    doer.data_manager = SlowDataManager(check_time=4)
+
+    threads = [threading.Thread(target=doer.start_updates), threading.Thread(target=doer.start_data_collection)]
+    for thread in threads:
+        thread.start()
+    sleep(7)
+    doer.is_working = False
+    for thread in threads:
+        thread.join()
+
+    heartbeats = doer.db_client.heartbeats
+    assert len(heartbeats) >= 5
+    assert max(later - earlier for earlier, later in zip(heartbeats, heartbeats[1:])) < 2.5
+
+    # deltas received during slow check are applied after it, in order
+    assert doer.data_manager.user_ids_updates[0] == [1]
+    assert doer.basic_user_ids == [1] + list(range(3, doer.applied_users_version + 2))
+    assert doer.users_version == doer.db_client.version
@@ -0,0 +1,213 @@
+import json
+import queue
+import socket
+import threading
+import itertools
+import datetime as dt
+from time import monotonic
+from gtinfo_requests import *
+from binary_functions import *
+from wire_codec import CODEC_BINARY, decode_message, set_request_codec
+
+
+class PendingRequest:
+    def __init__(self, sock, is_streamed=False):
+        self.sock = sock
+        self.event = threading.Event()
+        self.response = None
+        self.frames = queue.Queue() if is_streamed else None  # None marks closed connection
+
+
+# keeps one long-lived connection to db server
+# requests from any thread are pipelined on it and matched to responses by id
+# requests are json, responses are asked in codec (old servers ignore it and answer json)
+class GTInfoClient:
+    def __init__(self, server_address, timeout=5, name="DB", codec=CODEC_BINARY):
+        self.server_address = server_address
+        self.timeout = timeout
+        self.name = name
+        self.codec = codec
+        self.operational = True
+
+        self.sock = None
+        self.connect_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}  # { request_id: PendingRequest }
+        self.request_ids = itertools.count(1)
+
+    # returns connected socket if server operational, else None
+    def get_socket(self):
+        with self.connect_lock:
+            if self.sock is not None:
+                return self.sock
+
+            sock = socket.socket()
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.server_address)
+            except (ConnectionRefusedError, socket.timeout, OSError) as ex:
+                sock.close()
+                if self.operational:
+                    print(f"{self.name} is not operational since {dt.datetime.utcnow()} utc ({ex})")
+                    self.operational = False
+                return None
+
+            if not self.operational:
+                print(f"{self.name} is operational since {dt.datetime.utcnow()} utc")
+                self.operational = True
+
+            sock.settimeout(None)  # reader waits for responses as long as connection lives
+            self.sock = sock
+            threading.Thread(target=self.read_responses, args=(sock,), daemon=True).start()
+            return sock
+
+    def is_connected(self, sock):
+        with self.connect_lock:
+            return self.sock is sock
+
+    def drop_socket(self, sock):
+        with self.connect_lock:
+            if self.sock is sock:
+                self.sock = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def recv_response(sock):
+        try:
+            return recv_msg(sock)
+        except OSError:  # socket closed by client
+            return None
+
+    def read_responses(self, sock):
+        while (response := self.recv_response(sock)) is not None:
+            try:
+                response = decode_message(response)
+            except (ValueError, TypeError):
+                print(f"Incorrect response from {self.name}: {response}")
+                continue
+            request_id = read_request_id(response)
+            with self.pending_lock:
+                pending_request = self.pending.get(request_id, None)
+                # streamed request waits for frames until the last one
+                if pending_request is not None and not (pending_request.frames is not None and read_stream_more(response)):
+                    del self.pending[request_id]
+            if pending_request is None:
+                continue
+            response.pop("id", None)
+            if pending_request.frames is not None:
+                pending_request.frames.put(response)
+            else:
+                pending_request.response = response
+                pending_request.event.set()
+
+        # connection closed, fail requests that were waiting on it
+        self.drop_socket(sock)
+        with self.pending_lock:
+            for request_id, pending_request in list(self.pending.items()):
+                if pending_request.sock is sock:
+                    del self.pending[request_id]
+                    pending_request.event.set()
+                    if pending_request.frames is not None:
+                        pending_request.frames.put(None)
+
+    def send_requests(self, requests_list):
+        return self.send_requests_once(requests_list, retry=True)
+
+    def send_requests_once(self, requests_list, retry):
+        if not (sock := self.get_socket()):
+            return [make_request(GTInfoResponseTypes.no_connection, 0) for _ in requests_list]
+
+        pending_requests = []
+        with self.pending_lock:
+            for request in requests_list:
+                request_id = next(self.request_ids)
+                self.pending[request_id] = pending_request = PendingRequest(sock)
+                pending_requests.append((request_id, pending_request, tag_request(request, request_id)))
+
+        try:
+            with self.send_lock:
+                for request_id, pending_request, request in pending_requests:
+                    send_msg(sock, json.dumps(set_request_codec(request, self.codec)))
+        except OSError:
+            self.drop_socket(sock)
+            with self.pending_lock:
+                for request_id, pending_request, request in pending_requests:
+                    self.pending.pop(request_id, None)
+            # server may close idle connection at any moment, so reconnect once
+            # part of requests may have reached server already, only ones safe to repeat are resent
+            if retry and all(is_safe_to_resend(request) for request in requests_list):
+                return self.send_requests_once(requests_list, retry=False)
+            return [make_request(GTInfoResponseTypes.no_connection, 0) for _ in requests_list]
+
+        responses = []
+        deadline = monotonic() + self.timeout
+        for request_id, pending_request, request in pending_requests:
+            if not pending_request.event.wait(max(deadline - monotonic(), 0)):
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+            responses.append(pending_request.response)
+
+        # connection dropped before responses came (e.g. closed by server as idle), resend unanswered once
+        # request that may have been applied already is resent only if it is safe to repeat
+        if retry and any(response is None for response in responses) and not self.is_connected(sock):
+            retry_indexes = [i for i, response in enumerate(responses) if response is None and is_safe_to_resend(requests_list[i])]
+            retry_responses = self.send_requests_once([requests_list[i] for i in retry_indexes], retry=False) if retry_indexes else []
+            for i, response in zip(retry_indexes, retry_responses):
+                responses[i] = response
+
+        return [make_request(GTInfoResponseTypes.no_response, 0) if response is None else response for response in responses]
+
+    def send_request(self, request):
+        return self.send_requests([request])[0]
+
+    # yields frames of streamed response, last frame has "more" set to False
+    def stream_request(self, request):
+        if not (sock := self.get_socket()):
+            yield make_stream_frame(GTInfoResponseTypes.no_connection, 0, False)
+            return
+
+        request_id = next(self.request_ids)
+        pending_request = PendingRequest(sock, is_streamed=True)
+        with self.pending_lock:
+            self.pending[request_id] = pending_request
+
+        try:
+            try:
+                with self.send_lock:
+                    send_msg(sock, json.dumps(set_request_codec(tag_request(request, request_id), self.codec)))
+            except OSError:
+                self.drop_socket(sock)
+                yield make_stream_frame(GTInfoResponseTypes.no_connection, 0, False)
+                return
+
+            while True:
+                try:
+                    frame = pending_request.frames.get(timeout=self.timeout)
+                except queue.Empty:
+                    frame = None
+                if frame is None:
+                    yield make_stream_frame(GTInfoResponseTypes.no_response, 0, False)
+                    return
+                yield frame
+                if not read_stream_more(frame):
+                    return
+        finally:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+
+    def quick_request(self, request_type, data):
+        return read_request(self.send_request(make_request(request_type, data)))
+
+    def close(self):
+        with self.connect_lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
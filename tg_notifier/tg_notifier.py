@@ -1,5 +1,6 @@
 import datetime as dt
 import json
+from collections import OrderedDict
 from dataclasses import dataclass
 from name_finder import NameFinder
 from datetime import datetime
@@ -7,9 +8,9 @@ import asyncio
 import aiogram
 from asyncio_requests.asyncio_request import request
 import signal
-import socket
 from gtinfo_requests import *
 from binary_functions import *
+from gtinfo_client import GTInfoClient
 
 
 # add 3 hours to date lol
@@ -36,6 +37,8 @@ class TGNotifier:
     @dataclass
     class Settings:
         users_retrieval_freq: int = 1
+        max_pending_notifications: int = 10000  # received activity objects waiting to be sent, db server gets "busy" above it
+        max_delivered_keys: int = 100000  # sessions remembered to skip ones db server sends again
 
     @dataclass
     class Tasks:
@@ -43,6 +46,7 @@ class TGNotifier:
         socket_task: asyncio.Task = None
         update_task: asyncio.Task = None
         polling_task: asyncio.Task = None
+        notify_task: asyncio.Task = None
 
     def __init__(self, bind_address, db_server_address, website_url, token):
         self.bot = aiogram.Bot(token=token)
@@ -53,10 +57,12 @@ class TGNotifier:
         self.BIND_ADDRESS = bind_address
         self.WEBSITE_URL = website_url
         self.db_server_address = db_server_address
+        self.db_client = GTInfoClient(db_server_address)
         self.website_operational = True
-        self.db_operational = True
 
         self.gtinfo_users = set()
+        self.pending_notifications = None  # asyncio.Queue of activity objects, created in running loop
+        self.delivered_keys = OrderedDict()  # sessions already received, oldest first
 
         self.settings = self.Settings()
         self.tasks = self.Tasks()
@@ -64,12 +70,14 @@ class TGNotifier:
     async def start(self):
         print("Telegram notifier starting...")
         signal.signal(signal.SIGTERM, self.stop)
+        self.pending_notifications = asyncio.Queue()
 
         self.tasks.socket_task = asyncio.create_task(self.start_socket())
         self.tasks.update_task = asyncio.create_task(self.start_update())
         self.tasks.polling_task = asyncio.create_task(self.start_polling())
+        self.tasks.notify_task = asyncio.create_task(self.start_notifying())
 
-        tasks_list = [self.tasks.socket_task, self.tasks.update_task, self.tasks.polling_task]
+        tasks_list = [self.tasks.socket_task, self.tasks.update_task, self.tasks.polling_task, self.tasks.notify_task]
         await asyncio.wait(tasks_list, return_when=asyncio.FIRST_COMPLETED)
 
         # tasks_list = [self.tasks.socket_task, self.tasks.update_task]
@@ -78,9 +86,10 @@ class TGNotifier:
 
     def stop(self, *args):
         print("cancelling tasks")
-        tasks_list = [self.tasks.socket_task, self.tasks.update_task, self.tasks.polling_task]
+        tasks_list = [self.tasks.socket_task, self.tasks.update_task, self.tasks.polling_task, self.tasks.notify_task]
         for task in tasks_list:
             task.cancel()
+        self.db_client.close()
 
     async def start_socket(self):
         print('Socket active')
@@ -88,16 +97,51 @@ class TGNotifier:
         async with server:
             await server.serve_forever()
 
+    # db server keeps connection open and sends batches one by one,
+    # each batch is acknowledged with its id as soon as it is queued, notifications are sent by notify task,
+    # so acknowledgement doesn't wait for telegram and name lookups however big the batch is
     async def handle_connection(self, reader, writer):
         try:
-            message = (await reader.read())[4:].decode()
-            message = json.loads(message)
-            if message["command"] == "new_user_online_activity_objects":
-                await self.notify(message["user_online_activity_objects"])
+            while (message_raw := await read_msg(reader)) is not None:
+                message = json.loads(message_raw.decode())
+                response = make_request(GTInfoResponseTypes.ok, 0)
+                try:
+                    if message["command"] == "new_user_online_activity_objects":
+                        if not self.queue_notifications(message["user_online_activity_objects"]):
+                            response = make_request(GTInfoResponseTypes.busy, 0)
+                except Exception as ex:
+                    print("Error at handling message: ", ex)
+                    response = make_request(GTInfoResponseTypes.error, 0)
+                writer.write(pack_msg(json.dumps(tag_request(response, read_request_id(message)))))
+                await writer.drain()
         except Exception as ex:
             print("Error at handling connection: ", ex)
         writer.close()
 
+    # returns False if objects don't fit into pending notifications, db server sends them again later
+    # sessions received before are skipped, db server resends batch whose acknowledgement was lost
+    def queue_notifications(self, user_online_activity_objects):
+        pending_count = self.pending_notifications.qsize()
+        if pending_count and pending_count + len(user_online_activity_objects) > self.settings.max_pending_notifications:
+            return False
+        for user_online_activity_object in user_online_activity_objects:
+            key = tuple(user_online_activity_object.get(column, None) for column in ("tracked_user", "game_id", "started_playing_timestamp", "ended_playing_timestamp"))
+            if key in self.delivered_keys:
+                continue
+            self.delivered_keys[key] = True
+            if len(self.delivered_keys) > self.settings.max_delivered_keys:
+                self.delivered_keys.popitem(last=False)
+            self.pending_notifications.put_nowait(user_online_activity_object)
+        return True
+
+    async def start_notifying(self):
+        while True:
+            user_online_activity_object = await self.pending_notifications.get()
+            try:
+                await self.notify([user_online_activity_object])
+            except Exception as ex:
+                print("Error at notifying: ", ex)
+
     async def notify(self, user_online_activity_objects):
         print("received", user_online_activity_objects)
         for user_online_activity_object in user_online_activity_objects:
@@ -146,32 +190,11 @@ class TGNotifier:
 
         self.gtinfo_users = new_gtinfo_users
 
-    def try_to_connect(self):
-        sock = socket.socket()
-        sock.settimeout(5)
-        try:
-            sock.connect(self.db_server_address)
-            if not self.db_operational:
-                print(f"DB is operational since {dt.datetime.utcnow()} utc")
-                self.db_operational = True
-            return sock
-        except (ConnectionRefusedError, socket.timeout, OSError) as ex:
-            if self.db_operational:
-                print(f"DB is not operational since {dt.datetime.utcnow()} utc ({ex})")
-                self.db_operational = False
-
     def send_request(self, request):
-        if not (sock := self.try_to_connect()):
-            return make_request(GTInfoResponseTypes.no_connection, 0)
-        send_msg(sock, json.dumps(request))
-        if not (response := recv_msg(sock)):
-            return make_request(GTInfoResponseTypes.no_response, 0)
-        sock.close()
-        response = json.loads(response)
-        return response
+        return self.db_client.send_request(request)
 
     def quick_request(self, request_type, data):
-        return read_request(self.send_request(make_request(request_type, data)))
+        return self.db_client.quick_request(request_type, data)
 
     async def start_polling(self):
         @self.dp.message_handler(commands=['users_week', 'games_week', 'users_total', 'games_total'])
@@ -188,17 +211,19 @@ class TGNotifier:
             comment = ""
             # "end_timestamp": int(datetime.now().timestamp())
             request_data = {"limit": 10, "tracked_users": list(gtinfo_user.notified_users)}
+            # rounded to minute, so repeated requests hit db server result cache
+            week_start_timestamp = int(datetime.now().timestamp()) // 60 * 60 - 7 * 24 * 60 * 60
             request = None
             if msg.text == '/users_week':
                 request = GTInfoRequestTypes.most_played_users
-                request_data["start_timestamp"] = int(datetime.now().timestamp()) - 7 * 24 * 60 * 60
+                request_data["start_timestamp"] = week_start_timestamp
                 comment = "Активные пользователи за последнюю неделю:\n"
             elif msg.text == '/users_total':
                 request = GTInfoRequestTypes.most_played_users
                 comment = "Активные пользователи за все время сервиса:\n"
             elif msg.text == '/games_week':
                 request = GTInfoRequestTypes.most_played_games
-                request_data["start_timestamp"] = int(datetime.now().timestamp()) - 7 * 24 * 60 * 60
+                request_data["start_timestamp"] = week_start_timestamp
                 comment = "Популярные игры за последнюю неделю:\n"
             elif msg.text == '/games_total':
                 request = GTInfoRequestTypes.most_played_games
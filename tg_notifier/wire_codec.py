@@ -0,0 +1,238 @@
+# compact binary alternative to json frames
+# binary frame starts with MAGIC, json frame starts with "{", so frames of both kinds are told apart by first byte
+# lists of equal-length rows are encoded column by column, int and float columns as packed little-endian arrays
+import sys
+import json
+import struct
+from array import array
+
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+CODECS = (CODEC_JSON, CODEC_BINARY)
+
+MAGIC = b"\xb7\x01"  # marker and format version
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+MIN_ROWSET_SIZE = 2  # shorter lists are cheaper as plain lists
+
+TAG_NONE = b"N"
+TAG_TRUE = b"T"
+TAG_FALSE = b"F"
+TAG_INT = b"i"
+TAG_BIG_INT = b"I"  # doesn't fit into int64, stored as decimal string
+TAG_FLOAT = b"d"
+TAG_STR = b"s"
+TAG_LIST = b"l"
+TAG_DICT = b"m"
+TAG_ARRAY = b"a"  # list of ints or floats as one packed array
+TAG_ROWSET = b"R"
+
+COLUMN_INT = b"q"
+COLUMN_FLOAT = b"d"
+COLUMN_ANY = b"o"
+
+IS_BIG_ENDIAN = sys.byteorder == "big"
+
+pack_u32 = struct.Struct("<I").pack
+unpack_u32 = struct.Struct("<I").unpack_from
+pack_i64 = struct.Struct("<q").pack
+unpack_i64 = struct.Struct("<q").unpack_from
+pack_f64 = struct.Struct("<d").pack
+unpack_f64 = struct.Struct("<d").unpack_from
+
+
+class WireCodecError(ValueError):
+    pass
+
+
+def is_int(value):
+    return type(value) is int or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def pack_array(typecode, values):
+    packed = array(typecode, values)
+    if IS_BIG_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_array(typecode, data, offset, count):
+    packed = array(typecode)
+    end = offset + count * packed.itemsize
+    packed.frombytes(data[offset:end])
+    if IS_BIG_ENDIAN:
+        packed.byteswap()
+    return packed.tolist(), end
+
+
+# returns column type code if all values fit into packed array, else COLUMN_ANY
+def get_column_type(values):
+    if all(is_int(value) and INT64_MIN <= value <= INT64_MAX for value in values):
+        return COLUMN_INT
+    if all(type(value) is float for value in values):
+        return COLUMN_FLOAT
+    return COLUMN_ANY
+
+
+# row set: list of lists or tuples of the same length
+def get_row_width(value):
+    if len(value) < MIN_ROWSET_SIZE or not isinstance(value[0], (list, tuple)):
+        return None
+    width = len(value[0])
+    if width == 0 or not all(isinstance(row, (list, tuple)) and len(row) == width for row in value):
+        return None
+    return width
+
+
+def encode_rowset(out, value, width):
+    out += TAG_ROWSET
+    out += pack_u32(len(value))
+    out += pack_u32(width)
+    for column in zip(*value):
+        column_type = get_column_type(column)
+        out += column_type
+        if column_type == COLUMN_ANY:
+            for item in column:
+                encode_value(out, item)
+        else:
+            out += pack_array(column_type.decode(), column)
+
+
+def encode_value(out, value):
+    if value is None:
+        out += TAG_NONE
+    elif value is True:
+        out += TAG_TRUE
+    elif value is False:
+        out += TAG_FALSE
+    elif is_int(value):
+        if INT64_MIN <= value <= INT64_MAX:
+            out += TAG_INT
+            out += pack_i64(value)
+        else:
+            encoded = str(int(value)).encode()
+            out += TAG_BIG_INT
+            out += pack_u32(len(encoded))
+            out += encoded
+    elif isinstance(value, float):
+        out += TAG_FLOAT
+        out += pack_f64(value)
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        out += TAG_STR
+        out += pack_u32(len(encoded))
+        out += encoded
+    elif isinstance(value, dict):
+        out += TAG_DICT
+        out += pack_u32(len(value))
+        for key, item in value.items():
+            encode_value(out, str(key))  # same as json, keys are strings
+            encode_value(out, item)
+    elif isinstance(value, (list, tuple)):
+        if (width := get_row_width(value)) is not None:
+            encode_rowset(out, value, width)
+            return
+        if len(value) >= MIN_ROWSET_SIZE and (column_type := get_column_type(value)) != COLUMN_ANY:
+            out += TAG_ARRAY
+            out += column_type
+            out += pack_u32(len(value))
+            out += pack_array(column_type.decode(), value)
+            return
+        out += TAG_LIST
+        out += pack_u32(len(value))
+        for item in value:
+            encode_value(out, item)
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+# returns (value, offset after value)
+def decode_value(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == TAG_INT:
+        return unpack_i64(data, offset)[0], offset + 8
+    if tag == TAG_FLOAT:
+        return unpack_f64(data, offset)[0], offset + 8
+    if tag == TAG_STR or tag == TAG_BIG_INT:
+        length = unpack_u32(data, offset)[0]
+        offset += 4
+        value = bytes(data[offset:offset + length]).decode("utf-8")
+        return (int(value) if tag == TAG_BIG_INT else value), offset + length
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_LIST:
+        count = unpack_u32(data, offset)[0]
+        offset += 4
+        value = []
+        for _ in range(count):
+            item, offset = decode_value(data, offset)
+            value.append(item)
+        return value, offset
+    if tag == TAG_ARRAY:
+        column_type = data[offset:offset + 1]
+        count = unpack_u32(data, offset + 1)[0]
+        return unpack_array(column_type.decode(), data, offset + 5, count)
+    if tag == TAG_DICT:
+        count = unpack_u32(data, offset)[0]
+        offset += 4
+        value = {}
+        for _ in range(count):
+            key, offset = decode_value(data, offset)
+            value[key], offset = decode_value(data, offset)
+        return value, offset
+    if tag == TAG_ROWSET:
+        count = unpack_u32(data, offset)[0]
+        width = unpack_u32(data, offset + 4)[0]
+        offset += 8
+        columns = []
+        for _ in range(width):
+            column_type = data[offset:offset + 1]
+            offset += 1
+            if column_type == COLUMN_ANY:
+                column = []
+                for _ in range(count):
+                    item, offset = decode_value(data, offset)
+                    column.append(item)
+            else:
+                column, offset = unpack_array(column_type.decode(), data, offset, count)
+            columns.append(column)
+        return list(map(list, zip(*columns))), offset
+    raise WireCodecError(f"unknown tag {tag} at {offset - 1}")
+
+
+# returns str for json and bytes for binary codec, both can be passed to send_msg
+def encode_message(message, codec=CODEC_JSON):
+    if codec != CODEC_BINARY:
+        return json.dumps(message)
+    out = bytearray(MAGIC)
+    encode_value(out, message)
+    return bytes(out)
+
+
+def decode_message(raw):
+    if raw[:len(MAGIC)] == MAGIC:
+        try:
+            value, offset = decode_value(raw, len(MAGIC))
+        except (struct.error, IndexError, UnicodeDecodeError) as ex:
+            raise WireCodecError(f"broken binary message: {ex}")
+        if offset != len(raw):
+            raise WireCodecError(f"{len(raw) - offset} unexpected bytes after message")
+        return value
+    return json.loads(raw)
+
+
+# client asks for codec of responses with "codec" field of request, old clients get json
+def read_request_codec(request, default=CODEC_JSON):
+    codec = request.get("codec", default) if isinstance(request, dict) else default
+    return codec if codec in CODECS else default
+
+
+def set_request_codec(request, codec):
+    return request if codec == CODEC_JSON else {**request, "codec": codec}